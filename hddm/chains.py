@@ -0,0 +1,555 @@
+"""Parallel HMC chains for the DDM regressions, with online convergence checks.
+
+Each chain runs in its own worker process and samples the posterior of a
+``wiener.Regressor`` model with Hamiltonian Monte Carlo. Chains draw from
+independent streams spawned from one seed, so a fit is reproduced by its
+seed regardless of how the chains were scheduled on the workers.
+
+When the data has a subject column the model is hierarchical, as the
+HDDMRegressor fits are: subject intercepts around group intercepts, with
+group sds. HMC samples it in a non-centred parameterisation, moving the
+log of every group sd and the subjects' standardized offsets z, with
+subject intercept = group intercept + sd * z, which avoids the funnel
+between the sds and the subjects. The store holds the draws in the
+model's own terms (``v_Intercept_std``, ``v_Intercept_subj.3``, ...), as
+``to_params`` maps them.
+
+Sampling proceeds in rounds of ``block`` draws per chain. After every
+round the new draws are appended to the output directory, a trace store
+(see ``traces.py``), split R-hat and the effective sample size are updated
+from all draws so far, and sampling stops as soon as every parameter meets
+the targets (or at ``max_draws``)::
+
+    python chains.py -d hddm_data_full_center.csv -b test -m vta -o fits/test_vta
+
+in place of sampling ``*_chain_0..4`` separately and combining them with
+``kabuki.utils.concat_models``. The store's ``meta.json`` also records the
+model, the subject column, the seed and the convergence history, and the
+store can be read with ``traces.Traces`` while the fit is running.
+
+"""
+from __future__ import division
+import sys, getopt
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import wiener
+import traces
+
+#the model being sampled, built once in every worker process
+_model = None
+
+#priors on the regression intercepts: HDDM's informative group priors
+#(Wiecki et al., 2013) as (mean, sd), normal for v and gamma for a and t
+intercept_priors = dict(v = ('normal', 2., 3.),
+                        a = ('gamma', 1.5, .75),
+                        t = ('gamma', .4, .2))
+
+#sd of the normal priors on the other coefficients
+coefficient_sd = 2.
+
+#sd of the half-normal priors on the group sds of the subject intercepts,
+#as in HDDM's informative priors
+std_priors = dict(v = 2., a = 2., t = 1.)
+
+
+def load_data(fname, block=None):
+    """Trials of a data file, with error RTs made negative as in HDDM.
+
+    Parameters
+    ----------
+    fname : string
+        CSV file with rt, response (1 correct, 0 error) and the model's
+        columns, like ``hddm_data_full_center.csv``.
+    block : string, optional
+        Keep only trials whose ``cond`` is block ('reward' or 'test').
+
+    """
+    import pandas as pd
+    data = pd.read_csv(fname)
+    if block is not None:
+        data = data[data['cond'] == block].reset_index(drop = True)
+    if (data['rt'] > 0).all():
+        data['rt'] = np.where(data['response'] == 1, data['rt'], -data['rt'])
+    return data
+
+
+def store_model(store, data):
+    """The ``wiener.Regressor`` of a trace store's fit, for a dataset.
+
+    The model is hierarchical if the store records a subject column.
+    Raises ValueError if the store lacks parameters the data needs (e.g.
+    subjects it wasn't fitted to) or has subject nodes the model doesn't
+    use, such as those of an HDDM fit with subject-level regressors.
+    """
+    meta = store.meta
+    model = wiener.Regressor(data, meta['models'], p_outlier = meta.get('p_outlier', 0),
+                             subject = meta.get('subject'))
+    missing = [name for name in model.names if name not in store]
+    if missing:
+        raise ValueError('%s has no %s' % (store.path, ', '.join(missing[:5])))
+    nodes = set(name.split('_subj.')[0] for name in model.names if '_subj.' in name)
+    unused = [name for name in store.names
+              if '_subj.' in name and name.split('_subj.')[0] not in nodes]
+    if unused:
+        raise ValueError('%s has subject nodes the model does not use: %s'
+                         % (store.path, ', '.join(unused[:5])))
+    return model
+
+
+####################
+#### Posterior #####
+####################
+
+def to_params(model, phi):
+    """Model coefficients from a point of the sampler's space.
+
+    phi is one vector or an array (..., parameters) ordered like
+    ``model.names``, holding log sds and standardized subject offsets in
+    the slots of the sds and subject intercepts. Pooled models are
+    sampled in their own terms.
+    """
+    phi = np.asarray(phi, float)
+    theta = phi.copy()
+    for param in model.subj_slices:
+        sl = model.subj_slices[param]
+        sd = np.exp(phi[..., model.std[param]])
+        theta[..., model.std[param]] = sd
+        theta[..., sl] = phi[..., model.slices[param].start, None] + sd[..., None] * phi[..., sl]
+    return theta
+
+
+def from_params(model, theta):
+    """The sampler's point for model coefficients; inverts ``to_params``."""
+    theta = np.asarray(theta, float)
+    phi = theta.copy()
+    for param in model.subj_slices:
+        sl = model.subj_slices[param]
+        sd = theta[..., model.std[param]]
+        phi[..., model.std[param]] = np.log(sd)
+        phi[..., sl] = (theta[..., sl] - theta[..., model.slices[param].start, None]) / sd[..., None]
+    return phi
+
+
+def log_prior(model, theta):
+    """Log prior density of a point of the sampler's space and its gradient.
+
+    The group sds' half-normal priors include the Jacobian of their log,
+    and the subject offsets are standard normal.
+    """
+    theta = np.asarray(theta, float)
+    logp = 0.
+    grad = np.zeros(len(theta))
+    for param in model.params:
+        sl = model.slices[param]
+        coefs = theta[sl]
+
+        #intercepts, or the parameter itself when it isn't regressed
+        kind, mean, sd = intercept_priors[param]
+        x = coefs[0]
+        if kind == 'normal':
+            logp += -.5 * ((x - mean) / sd) ** 2
+            grad[sl.start] = -(x - mean) / sd ** 2
+        else:
+            shape, scale = (mean / sd) ** 2, sd ** 2 / mean
+            if x <= 0:
+                return -np.inf, grad
+            logp += (shape - 1) * np.log(x) - x / scale
+            grad[sl.start] = (shape - 1) / x - 1 / scale
+
+        logp += -.5 * np.sum((coefs[1:] / coefficient_sd) ** 2)
+        grad[sl.start + 1:sl.stop] = -coefs[1:] / coefficient_sd ** 2
+
+        if param in model.subj_slices:
+            i, sl = model.std[param], model.subj_slices[param]
+            sd = np.exp(theta[i])
+            logp += -.5 * (sd / std_priors[param]) ** 2 + theta[i]
+            grad[i] = 1 - (sd / std_priors[param]) ** 2
+            logp += -.5 * np.sum(theta[sl] ** 2)
+            grad[sl] = -theta[sl]
+    return logp, grad
+
+
+def log_posterior(model, theta):
+    """Unnormalized log posterior of a point of the sampler's space and its
+    gradient."""
+    prior, dprior = log_prior(model, theta)
+    if not np.isfinite(prior):
+        return -np.inf, dprior
+    logp, grad = model.logp_grad(to_params(model, theta))
+    if not np.isfinite(logp):
+        return -np.inf, grad
+
+    #chain rule through the subject intercepts
+    for param in model.subj_slices:
+        i, sl = model.std[param], model.subj_slices[param]
+        d_subj = grad[sl]
+        sd = np.exp(theta[i])
+        grad[model.slices[param].start] += d_subj.sum()
+        grad[i] = np.sum(d_subj * theta[sl]) * sd
+        grad[sl] = d_subj * sd
+    return logp + prior, grad + dprior
+
+
+def find_starting_values(model):
+    """Posterior mode, where chains start, as HDDM's ``find_starting_values``.
+
+    The non-centred posterior has no useful mode in the group sds (it puts
+    them at the mode of their prior and shrinks the offsets to match), so
+    the sds are held at their initial values while the rest is optimized,
+    and then set to the spread of the subject intercepts found.
+    """
+    from scipy.optimize import minimize
+
+    start = from_params(model, model.initial_values())
+    free = np.ones(len(start), bool)
+    free[list(model.std.values())] = False
+
+    def objective(x):
+        theta = start.copy()
+        theta[free] = x
+        logp, grad = log_posterior(model, theta)
+        if not np.isfinite(logp):
+            return 1e20, np.zeros(len(x))
+        return -logp, -grad[free]
+
+    result = minimize(objective, start[free], jac = True, method = 'L-BFGS-B')
+    mode = start.copy()
+    mode[free] = result.x
+
+    theta = to_params(model, mode)
+    for param in model.subj_slices:
+        theta[model.std[param]] = max(theta[model.subj_slices[param]].std(), .01)
+    return from_params(model, theta)
+
+
+####################
+#### HMC ###########
+####################
+
+def _velocity(inv_mass, momentum):
+    #inverse mass matrix times momentum, for a diagonal (1-D) or dense metric
+    if inv_mass.ndim == 1:
+        return inv_mass * momentum
+    return inv_mass.dot(momentum)
+
+
+def _momentum(inv_mass, rng):
+    #momentum with covariance the mass matrix, the inverse of inv_mass
+    z = rng.standard_normal(len(inv_mass))
+    if inv_mass.ndim == 1:
+        return z / np.sqrt(inv_mass)
+    return np.linalg.solve(np.linalg.cholesky(inv_mass).T, z)
+
+
+def leapfrog(theta, momentum, grad, step, inv_mass, n_steps):
+    """Integrate Hamiltonian dynamics; returns the end point and its log posterior."""
+    momentum = momentum + step / 2 * grad
+    for i in range(n_steps):
+        theta = theta + step * _velocity(inv_mass, momentum)
+        logp, grad = log_posterior(_model, theta)
+        if not np.isfinite(logp):
+            return theta, momentum, -np.inf, grad
+        if i < n_steps - 1:
+            momentum = momentum + step * grad
+    momentum = momentum + step / 2 * grad
+    return theta, momentum, logp, grad
+
+
+def hmc_step(state):
+    """One HMC transition; updates state and returns the acceptance probability."""
+    rng = state['rng']
+    inv_mass = state['inv_mass']
+    #jitter the step size so the trajectory length doesn't resonate
+    step = state['step'] * rng.uniform(.9, 1.1)
+
+    momentum = _momentum(inv_mass, rng)
+    h0 = state['logp'] - .5 * momentum.dot(_velocity(inv_mass, momentum))
+    theta, momentum, logp, grad = leapfrog(state['theta'], momentum, state['grad'],
+                                           step, inv_mass, state['n_leapfrog'])
+    h1 = logp - .5 * momentum.dot(_velocity(inv_mass, momentum))
+
+    accept = 0. if not np.isfinite(h1) else min(1., np.exp(h1 - h0))
+    if rng.uniform() < accept:
+        state['theta'], state['logp'], state['grad'] = theta, logp, grad
+    return accept
+
+
+def _dual_averaging(state, step):
+    #Hoffman & Gelman (2014) step size adaptation toward 80% acceptance
+    state['adapt'] = dict(mu = np.log(10 * step), h_bar = 0., log_step_bar = 0., m = 0)
+    state['step'] = step
+
+
+def _adapt_step(state, accept, target=.8, gamma=.05, t0=10, kappa=.75):
+    ad = state['adapt']
+    ad['m'] += 1
+    m = ad['m']
+    ad['h_bar'] = (1 - 1 / (m + t0)) * ad['h_bar'] + (target - accept) / (m + t0)
+    log_step = ad['mu'] - np.sqrt(m) / gamma * ad['h_bar']
+    ad['log_step_bar'] = m ** -kappa * log_step + (1 - m ** -kappa) * ad['log_step_bar']
+    state['step'] = np.exp(log_step)
+
+
+def _init_worker(data, models, p_outlier, subject):
+    global _model
+    _model = wiener.Regressor(data, models, p_outlier = p_outlier, subject = subject)
+
+
+def warmup(state, n_warmup):
+    """Adapt the step size and the mass matrix; draws are discarded.
+
+    The mass matrix is set from the variance of the middle half of the
+    warmup, after which the step size is adapted again for the new metric.
+    Hierarchical models get the whole covariance: the group intercepts and
+    the subject offsets move together along a ridge that a diagonal metric
+    crosses in tiny steps.
+    """
+    logp, grad = log_posterior(_model, state['theta'])
+    state['logp'], state['grad'] = logp, grad
+    _dual_averaging(state, state['step'])
+
+    window = (n_warmup // 4, 3 * n_warmup // 4)
+    draws = []
+    for i in range(n_warmup):
+        accept = hmc_step(state)
+        _adapt_step(state, accept)
+        if window[0] <= i < window[1]:
+            draws.append(state['theta'])
+        if i == window[1] - 1 and len(draws) > 2:
+            n = len(draws)
+            if _model.hierarchical:
+                cov = np.cov(np.array(draws).T)
+                state['inv_mass'] = n / (n + 5) * cov + 1e-3 * 5 / (n + 5) * np.eye(len(cov))
+            else:
+                var = np.var(draws, axis = 0)
+                state['inv_mass'] = n / (n + 5) * var + 1e-3 * 5 / (n + 5)
+            _dual_averaging(state, state['step'])
+    state['step'] = np.exp(state['adapt']['log_step_bar'])
+    return state
+
+
+def sample(state, n_draws):
+    """Draw n_draws from a warmed-up chain; returns (state, draws, acceptance)."""
+    draws = np.empty((n_draws, len(state['theta'])))
+    accept = np.empty(n_draws)
+    for i in range(n_draws):
+        accept[i] = hmc_step(state)
+        draws[i] = state['theta']
+    return state, draws, accept
+
+
+def _run_round(state, n_draws, n_warmup=0):
+    #worker task: optionally warm up, then sample; the state travels with it
+    if n_warmup:
+        state = warmup(state, n_warmup)
+    return sample(state, n_draws)
+
+
+####################
+#### Diagnostics ###
+####################
+
+def autocovariance(x):
+    """Autocovariance of x along its last axis, by FFT."""
+    n = x.shape[-1]
+    m = 2 ** int(np.ceil(np.log2(2 * n)))
+    x = x - x.mean(-1, keepdims = True)
+    f = np.fft.rfft(x, m)
+    return np.fft.irfft(f * np.conj(f), m)[..., :n] / n
+
+
+def rhat(draws):
+    """Split R-hat of every parameter.
+
+    Parameters
+    ----------
+    draws : array (chains, draws, parameters)
+
+    """
+    n = draws.shape[1] // 2
+    split = np.concatenate([draws[:, :n], draws[:, n:2 * n]])
+    W = split.var(1, ddof = 1).mean(0)
+    B = split.mean(1).var(0, ddof = 1)
+    var_plus = (n - 1) / n * W + B
+    return np.sqrt(var_plus / W)
+
+
+def ess(draws):
+    """Effective sample size of every parameter across chains.
+
+    Uses the multi-chain autocorrelation estimate with Geyer's initial
+    monotone sequence, as Stan does.
+
+    Parameters
+    ----------
+    draws : array (chains, draws, parameters)
+
+    """
+    m, n, k = draws.shape
+    x = np.moveaxis(draws, 1, -1)
+    acov = autocovariance(x)
+    W = (acov[..., 0] * n / (n - 1)).mean(0)
+    B = x.mean(-1).var(0, ddof = 1) if m > 1 else 0
+    var_plus = (n - 1) / n * W + B
+    rho = 1 - (W[:, None] - acov.mean(0)) / var_plus[:, None]
+    rho[:, 0] = 1
+
+    #sums of adjacent pairs, truncated at the first negative and made monotone
+    n_pairs = n // 2
+    pairs = rho[:, :2 * n_pairs].reshape(k, n_pairs, 2).sum(-1)
+    pairs = np.where(np.cumprod(pairs > 0, axis = 1).astype(bool), pairs, 0)
+    pairs = np.minimum.accumulate(pairs, axis = 1)
+    tau = -1 + 2 * pairs.sum(1)
+    return m * n / np.maximum(tau, 1 / np.log10(m * n))
+
+
+####################
+#### Runner ########
+####################
+
+def run_chains(data, models, outdir, n_chains=5, n_warmup=500, max_draws=5000,
+               block=100, rhat_target=1.01, ess_target=400, p_outlier=.05,
+               n_leapfrog=10, seed=None, n_workers=None, hierarchical=True):
+    """Sample a DDM regression with parallel chains until they converge.
+
+    Parameters
+    ----------
+    data : DataFrame
+        Trials with signed RTs (see ``load_data``).
+    models : list of strings
+        Regression formulas (see ``wiener.regression_models``).
+    outdir : string
+        Directory of the trace store.
+    n_chains : int
+        Number of chains.
+    n_warmup : int
+        Adaptation iterations per chain, not saved.
+    max_draws : int
+        Draws per chain after which sampling stops regardless.
+    block : int
+        Draws per chain between convergence checks.
+    rhat_target, ess_target : floats
+        Sampling stops once every parameter has R-hat below rhat_target and
+        effective sample size above ess_target.
+    p_outlier : float
+        Probability of outlier responses in the likelihood.
+    n_leapfrog : int
+        Leapfrog steps per HMC transition.
+    seed : int, optional
+        Seed of the chains' random streams; drawn from the OS when None.
+    n_workers : int, optional
+        Worker processes; one per chain by default.
+    hierarchical : bool
+        Fit subject intercepts if the data has a subject column (see
+        ``wiener.subject_column``); pool the subjects otherwise.
+
+    Returns
+    -------
+    draws : array (chains, draws, parameters)
+        Draws of the model's coefficients.
+    meta : dict
+        The store's metadata.
+
+    """
+    subject = wiener.subject_column(data) if hierarchical else None
+    model = wiener.Regressor(data, models, p_outlier = p_outlier, subject = subject)
+    seed_seq = np.random.SeedSequence(seed)
+    rngs = [np.random.default_rng(s) for s in seed_seq.spawn(n_chains)]
+
+    #chains start around the posterior mode
+    mode = find_starting_values(model)
+    states = []
+    for rng in rngs:
+        theta = mode + rng.normal(0, .01, len(mode))
+        states.append(dict(theta = theta, rng = rng, step = .1, n_leapfrog = n_leapfrog,
+                           inv_mass = np.ones(len(mode))))
+
+    meta = dict(models = list(models),
+                p_outlier = p_outlier,
+                subject = subject,
+                n_warmup = n_warmup,
+                seed = seed_seq.entropy,
+                converged = False,
+                history = [])
+    writer = traces.TraceWriter(outdir, model.names, n_chains, max_draws, meta)
+    meta = writer.meta
+
+    draws = np.empty((n_chains, 0, len(model.names)))
+    t0 = time.time()
+    with ProcessPoolExecutor(max_workers = n_workers or n_chains,
+                             initializer = _init_worker,
+                             initargs = (data, models, p_outlier, subject)) as pool:
+        while draws.shape[1] < max_draws:
+            n_draws = min(block, max_draws - draws.shape[1])
+            n_warm = n_warmup if draws.shape[1] == 0 else 0
+            results = list(pool.map(_run_round, states, [n_draws] * n_chains, [n_warm] * n_chains))
+
+            states = [res[0] for res in results]
+            new = to_params(model, np.stack([res[1] for res in results]))
+            draws = np.concatenate([draws, new], 1)
+
+            r, n_eff = rhat(draws), ess(draws)
+            accept = np.mean([res[2].mean() for res in results])
+            meta['history'].append(dict(n_draws = draws.shape[1],
+                                        seconds = time.time() - t0,
+                                        max_rhat = float(r.max()),
+                                        min_ess = float(n_eff.min()),
+                                        accept = float(accept)))
+            meta['rhat'] = r.tolist()
+            meta['ess'] = n_eff.tolist()
+            meta['converged'] = bool(r.max() < rhat_target and n_eff.min() > ess_target)
+
+            #stream the round's draws and diagnostics to the store
+            writer.append(new)
+            print('%i draws per chain: max R-hat %.3f, min ESS %.0f, acceptance %.2f'
+                  % (draws.shape[1], r.max(), n_eff.min(), accept))
+
+            if meta['converged']:
+                break
+
+    writer.close()
+    return draws, meta
+
+
+def main(arglist):
+    help_str = 'chains.py -d <data_csv> -o <outdir> [-b <block> -m <model> -n <n_chains> -s <seed> -p]'
+    try:
+        opts, args = getopt.getopt(arglist, "d:o:b:m:n:s:p", ["data=", "outdir=", "block=", "model=", "chains=", "seed=", "pooled"])
+    except getopt.GetoptError:
+        print(help_str)
+        sys.exit(2)
+
+    fname, outdir, cond, spec, n_chains, seed = None, None, None, 'vta', 5, None
+    hierarchical = True
+    for opt, arg in opts:
+        if opt in ("-d", "--data"):
+            fname = arg
+        elif opt in ("-o", "--outdir"):
+            outdir = arg
+        elif opt in ("-b", "--block"):
+            cond = arg
+        elif opt in ("-m", "--model"):
+            spec = arg
+        elif opt in ("-n", "--chains"):
+            n_chains = int(arg)
+        elif opt in ("-s", "--seed"):
+            seed = int(arg)
+        elif opt in ("-p", "--pooled"):
+            hierarchical = False
+    if fname is None or outdir is None:
+        print(help_str)
+        sys.exit(2)
+
+    data = load_data(fname, cond)
+    models = wiener.regression_models(spec)
+    draws, meta = run_chains(data, models, outdir, n_chains = n_chains, seed = seed,
+                             hierarchical = hierarchical)
+
+    print('\nconverged' if meta['converged'] else '\nnot converged')
+    for name, mean, r, n_eff in zip(meta['names'], draws.mean((0, 1)), meta['rhat'], meta['ess']):
+        print('%-60s %8.4f  R-hat %.3f  ESS %.0f' % (name, mean, r, n_eff))
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,337 @@
+"""DIC, WAIC and PSIS-LOO for the DDM regression variants.
+
+Every variant of ``variants`` (which parameters depend on the trial type)
+is loaded from its trace store in the fit directory, or fitted with
+``chains.run_chains`` when the store doesn't exist yet. Each fit is then
+scored from its pointwise log likelihood, a (draws x trials) matrix
+computed in chunks of draws:
+
+* DIC, as HDDM reports it: mean deviance plus pD, the mean deviance minus
+  the deviance at the posterior mean.
+* WAIC: log pointwise predictive density minus the summed variance of the
+  log likelihood over draws (Watanabe, 2010).
+* PSIS-LOO: leave-one-out predictive density from importance weights whose
+  tails are smoothed with a generalized Pareto fit (Vehtari et al., 2017),
+  with the Pareto k of every trial as a diagnostic.
+
+Fits run one after another, each on all cores through its chains; the
+scores of the variants are computed concurrently in a process pool. Scores
+are cached in ``<fitdir>/comparison/`` under a hash of the data and the
+contents of the fit's store, so rerunning the comparison only scores what
+changed::
+
+    python model_comparison.py -d hddm_data_full_center.csv -b reward -f fits -o dic_reward.csv
+
+The resulting table replaces the hand-copied ``DIC_map``, with each
+criterion also given relative to the coherence-only model.
+
+"""
+from __future__ import division
+import sys, getopt
+import os
+import os.path as op
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import wiener
+import traces
+import chains
+from chains import load_data
+
+#model variants of the paper, named by the parameters that vary with trial type
+variants = ['coherence', 'a', 'v', 't', 'va', 'vt', 'ta', 'vta']
+
+#baseline the criteria are reported relative to
+baseline = 'coherence'
+
+
+def logsumexp(x, axis=0):
+    m = np.max(x, axis, keepdims = True)
+    m = np.where(np.isfinite(m), m, 0)
+    with np.errstate(divide = 'ignore'):
+        return np.log(np.sum(np.exp(x - m), axis)) + np.squeeze(m, axis)
+
+
+def pointwise_loglik(model, theta, chunk=50):
+    """Log likelihood (draws, trials) of draws theta (draws, coefficients)."""
+    loglik = np.empty((len(theta), len(model.x)))
+    for start in range(0, len(theta), chunk):
+        loglik[start:start + chunk] = model.pointwise(theta[start:start + chunk])
+    return loglik
+
+
+def dic(model, theta, loglik):
+    """DIC and pD of draws theta with their pointwise log likelihood.
+
+    Both the mean deviance and the deviance at the posterior mean come
+    from theta, so it has to be the draws loglik was computed from.
+    """
+    if len(theta) != len(loglik):
+        raise ValueError('%i draws for a log likelihood of %i' % (len(theta), len(loglik)))
+    deviance = -2 * loglik.sum(1)
+    d_mean = -2 * model.logp(theta.mean(0))
+    pd = deviance.mean() - d_mean
+    return deviance.mean() + pd, pd
+
+
+def waic(loglik):
+    """WAIC of a pointwise log likelihood (draws, trials).
+
+    Returns
+    -------
+    waic, p_waic, se : floats
+        WAIC on the deviance scale, the effective number of parameters
+        and the standard error of WAIC.
+
+    """
+    n_draws, n_trials = loglik.shape
+    lppd = logsumexp(loglik) - np.log(n_draws)
+    p = loglik.var(0, ddof = 1)
+    elpd = lppd - p
+    return -2 * elpd.sum(), p.sum(), 2 * np.sqrt(n_trials * elpd.var())
+
+
+def gpd_fit(x, prior_bs=3, prior_k=10):
+    """Generalized Pareto fit to exceedances, one row per trial.
+
+    Zhang & Stephens (2009) estimator with the weakly informative prior on
+    k of Vehtari et al. (2017), vectorized over the rows of x.
+
+    Parameters
+    ----------
+    x : array (trials, n)
+        Positive exceedances, sorted ascending along each row.
+
+    Returns
+    -------
+    k, sigma : arrays (trials,)
+
+    """
+    n = x.shape[1]
+    m = 30 + int(np.sqrt(n))
+    b = 1 - np.sqrt(m / (np.arange(1, m + 1) - .5))
+    b = b / (prior_bs * x[:, int(n / 4 + .5) - 1:int(n / 4 + .5)]) + 1 / x[:, -1:]
+    k = np.log1p(-b[:, :, None] * x[:, None, :]).mean(2)
+    with np.errstate(over = 'ignore', invalid = 'ignore'):
+        len_scale = n * (np.log(-b / k) - k - 1)
+        weights = 1 / np.exp(len_scale[:, None, :] - len_scale[:, :, None]).sum(2)
+    weights /= weights.sum(1, keepdims = True)
+
+    b_post = (b * weights).sum(1)
+    k_post = np.log1p(-b_post[:, None] * x).mean(1)
+    sigma = -k_post / b_post
+    k_post = (n * k_post + prior_k * .5) / (n + prior_k)
+    return k_post, sigma
+
+
+def psis_loo(loglik, chunk=2000):
+    """PSIS-LOO of a pointwise log likelihood (draws, trials).
+
+    Returns
+    -------
+    looic, p_loo, se : floats
+        LOO information criterion on the deviance scale, the effective
+        number of parameters and the standard error of looic.
+    k : array (trials,)
+        Pareto k of each trial's importance weights; above .7 the trial's
+        LOO estimate is unreliable.
+
+    """
+    n_draws, n_trials = loglik.shape
+    n_tail = int(min(np.ceil(.2 * n_draws), np.ceil(3 * np.sqrt(n_draws))))
+    lppd = logsumexp(loglik) - np.log(n_draws)
+
+    loo = np.empty(n_trials)
+    k_hat = np.empty(n_trials)
+    for start in range(0, n_trials, chunk):
+        #log importance ratios are -loglik; sort each trial's draws by them
+        ll = np.sort(loglik[:, start:start + chunk], 0)[::-1].T
+        lw = -ll
+        lw = lw - lw[:, -1:]
+
+        #replace the largest ratios by the quantiles of a Pareto fit
+        cutoff = lw[:, -n_tail - 1:-n_tail]
+        exceed = np.exp(lw[:, -n_tail:]) - np.exp(cutoff)
+        exceed = np.maximum(exceed, np.finfo(float).tiny)
+        k, sigma = gpd_fit(exceed)
+        p = (np.arange(n_tail) + .5) / n_tail
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            tail = sigma[:, None] * np.expm1(-k[:, None] * np.log1p(-p)) / k[:, None]
+            smoothed = np.log(tail + np.exp(cutoff))
+        ok = np.isfinite(k)
+        lw[ok, -n_tail:] = np.minimum(smoothed[ok], 0)
+
+        lw = lw - logsumexp(lw, 1)[:, None]
+        loo[start:start + chunk] = logsumexp(lw + ll, 1)
+        k_hat[start:start + chunk] = np.where(ok, k, np.inf)
+
+    p_loo = (lppd - loo).sum()
+    return -2 * loo.sum(), p_loo, 2 * np.sqrt(n_trials * loo.var()), k_hat
+
+
+####################
+#### Pipeline ######
+####################
+
+def data_hash(data):
+    """Hash of a dataset's contents."""
+    import pandas as pd
+    rows = pd.util.hash_pandas_object(data, index = False).values
+    return hashlib.sha1(rows.tobytes() + ','.join(map(str, data.columns)).encode()).hexdigest()
+
+
+def cache_key(data_key, store, n_samples, seed):
+    """Hash of what a score depends on.
+
+    The fit is identified by the contents of its store, since converted
+    stores have no seed and a refit can reuse one.
+    """
+    spec = dict(data = data_key,
+                fit = store.checksum(),
+                n_samples = n_samples,
+                seed = seed)
+    return hashlib.sha1(json.dumps(spec, sort_keys = True).encode()).hexdigest()
+
+
+def score(store, data, n_samples=1000, seed=0):
+    """DIC, WAIC and PSIS-LOO of a fit on its data.
+
+    All three are computed from ``n_samples`` posterior draws chosen with
+    the seed. Hierarchical fits, including converted HDDM stores with
+    subject nodes, are scored with every subject's own parameters, so DIC
+    is on the scale of HDDM's; stores with subject nodes the model doesn't
+    use raise ValueError (see ``chains.store_model``).
+    """
+    if not isinstance(store, traces.Traces):
+        store = traces.Traces(store)
+    model = chains.store_model(store, data)
+    theta = store.to_array(model.names).reshape(-1, len(model.names)).astype(float)
+
+    rng = np.random.default_rng(seed)
+    sample = np.sort(rng.choice(len(theta), min(n_samples, len(theta)), replace = False))
+    theta = theta[sample]
+    loglik = pointwise_loglik(model, theta)
+
+    result = dict(n_trials = len(model.x), n_draws = len(sample))
+    result['DIC'], result['pD'] = dic(model, theta, loglik)
+    result['WAIC'], result['p_waic'], result['WAIC_se'] = waic(loglik)
+    result['LOO'], result['p_loo'], result['LOO_se'], k = psis_loo(loglik)
+    result['n_bad_k'] = int((k > .7).sum())
+    result['max_k'] = float(k.max())
+    return dict((key, float(val)) if isinstance(val, np.floating) else (key, val)
+                for key, val in result.items())
+
+
+def _score_cached(store_path, data, cache_f, n_samples, seed):
+    #pool task: score one variant and cache the result
+    result = score(store_path, data, n_samples, seed)
+    with open(cache_f, 'w') as f:
+        json.dump(result, f, indent = 1)
+    return result
+
+
+def compare(data, fitdir, block=None, specs=None, n_samples=1000, seed=0,
+            n_workers=None, fit_kwargs=None):
+    """Fit or load every model variant and tabulate their criteria.
+
+    Parameters
+    ----------
+    data : DataFrame
+        Trials with signed RTs (see ``chains.load_data``).
+    fitdir : string
+        Directory of the trace stores, named ``<block>_<spec>``.
+    block : string, optional
+        Data block, used in the store names.
+    specs : list of strings, optional
+        Variants to compare; ``variants`` by default.
+    n_samples : int
+        Posterior draws the pointwise criteria are computed from.
+    seed : int
+        Seed of the draw selection.
+    n_workers : int, optional
+        Processes scoring variants concurrently.
+    fit_kwargs : dict, optional
+        Arguments for ``chains.run_chains`` when a variant has to be fitted.
+
+    Returns
+    -------
+    table : DataFrame
+        One row per variant, with each criterion and its difference from
+        the baseline model (``d<criterion>``) when the baseline is compared.
+
+    """
+    import pandas as pd
+    specs = variants if specs is None else specs
+    cache_dir = op.join(fitdir, 'comparison')
+    if not op.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    #fit what isn't there yet
+    stores = {}
+    for spec in specs:
+        path = op.join(fitdir, spec if block is None else block + '_' + spec)
+        if not op.exists(op.join(path, 'meta.json')):
+            print('fitting %s' % spec)
+            chains.run_chains(data, wiener.regression_models(spec), path, **(fit_kwargs or {}))
+        stores[spec] = path
+
+    #score the variants that aren't cached
+    data_key = data_hash(data)
+    results, todo = {}, {}
+    for spec, path in stores.items():
+        cache_f = op.join(cache_dir, cache_key(data_key, traces.Traces(path), n_samples, seed) + '.json')
+        if op.exists(cache_f):
+            with open(cache_f) as f:
+                results[spec] = json.load(f)
+        else:
+            todo[spec] = (path, cache_f)
+
+    if todo:
+        with ProcessPoolExecutor(max_workers = n_workers) as pool:
+            futures = dict((spec, pool.submit(_score_cached, path, data, cache_f, n_samples, seed))
+                           for spec, (path, cache_f) in todo.items())
+            for spec, future in futures.items():
+                results[spec] = future.result()
+
+    table = pd.DataFrame([dict(model = spec, **results[spec]) for spec in specs])
+    if baseline in results:
+        for crit in ['DIC', 'WAIC', 'LOO']:
+            table['d' + crit] = table[crit] - results[baseline][crit]
+    return table
+
+
+def main(arglist):
+    help_str = 'model_comparison.py -d <data_csv> -f <fitdir> -o <out_csv> [-b <block> -m <v,a,...> -n <n_samples>]'
+    try:
+        opts, args = getopt.getopt(arglist, "d:f:o:b:m:n:", ["data=", "fitdir=", "out=", "block=", "models=", "samples="])
+    except getopt.GetoptError:
+        print(help_str)
+        sys.exit(2)
+
+    fname, fitdir, out_f, cond, specs, n_samples = None, None, None, None, None, 1000
+    for opt, arg in opts:
+        if opt in ("-d", "--data"):
+            fname = arg
+        elif opt in ("-f", "--fitdir"):
+            fitdir = arg
+        elif opt in ("-o", "--out"):
+            out_f = arg
+        elif opt in ("-b", "--block"):
+            cond = arg
+        elif opt in ("-m", "--models"):
+            specs = arg.split(',')
+        elif opt in ("-n", "--samples"):
+            n_samples = int(arg)
+    if fname is None or fitdir is None or out_f is None:
+        print(help_str)
+        sys.exit(2)
+
+    data = load_data(fname, cond)
+    table = compare(data, fitdir, cond, specs, n_samples)
+    table.to_csv(out_f, index = False)
+    print(table[['model', 'DIC', 'WAIC', 'LOO', 'n_bad_k']].to_string(index = False))
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,291 @@
+"""Posterior-predictive simulation of the DDM regressions.
+
+For every posterior draw of a fit (a trace store, see ``traces.py``) and
+every trial of a design, ``simulate`` samples a signed RT from the
+diffusion process with that draw's v, a and t for the trial. Trials with the
+same design rows share their parameters, so the first-passage
+distributions are tabulated once per (draw, condition) and trials are
+sampled from them by inverse CDF:
+
+* The density of the normalized decision time u = (rt - t) / a**2 is
+  f(u | w) times exp(-v a w - v**2 a**2 u / 2) (Navarro & Fuss, 2009), so
+  f is evaluated once on a fixed grid and every table is one exponential
+  of it.
+* Each table is cumulated per boundary and inverted into a quantile
+  function on an even grid of probabilities, so drawing a trial's RT is a
+  uniform draw and one interpolation between two table entries.
+
+Hierarchical fits are simulated from each subject's own parameters;
+pooled fits give every subject the same ones.
+
+The sampling is exact up to the resolution of the grids. ``summarize``
+reduces the samples to the columns the figures use (``rt_positive_sampled``
+and ``accuracy_sampled``, with the data's ``rt_positive`` and
+``accuracy``) per posterior sample and group, like the
+``post_pred_gen`` tables saved as ``avt_reward.csv`` and friends. Groups
+are split by subject only for hierarchical fits::
+
+    python ppc.py -d hddm_data_full_center.csv -b reward -o simulations fits/reward_avt fits/reward_vt
+
+"""
+from __future__ import division
+import sys, getopt
+import os
+import os.path as op
+import numpy as np
+import wiener
+import traces
+from chains import load_data, store_model
+
+#columns the simulated data is averaged over, as in the figures; the
+#subject column comes first for hierarchical fits
+group_columns = ['coherence_bin', 'miniblock_type', 'cond']
+
+
+def u_grid(u_max=6, n_grid=512):
+    """Normalized decision times, spaced densely where the density rises."""
+    return np.linspace(0, np.sqrt(u_max), n_grid) ** 2
+
+
+def passage_tables(v, a, w=.5, u=None, n_quantiles=1024):
+    """First-passage quantile functions of both boundaries.
+
+    Parameters
+    ----------
+    v, a : arrays (k,)
+        Drift and boundary separation of each table.
+    w : float
+        Relative starting point.
+    u : array (g,), optional
+        Grid of normalized decision times the densities are cumulated on;
+        ``u_grid()`` by default.
+    n_quantiles : int
+        Evenly spaced probabilities the quantile functions are tabulated at.
+
+    Returns
+    -------
+    quantiles : array (k, 2, n_quantiles)
+        Normalized decision times at the quantiles of the lower (0) and
+        upper (1) boundary's distribution.
+    p_upper : array (k,)
+        Probability of reaching the upper boundary.
+
+    """
+    u = u_grid() if u is None else u
+    n_grid = len(u)
+    v = np.asarray(v, float)[:, None]
+    a = np.asarray(a, float)[:, None]
+
+    #normalized densities of the boundaries; the upper one mirrors v and w
+    logf = np.empty((2, n_grid))
+    logf[:, 0] = -np.inf
+    for i, ww in enumerate([w, 1 - w]):
+        logf[i, 1:] = wiener.log_series(u[1:], ww)[0]
+    lower = np.exp(logf[0] - v * a * w - v ** 2 * a ** 2 * u / 2)
+    upper = np.exp(logf[1] + v * a * (1 - w) - v ** 2 * a ** 2 * u / 2)
+
+    #trapezoid cumulation in u
+    dens = np.stack([lower, upper], 1)
+    cdf = np.zeros(dens.shape)
+    cdf[..., 1:] = np.cumsum((dens[..., 1:] + dens[..., :-1]) / 2 * np.diff(u), -1)
+    mass = cdf[..., -1]
+    p_upper = mass[:, 1] / mass.sum(1)
+
+    #invert all CDFs in one search: row r of the stacked CDFs spans [r, r + 1]
+    n_rows = cdf.shape[0] * 2
+    offset = np.arange(n_rows)[:, None]
+    flat = (cdf.reshape(n_rows, n_grid) / mass.reshape(n_rows, 1) + offset).ravel()
+    #the top quantile is the end of the tail rather than of the grid
+    q = (np.linspace(0, 1 - 1e-6, n_quantiles) + offset).ravel()
+    j = np.searchsorted(flat, q) - np.repeat(offset.ravel() * n_grid, n_quantiles)
+    j = np.clip(j, 1, n_grid - 1) + np.repeat(offset.ravel() * n_grid, n_quantiles)
+
+    #linear interpolation within the grid step
+    c0, c1 = flat[j - 1], flat[j]
+    frac = np.where(c1 > c0, (q - c0) / np.maximum(c1 - c0, 1e-300), 0)
+    u0 = u[(j - 1) % n_grid]
+    quantiles = u0 + np.clip(frac, 0, 1) * (u[j % n_grid] - u0)
+    return quantiles.reshape(-1, 2, n_quantiles), p_upper
+
+
+def sample_tables(quantiles, p_upper, rows, rng):
+    """Signed normalized decision times from tabulated quantile functions.
+
+    Parameters
+    ----------
+    quantiles, p_upper : arrays
+        Output of ``passage_tables``.
+    rows : int array
+        Table of every sample.
+    rng : Generator
+
+    Returns
+    -------
+    u : array like rows
+        Normalized decision times, negative for the lower boundary.
+
+    """
+    n_quantiles = quantiles.shape[-1]
+    upper = rng.uniform(size = rows.shape) < p_upper[rows]
+    pos = rng.uniform(size = rows.shape) * (n_quantiles - 1)
+    i = np.minimum(pos.astype(int), n_quantiles - 2)
+    frac = pos - i
+
+    table = quantiles.reshape(-1, n_quantiles)
+    row = rows * 2 + upper
+    samples = table[row, i] + frac * (table[row, i + 1] - table[row, i])
+    return np.where(upper, samples, -samples)
+
+
+def simulate(store, data, n_samples=500, seed=None, w=.5, chunk=50):
+    """Signed RTs of every trial under posterior draws of a fit.
+
+    Parameters
+    ----------
+    store : Traces or string
+        Fit with the regression formulas in its metadata.
+    data : DataFrame
+        Trials with the columns the formulas use, and the subject column
+        of a hierarchical fit.
+    n_samples : int
+        Posterior draws to simulate, taken without replacement.
+    seed : int, optional
+        Seed of the draw selection and the sampling.
+    w : float
+        Relative starting point.
+    chunk : int
+        Draws simulated at a time, to bound memory.
+
+    Returns
+    -------
+    rt : array (n_samples, n_trials)
+        Simulated RTs, negative for errors.
+    samples : array (n_samples,)
+        Indices of the draws, counting through the chains.
+
+    """
+    if not isinstance(store, traces.Traces):
+        store = traces.Traces(store)
+    model = store_model(store, data)
+    theta = store.to_array(model.names).reshape(-1, len(model.names)).astype(float)
+
+    rng = np.random.default_rng(seed)
+    n_samples = min(n_samples, len(theta))
+    samples = np.sort(rng.choice(len(theta), n_samples, replace = False))
+
+    rt = np.empty((n_samples, len(data)))
+    for start in range(0, n_samples, chunk):
+        th = theta[samples[start:start + chunk]]
+        #parameters of every (draw, condition)
+        v, a, t = model.condition_params(th)
+        quantiles, p_upper = passage_tables(v.ravel(), a.ravel(), w)
+
+        n = len(th)
+        rows = np.arange(n)[:, None] * model.n_conditions + model.condition
+        x = sample_tables(quantiles, p_upper, rows, rng)
+        a_trial, t_trial = a.ravel()[rows], t.ravel()[rows]
+        rt[start:start + n] = np.sign(x) * (np.abs(x) * a_trial ** 2 + t_trial)
+    return rt, samples
+
+
+def summarize(data, rt, by=None):
+    """Mean simulated and observed RT and accuracy per sample and group.
+
+    Parameters
+    ----------
+    data : DataFrame
+        The simulated trials, with signed ``rt`` if the data is observed.
+    rt : array (n_samples, n_trials)
+        Output of ``simulate``.
+    by : list of strings, optional
+        Grouping columns; those of ``group_columns`` in data by default.
+
+    Returns
+    -------
+    summary : DataFrame
+        One row per sample and group with ``rt_positive_sampled``,
+        ``accuracy_sampled`` and, for observed data, ``rt_positive`` and
+        ``accuracy``.
+
+    """
+    import pandas as pd
+    if by is None:
+        by = [col for col in group_columns if col in data]
+    groups = data.groupby(by, sort = True).ngroup().values
+    keys = data[by].drop_duplicates().sort_values(by).reset_index(drop = True)
+    n_groups = len(keys)
+    n_samples = len(rt)
+
+    #sums per (sample, group) in one bincount
+    idx = (np.arange(n_samples)[:, None] * n_groups + groups).ravel()
+    size = n_samples * n_groups
+    count = np.bincount(idx, minlength = size)
+    rt_sum = np.bincount(idx, np.abs(rt).ravel(), size)
+    acc_sum = np.bincount(idx, (rt > 0).ravel(), size)
+
+    summary = pd.concat([keys] * n_samples, ignore_index = True)
+    summary['sample'] = np.repeat(np.arange(n_samples), n_groups)
+    summary['rt_positive_sampled'] = rt_sum / count
+    summary['accuracy_sampled'] = acc_sum / count
+
+    if 'rt' in data:
+        observed = pd.DataFrame(dict(rt_positive = np.abs(data['rt'].values),
+                                     accuracy = (data['rt'].values > 0).astype(float),
+                                     group = groups)).groupby('group').mean()
+        summary['rt_positive'] = np.tile(observed['rt_positive'].values, n_samples)
+        summary['accuracy'] = np.tile(observed['accuracy'].values, n_samples)
+    return summary
+
+
+def posterior_predictive(store, data, n_samples=500, seed=None, by=None):
+    """Simulate a fit and summarize it; see ``simulate`` and ``summarize``.
+
+    By default, groups are split by subject for hierarchical fits only.
+    """
+    if not isinstance(store, traces.Traces):
+        store = traces.Traces(store)
+    if by is None:
+        subject = store.meta.get('subject')
+        by = [col for col in [subject] + group_columns if col is not None and col in data]
+    rt, samples = simulate(store, data, n_samples, seed)
+    summary = summarize(data, rt, by)
+    summary['draw'] = samples[summary['sample'].values]
+    return summary
+
+
+def main(arglist):
+    help_str = 'ppc.py -d <data_csv> -o <outdir> [-b <block> -n <n_samples> -s <seed>] <store> [<store> ...]'
+    try:
+        opts, args = getopt.getopt(arglist, "d:o:b:n:s:", ["data=", "outdir=", "block=", "samples=", "seed="])
+    except getopt.GetoptError:
+        print(help_str)
+        sys.exit(2)
+
+    fname, outdir, cond, n_samples, seed = None, None, None, 500, 0
+    for opt, arg in opts:
+        if opt in ("-d", "--data"):
+            fname = arg
+        elif opt in ("-o", "--outdir"):
+            outdir = arg
+        elif opt in ("-b", "--block"):
+            cond = arg
+        elif opt in ("-n", "--samples"):
+            n_samples = int(arg)
+        elif opt in ("-s", "--seed"):
+            seed = int(arg)
+    if fname is None or outdir is None or not args:
+        print(help_str)
+        sys.exit(2)
+
+    if not op.exists(outdir):
+        os.makedirs(outdir)
+    data = load_data(fname, cond)
+    for store in args:
+        summary = posterior_predictive(store, data, n_samples, seed)
+        out_f = op.join(outdir, op.basename(op.normpath(store)) + '.csv')
+        summary.to_csv(out_f, index = False)
+        print(out_f)
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
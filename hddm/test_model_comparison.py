@@ -0,0 +1,58 @@
+"""Checks of WAIC and PSIS-LOO against cases worked out by hand.
+
+Run from the hddm directory with ``python -m pytest test_model_comparison.py``.
+"""
+from __future__ import division
+import numpy as np
+import pytest
+import model_comparison as mc
+
+
+def test_waic_two_draws():
+    #trial 1: lppd = log .3, p_waic = var(log .2, log .4) = log(2)**2 / 2
+    #trial 2: lppd = log .5, p_waic = 0
+    loglik = np.log([[.2, .5],
+                     [.4, .5]])
+    waic, p_waic, se = mc.waic(loglik)
+    assert p_waic == pytest.approx(.2402265, abs = 1e-7)
+    assert waic == pytest.approx(-2 * (-1.2039728 - .2402265 - .6931472), abs = 1e-6)
+
+
+def test_constant_likelihood():
+    #every draw fits equally well: no parameters are effective and the
+    #criteria are the deviance
+    loglik = np.tile(np.log([.1, .2, .3]), (400, 1))
+    deviance = -2 * np.log([.1, .2, .3]).sum()
+
+    waic, p_waic, se = mc.waic(loglik)
+    assert waic == pytest.approx(deviance)
+    assert p_waic == pytest.approx(0, abs = 1e-12)
+
+    looic, p_loo, se, k = mc.psis_loo(loglik)
+    assert looic == pytest.approx(deviance)
+    assert p_loo == pytest.approx(0, abs = 1e-9)
+
+
+def test_loo_light_tails_is_importance_sampling():
+    #with light-tailed ratios smoothing only nudges the largest weights, so
+    #LOO is close to the plain importance sampling estimate,
+    #elpd_i = -log mean(exp(-loglik_i))
+    rng = np.random.default_rng(0)
+    loglik = rng.normal(-1, .1, (2000, 20))
+    looic, p_loo, se, k = mc.psis_loo(loglik)
+
+    elpd = -np.log(np.mean(np.exp(-loglik), 0))
+    lppd = np.log(np.mean(np.exp(loglik), 0))
+    assert looic == pytest.approx(-2 * elpd.sum(), abs = 5e-3)
+    assert p_loo == pytest.approx((lppd - elpd).sum(), abs = 5e-3)
+    assert np.all(k < .5)
+
+
+def test_loo_flags_heavy_tails():
+    #one trial badly fit by a few draws gives huge ratios and a large k
+    rng = np.random.default_rng(1)
+    loglik = rng.normal(-1, .1, (1000, 3))
+    loglik[:5, 0] = -30
+    k = mc.psis_loo(loglik)[3]
+    assert k[0] > .7
+    assert np.all(k[1:] < .5)
@@ -0,0 +1,59 @@
+"""Checks of the Wiener first-passage time likelihood.
+
+Run from the hddm directory with ``python -m pytest test_wiener.py``.
+"""
+from __future__ import division
+import numpy as np
+import pytest
+from scipy.integrate import quad
+import wiener
+
+#(v, a, t, w) covering both drift signs, biased starts and wide boundaries
+params = [(0., 1., .3, .5),
+          (1., 1.5, .2, .5),
+          (-.8, 2., .4, .3),
+          (2.5, 1.2, .1, .7),
+          (.5, 3., .3, .5)]
+
+
+def density(x, v, a, t, w, p_outlier=0):
+    return np.exp(wiener.wfpt_logp(np.array([x]), v, a, t, w, p_outlier)[0])
+
+
+def p_lower(v, a, w):
+    """Probability of absorption at the lower boundary (Cox & Miller, 1965)."""
+    if v == 0:
+        return 1 - w
+    return (np.exp(-2 * v * a * w) - np.exp(-2 * v * a)) / (1 - np.exp(-2 * v * a))
+
+
+@pytest.mark.parametrize('v, a, t, w', params)
+def test_density_integrates_to_boundary_probabilities(v, a, t, w):
+    upper = quad(lambda x: density(x, v, a, t, w), t, np.inf, limit = 200)[0]
+    lower = quad(lambda x: density(-x, v, a, t, w), t, np.inf, limit = 200)[0]
+    assert upper + lower == pytest.approx(1, abs = 1e-4)
+    assert lower == pytest.approx(p_lower(v, a, w), abs = 1e-4)
+
+
+def test_no_density_before_t():
+    x = np.array([.1, -.1, .25, -.25])
+    logp = wiener.wfpt_logp(x, 1., 1.5, .3)
+    assert np.all(logp == -np.inf)
+
+
+@pytest.mark.parametrize('p_outlier', [0, .05])
+@pytest.mark.parametrize('v, a, t, w', params)
+def test_gradient_matches_central_differences(v, a, t, w, p_outlier):
+    rng = np.random.default_rng(0)
+    x = (t + rng.gamma(2, .3, 50)) * rng.choice([-1, 1], 50)
+    logp, dv, da, dt = wiener.wfpt_logp_grad(x, v, a, t, w, p_outlier)
+    assert np.allclose(logp, wiener.wfpt_logp(x, v, a, t, w, p_outlier))
+
+    h = 1e-6
+    for i, d in enumerate([dv, da, dt]):
+        up, down = [v, a, t], [v, a, t]
+        up[i] += h
+        down[i] -= h
+        numeric = (wiener.wfpt_logp(x, *up, w = w, p_outlier = p_outlier)
+                   - wiener.wfpt_logp(x, *down, w = w, p_outlier = p_outlier)) / (2 * h)
+        assert np.allclose(d, numeric, rtol = 1e-4, atol = 1e-5)
@@ -0,0 +1,287 @@
+"""Compact posterior trace store.
+
+A fit is a directory holding one float32 file per parameter, each a
+C-ordered (chains, draws) array, and ``meta.json`` with the parameter
+names, the shape and whatever the fit recorded about the model::
+
+    test_block_vta/
+        meta.json
+        p0.f32      #v_Intercept
+        p1.f32      #v_C(miniblock_type, Treatment("noncompete"))[T.compete]
+        ...
+
+Reading needs only numpy. The files are memory-mapped, so a posterior
+summary touches just the parameters it uses::
+
+    traces = Traces('models/test_block_a_v_t_thin_center')
+    v_rewarded = traces.trace('v_C(miniblock_type, Treatment("noncompete"))[T.rewarded]')
+    v_compete = traces.trace('v_C(miniblock_type, Treatment("noncompete"))[T.compete]')
+    (v_rewarded > v_compete).mean()
+
+``TraceWriter`` fills a store as draws come in (``chains.py`` streams its
+draws through one), and ``convert`` turns the pickled HDDM chains in
+``models/`` into a store::
+
+    python traces.py -o models/test_block_a_v_t_thin_center models/test_block_a_v_t_thin_center_chain_*
+
+"""
+from __future__ import division
+import sys, getopt
+import os
+import os.path as op
+import json
+import hashlib
+import numpy as np
+
+dtype = np.float32
+
+
+def _fname(path, i):
+    return op.join(path, 'p%i.f32' % i)
+
+
+def read_meta(path):
+    with open(op.join(path, 'meta.json')) as f:
+        return json.load(f)
+
+
+def write_meta(path, meta):
+    #replace the file in one step so readers never see half of it
+    tmp = op.join(path, 'meta.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(meta, f, indent = 1)
+    os.replace(tmp, op.join(path, 'meta.json'))
+
+
+class TraceWriter(object):
+    """Writes draws of several chains into a trace store as they come in.
+
+    Space for ``capacity`` draws per chain is allocated up front, so the
+    parameter files keep their (chains, draws) layout while chains grow.
+    The store can be read at any time; ``close`` trims it to the draws
+    written.
+
+    """
+    def __init__(self, path, names, n_chains, capacity, meta=None):
+        """Create the store.
+
+        Parameters
+        ----------
+        path : string
+            Directory of the store; created if needed.
+        names : list of strings
+            Parameter names.
+        n_chains : int
+            Number of chains.
+        capacity : int
+            Maximum draws per chain.
+        meta : dict, optional
+            Model metadata kept in meta.json.
+
+        """
+        if not op.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.meta = dict(meta or {})
+        self.meta.update(names = list(names),
+                         n_chains = n_chains,
+                         n_draws = 0,
+                         capacity = capacity,
+                         dtype = np.dtype(dtype).name)
+        self.files = [np.memmap(_fname(path, i), dtype, 'w+', shape = (n_chains, capacity))
+                      for i in range(len(names))]
+        write_meta(path, self.meta)
+
+    def append(self, draws):
+        """Add draws (chains, draws, parameters) after those already written."""
+        n = self.meta['n_draws']
+        m = draws.shape[1]
+        if n + m > self.meta['capacity']:
+            raise ValueError('The store holds %i draws per chain' % self.meta['capacity'])
+        for i, mm in enumerate(self.files):
+            mm[:, n:n + m] = draws[:, :, i]
+            mm.flush()
+        self.meta['n_draws'] = n + m
+        write_meta(self.path, self.meta)
+
+    def close(self):
+        """Trim the parameter files to the draws written."""
+        n = self.meta['n_draws']
+        draws = [np.array(mm[:, :n]) for mm in self.files]
+        #release the maps before the files are rewritten
+        self.files = []
+        for i, trace in enumerate(draws):
+            trace.tofile(_fname(self.path, i))
+        self.meta['capacity'] = n
+        write_meta(self.path, self.meta)
+
+
+def write(path, draws, names, meta=None):
+    """Save draws (chains, draws, parameters) as a trace store."""
+    draws = np.asarray(draws)
+    writer = TraceWriter(path, names, draws.shape[0], draws.shape[1], meta)
+    writer.append(draws)
+    writer.close()
+
+
+class Traces(object):
+    """Memory-mapped reader of a trace store."""
+
+    def __init__(self, path):
+        self.path = path
+        self.meta = read_meta(path)
+        self.names = self.meta['names']
+        self._index = dict((name, i) for i, name in enumerate(self.names))
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, name):
+        """Draws of a parameter, a read-only (chains, draws) array."""
+        if name not in self._index:
+            raise KeyError('%s has no parameter %s' % (self.path, name))
+        if name not in self._maps:
+            shape = (self.meta['n_chains'], self.meta['capacity'])
+            self._maps[name] = np.memmap(_fname(self.path, self._index[name]), self.meta['dtype'],
+                                         'r', shape = shape)
+        return self._maps[name][:, :self.meta['n_draws']]
+
+    @property
+    def shape(self):
+        return self.meta['n_chains'], self.meta['n_draws'], len(self.names)
+
+    def trace(self, name):
+        """Draws of a parameter with the chains concatenated, like HDDM's
+        ``node.trace()`` of a ``concat_models`` model."""
+        return np.asarray(self[name]).ravel()
+
+    def to_array(self, names=None):
+        """Draws (chains, draws, parameters) of the given or all parameters."""
+        names = self.names if names is None else names
+        return np.stack([self[name] for name in names], -1)
+
+    def checksum(self):
+        """SHA-1 of meta.json and the draws, which identifies the fit."""
+        sha = hashlib.sha1()
+        with open(op.join(self.path, 'meta.json'), 'rb') as f:
+            sha.update(f.read())
+        for i in range(len(self.names)):
+            with open(_fname(self.path, i), 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+        return sha.hexdigest()
+
+    def to_frame(self, names=None):
+        """DataFrame of traces with one column per parameter and chain/draw index."""
+        import pandas as pd
+        names = self.names if names is None else names
+        n_chains, n_draws = self.shape[:2]
+        index = pd.MultiIndex.from_product([range(n_chains), range(n_draws)], names = ['chain', 'draw'])
+        return pd.DataFrame(dict((name, self.trace(name)) for name in names), index = index)
+
+
+####################
+#### Conversion ####
+####################
+
+def hddm_traces(model):
+    """Names and traces of the stochastic nodes of a sampled HDDM model."""
+    names, traces = [], []
+    db = model.nodes_db
+    for name, row in db.iterrows():
+        if row['observed']:
+            continue
+        try:
+            trace = row['node'].trace()
+        except (AttributeError, TypeError):
+            continue
+        if trace is None or np.ndim(trace) != 1:
+            continue
+        names.append(name)
+        traces.append(np.asarray(trace))
+    return names, traces
+
+
+def hddm_meta(model):
+    """Model metadata worth keeping from an HDDM model."""
+    meta = dict(source = type(model).__module__ + '.' + type(model).__name__)
+    descrs = getattr(model, 'model_descrs', None)
+    if descrs:
+        meta['models'] = [descr['model'] for descr in descrs]
+    meta['p_outlier'] = getattr(model, 'p_outlier', 0)
+    return meta
+
+
+def from_models(models, path, meta=None):
+    """Save the traces of sampled HDDM models, one per chain, as a store.
+
+    Chains are cut to the shortest, and only parameters every chain has
+    are kept. meta.json records the model formulas, p_outlier, the subject
+    column (HDDM's ``subj_idx``) if there are subject nodes, and each
+    chain's DIC when the models provide them.
+    """
+    chains = [dict(zip(*hddm_traces(model))) for model in models]
+    names = [name for name in chains[0] if all(name in chain for chain in chains)]
+    n_draws = min(len(chain[names[0]]) for chain in chains)
+    draws = np.stack([np.stack([chain[name][:n_draws] for name in names], -1) for chain in chains])
+
+    info = hddm_meta(models[0])
+    if any('_subj.' in name for name in names):
+        info['subject'] = 'subj_idx'
+    dic = []
+    for model in models:
+        try:
+            dic.append(float(model.dic))
+        except Exception:
+            dic = None
+            break
+    if dic:
+        info['dic'] = dic
+    info.update(meta or {})
+    write(path, draws, names, info)
+    return Traces(path)
+
+
+def convert(fnames, path):
+    """Convert pickled HDDM chains (``hddm.load`` files) to a trace store.
+
+    This is the only function here that needs hddm and its dependencies.
+    """
+    import hddm
+    models = [hddm.load(fname) for fname in sorted(fnames, key = _chain_number)]
+    return from_models(models, path, dict(converted_from = [op.basename(f) for f in fnames]))
+
+
+def _chain_number(fname):
+    try:
+        return int(fname.rsplit('_', 1)[-1])
+    except ValueError:
+        return fname
+
+
+def main(arglist):
+    help_str = 'traces.py -o <store_dir> <chain_pickle> [<chain_pickle> ...]'
+    try:
+        opts, args = getopt.getopt(arglist, "o:", ["outdir="])
+    except getopt.GetoptError:
+        print(help_str)
+        sys.exit(2)
+
+    path = None
+    for opt, arg in opts:
+        if opt in ("-o", "--outdir"):
+            path = arg
+    if path is None or not args:
+        print(help_str)
+        sys.exit(2)
+
+    traces = convert(args, path)
+    print('%i chains x %i draws of %i parameters written to %s' % (traces.shape + (path,)))
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,422 @@
+"""Vectorized Wiener first-passage time likelihood for the DDM regressions.
+
+The density of a response at time ``rt`` for a drift diffusion process with
+drift ``v``, boundary separation ``a``, non-decision time ``t`` and relative
+starting point ``w`` is evaluated for all trials at once in NumPy, together
+with its derivatives in v, a and t. RTs are coded as in HDDM (after
+``hddm.utils.flip_errors``): positive for the upper (correct) boundary and
+negative for the lower one.
+
+The normalized density is an infinite series. Following Navarro & Fuss
+(2009), each trial takes whichever of the small-time and large-time
+expansions needs fewer terms for the requested error, and each expansion
+is evaluated for its trials as one (trials x terms) array.
+
+``Regressor`` wraps the likelihood in the linear models used by the
+``HDDMRegressor`` fits::
+
+    model = Regressor(data, ['v ~ coherence + C(miniblock_type, Treatment("noncompete"))',
+                             'a ~ C(miniblock_type, Treatment("noncompete"))',
+                             't ~ C(miniblock_type, Treatment("noncompete"))'],
+                      p_outlier = .05)
+    theta = model.initial_values()
+    logp, grad = model.logp_grad(theta)
+
+``regression_models('vta')`` writes these formulas for a model variant.
+Coefficients are named as in HDDM's ``nodes_db`` (``v_Intercept``,
+``v_coherence``, ...). Trials with the same design rows share their v, a
+and t, so parameters and gradients are computed once per condition.
+
+Given a subject column, the model is hierarchical like an HDDMRegressor
+with its default ``group_only_regressors``: every subject has its own
+intercept (``v_Intercept_subj.3``, or ``a_subj.3`` when a isn't
+regressed), drawn around the group intercept with sd ``v_Intercept_std``
+(``a_std``), while the other coefficients are shared. The group intercept
+then only enters the likelihood through the subjects'.
+
+"""
+from __future__ import division
+import numpy as np
+
+#HDDM's defaults for the uniform outlier density and the series error
+w_outlier = .1
+err = 1e-4
+
+
+def n_terms(u, err=err):
+    """Terms the small- and large-time series need for error err.
+
+    Parameters
+    ----------
+    u : array
+        Normalized decision times, (rt - t) / a**2.
+    err : float
+        Bound on the truncation error of the normalized density.
+
+    Returns
+    -------
+    ks, kl : arrays
+        Number of terms of the small-time and large-time series.
+
+    """
+    u = np.asarray(u, float)
+
+    #large time
+    bound = np.pi * u * err
+    kl = 1 / (np.pi * np.sqrt(u))
+    ok = bound < 1
+    kl[ok] = np.maximum(kl[ok], np.sqrt(-2 * np.log(bound[ok]) / (np.pi ** 2 * u[ok])))
+
+    #small time
+    bound = 2 * np.sqrt(2 * np.pi * u) * err
+    ks = np.full(u.shape, 2.)
+    ok = bound < 1
+    ks[ok] = np.maximum(2 + np.sqrt(-2 * u[ok] * np.log(bound[ok])), np.sqrt(u[ok]) + 1)
+
+    return ks, kl
+
+
+def _small_time(u, w, nterms):
+    k = np.arange(-((nterms - 1) // 2), nterms // 2 + 1)
+    c = w[:, None] + 2 * k
+    #relative to the k = 0 term, which is the largest
+    d = (c ** 2 - w[:, None] ** 2) / 2
+    e = np.exp(-d / u[:, None])
+    s = (c * e).sum(1)
+    ds = (c * d * e).sum(1) / u ** 2
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        logf = np.log(s) - w ** 2 / (2 * u) - .5 * np.log(2 * np.pi) - 1.5 * np.log(u)
+        dlogf = w ** 2 / (2 * u ** 2) - 1.5 / u + ds / s
+    return logf, dlogf
+
+
+def _large_time(u, w, nterms):
+    k = np.arange(1, nterms + 1)
+    #relative to the k = 1 term
+    d = (k ** 2 - 1) * np.pi ** 2 / 2
+    e = np.exp(-d * u[:, None]) * k * np.sin(k * np.pi * w[:, None])
+    s = e.sum(1)
+    ds = -(d * e).sum(1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        logf = np.log(s) + np.log(np.pi) - np.pi ** 2 * u / 2
+        dlogf = ds / s - np.pi ** 2 / 2
+    return logf, dlogf
+
+
+def log_series(u, w, err=err, max_terms=100):
+    """Log of the normalized lower-boundary density and its u derivative.
+
+    Parameters
+    ----------
+    u : array
+        Normalized decision times, all positive.
+    w : array
+        Relative starting points, in (0, 1).
+    err : float
+        Bound on the truncation error.
+    max_terms : int
+        Cap on the terms of either series.
+
+    Returns
+    -------
+    logf, dlogf : arrays
+        log f(u | 0, 1, w) and d log f / du. Where truncation leaves a
+        non-positive sum, logf is -inf.
+
+    """
+    u, w = np.broadcast_arrays(np.asarray(u, float), np.asarray(w, float))
+    logf = np.empty(u.shape)
+    dlogf = np.empty(u.shape)
+
+    ks, kl = n_terms(u, err)
+    small = ks < kl
+    for series, idx, k in [(_small_time, small, ks), (_large_time, ~small, kl)]:
+        if not idx.any():
+            continue
+        nterms = int(min(np.ceil(k[idx].max()), max_terms))
+        logf[idx], dlogf[idx] = series(u[idx], w[idx], nterms)
+
+    bad = ~np.isfinite(logf)
+    logf[bad] = -np.inf
+    dlogf[bad] = 0
+    return logf, dlogf
+
+
+def _wfpt(x, v, a, t, w, p_outlier, w_outlier, err):
+    x, v, a, t, w = np.broadcast_arrays(*[np.asarray(arr, float) for arr in [x, v, a, t, w]])
+
+    #the upper boundary density is the lower one with v and w mirrored
+    upper = x > 0
+    sign = np.where(upper, -1., 1.)
+    v = v * sign
+    w = np.where(upper, 1 - w, w)
+    tau = np.abs(x) - t
+
+    logp = np.full(x.shape, -np.inf)
+    dv = np.zeros(x.shape)
+    da = np.zeros(x.shape)
+    dt = np.zeros(x.shape)
+
+    ok = (tau > 0) & (a > 0) & (t >= 0) & (w > 0) & (w < 1)
+    va, aa, wa, taua = v[ok], a[ok], w[ok], tau[ok]
+    u = taua / aa ** 2
+    logf, dlogf = log_series(u, wa, err)
+
+    logp[ok] = logf - 2 * np.log(aa) - va * aa * wa - va ** 2 * taua / 2
+    dv[ok] = (-aa * wa - va * taua) * sign[ok]
+    da[ok] = -2 / aa - va * wa - dlogf * 2 * u / aa
+    dt[ok] = va ** 2 / 2 - dlogf / aa ** 2
+
+    if p_outlier:
+        #mixture with a uniform density for contaminant responses
+        with np.errstate(divide = 'ignore'):
+            p = (1 - p_outlier) * np.exp(logp)
+            q = p + p_outlier * w_outlier
+            logp = np.log(q)
+        r = p / q
+        dv, da, dt = dv * r, da * r, dt * r
+
+    #parameters outside their range have no density even as outliers
+    invalid = (a <= 0) | (t < 0) | (w <= 0) | (w >= 1)
+    logp[invalid] = -np.inf
+    return logp, dv, da, dt
+
+
+def wfpt_logp(x, v, a, t, w=.5, p_outlier=0, w_outlier=w_outlier, err=err):
+    """Log density of signed RTs under the Wiener diffusion model.
+
+    Parameters
+    ----------
+    x : array
+        RTs in seconds, negative for lower-boundary (error) responses.
+    v, a, t, w : floats or arrays broadcastable to x
+        Drift rate, boundary separation, non-decision time and relative
+        starting point.
+    p_outlier : float
+        Probability that a response comes from the uniform outlier density
+        ``w_outlier`` instead of the diffusion process, as in HDDM.
+    err : float
+        Bound on the series truncation error.
+
+    Returns
+    -------
+    logp : array
+        Log density of every trial; -inf where the RT is shorter than t or
+        the parameters are out of range.
+
+    """
+    return _wfpt(x, v, a, t, w, p_outlier, w_outlier, err)[0]
+
+
+def wfpt_logp_grad(x, v, a, t, w=.5, p_outlier=0, w_outlier=w_outlier, err=err):
+    """Log density of signed RTs and its derivatives in v, a and t.
+
+    Takes the arguments of ``wfpt_logp`` and returns ``logp, dv, da, dt``,
+    arrays of the trials' log densities and their partial derivatives.
+    """
+    return _wfpt(x, v, a, t, w, p_outlier, w_outlier, err)
+
+
+def regression_models(spec, coherence='coherence_center', condition='miniblock_type',
+                      reference='noncompete'):
+    """HDDMRegressor formulas of a model variant.
+
+    Parameters
+    ----------
+    spec : string
+        Parameters that vary with the trial type, e.g. 'vta', 'av' or 't';
+        'coherence' for the baseline model in which none do. Drift always
+        depends on coherence.
+    coherence, condition : strings
+        Data columns of the coherence and the trial type.
+    reference : string
+        Trial type the other types are contrasted with.
+
+    Returns
+    -------
+    models : list of strings
+
+    """
+    if spec in ['coherence', 'coherence_only']:
+        spec = ''
+    unknown = set(spec) - set('vat')
+    if unknown:
+        raise ValueError('Unknown model variant %s' % spec)
+
+    contrast = 'C(%s, Treatment("%s"))' % (condition, reference)
+    models = ['v ~ ' + coherence + (' + ' + contrast if 'v' in spec else '')]
+    for param in ['a', 't']:
+        if param in spec:
+            models.append(param + ' ~ ' + contrast)
+    return models
+
+
+#columns that identify subjects, in the order they are looked for
+subject_columns = ['subj_idx', 'sub']
+
+
+def subject_column(data):
+    """The column of data identifying subjects, or None."""
+    for col in subject_columns:
+        if col in data:
+            return col
+    return None
+
+
+class Regressor(object):
+    """Linear models for v, a and t, with the likelihood of a dataset."""
+
+    params = ['v', 'a', 't']
+
+    def __init__(self, data, models, p_outlier=0, w=.5, err=err, subject=None):
+        """Build the design matrices for a dataset.
+
+        Parameters
+        ----------
+        data : DataFrame
+            Trials with the columns the models refer to and a signed ``rt``
+            column, which only the likelihood needs.
+        models : list of strings
+            Patsy formulas such as ``'v ~ coherence'``, one per regressed
+            parameter, as passed to ``HDDMRegressor``. Parameters without a
+            formula are constant.
+        p_outlier : float
+            Probability of outlier responses.
+        w : float
+            Relative starting point.
+        err : float
+            Bound on the series truncation error.
+        subject : string, optional
+            Column identifying subjects, for subject intercepts around the
+            group's (see ``subject_column``). Subjects are pooled if None.
+
+        """
+        import patsy
+
+        if isinstance(models, str):
+            models = [models]
+        formulas = dict((model.split('~')[0].strip(), model.split('~')[1]) for model in models)
+        unknown = set(formulas) - set(self.params)
+        if unknown:
+            raise ValueError('Only %s can be regressed, not %s'
+                             % (', '.join(self.params), ', '.join(sorted(unknown))))
+
+        self.x = np.asarray(data['rt'], float) if 'rt' in data else np.full(len(data), np.nan)
+        self.p_outlier = p_outlier
+        self.w = w
+        self.err = err
+        self.models = models
+        self.subject = subject
+
+        #design matrix and coefficient names of each parameter
+        designs = []
+        self.names = []
+        self.slices = {}
+        for param in self.params:
+            if param in formulas:
+                X = patsy.dmatrix(formulas[param], data, return_type = 'dataframe')
+                names = [param + '_' + col for col in X.columns]
+                X = X.values
+            else:
+                X = np.ones((len(self.x), 1))
+                names = [param]
+            self.slices[param] = slice(len(self.names), len(self.names) + len(names))
+            self.names += names
+            designs.append(X)
+
+        #sd and subject intercepts of every parameter after the coefficients
+        self.std = {}
+        self.subj_slices = {}
+        if subject is None:
+            self.subjects = []
+            trial_subject = np.zeros((len(self.x), 1))
+        else:
+            self.subjects, trial_subject = np.unique(np.asarray(data[subject]), return_inverse = True)
+            trial_subject = trial_subject.reshape(-1, 1)
+            for param, X in zip(self.params, designs):
+                intercept = self.names[self.slices[param].start]
+                if not np.all(X[:, 0] == 1):
+                    raise ValueError('%s needs an intercept for subject intercepts' % param)
+                self.std[param] = len(self.names)
+                self.subj_slices[param] = slice(len(self.names) + 1,
+                                                len(self.names) + 1 + len(self.subjects))
+                self.names += [intercept + '_std'] + [intercept + '_subj.%s' % label
+                                                      for label in self.subjects]
+        self.n_subjects = len(self.subjects)
+
+        #parameters are computed once per distinct row of the designs and subject
+        rows, self.condition = np.unique(np.hstack(designs + [trial_subject]), axis = 0,
+                                         return_inverse = True)
+        self.condition = self.condition.ravel()
+        self.n_conditions = len(rows)
+        self.condition_subject = rows[:, -1].astype(int)
+        self.designs = {}
+        for param in self.params:
+            self.designs[param] = rows[:, self.slices[param]]
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def hierarchical(self):
+        return self.subject is not None
+
+    def initial_values(self):
+        """Coefficients with v, a and t intercepts at typical values.
+
+        Subjects start at the group intercepts with sd .1.
+        """
+        theta = np.zeros(len(self.names))
+        for param, val in zip(self.params, [1., 1.5, .3]):
+            theta[self.slices[param].start] = val
+            if self.hierarchical:
+                theta[self.std[param]] = .1
+                theta[self.subj_slices[param]] = val
+        return theta
+
+    def condition_params(self, theta):
+        """v, a and t of every condition.
+
+        theta is one coefficient vector or an array (draws, coefficients),
+        giving arrays (n_conditions,) or (draws, n_conditions).
+        """
+        theta = np.asarray(theta, float)
+        values = []
+        for param in self.params:
+            sl = self.slices[param]
+            val = theta[..., sl].dot(self.designs[param].T)
+            if self.hierarchical:
+                #each subject's intercept replaces the group's
+                subj = theta[..., self.subj_slices[param]][..., self.condition_subject]
+                val = val + subj - theta[..., sl.start, None]
+            values.append(val)
+        return values
+
+    def trial_params(self, theta):
+        """v, a and t of every trial, (n_trials,) or (draws, n_trials)."""
+        return [val[..., self.condition] for val in self.condition_params(theta)]
+
+    def pointwise(self, theta):
+        """Log likelihood of every trial, for one or several draws of theta."""
+        v, a, t = self.trial_params(theta)
+        return wfpt_logp(self.x, v, a, t, self.w, self.p_outlier, err = self.err)
+
+    def logp(self, theta):
+        """Log likelihood of the dataset."""
+        return self.pointwise(theta).sum()
+
+    def logp_grad(self, theta):
+        """Log likelihood of the dataset and its gradient in the coefficients."""
+        v, a, t = self.trial_params(theta)
+        logp, dv, da, dt = wfpt_logp_grad(self.x, v, a, t, self.w, self.p_outlier, err = self.err)
+
+        grad = np.zeros(len(self.names))
+        for param, d in zip(self.params, [dv, da, dt]):
+            #sum the trial derivatives within conditions, then map to coefficients
+            d_cond = np.bincount(self.condition, weights = d, minlength = self.n_conditions)
+            grad[self.slices[param]] = self.designs[param].T.dot(d_cond)
+            if self.hierarchical:
+                grad[self.slices[param].start] = 0
+                grad[self.subj_slices[param]] = np.bincount(self.condition_subject, d_cond,
+                                                            self.n_subjects)
+        return logp.sum(), grad
@@ -0,0 +1,105 @@
+"""Micro-benchmarks for the frame-critical parts of the task code.
+
+Run from the task_code directory, e.g.::
+
+    python benchmarks.py update
+
+"""
+from __future__ import division
+import sys
+import os.path as op
+import subprocess
+import time
+
+
+def bench_update(dot_counts=(100, 1000, 10000, 100000), duration=1.,
+                 aperture=6, speed=5, interval=3, framerate=60):
+    """Time the per-frame dot position update for several dot counts.
+
+    Reports how many updates per second ``MotionKernel.step`` sustains,
+    which is the ceiling on the refresh rate the dot stimulus can keep up
+    with before drawing is taken into account.
+
+    """
+    import dots
+    norm = speed * interval / framerate
+    results = []
+    for n_dots in dot_counts:
+        kernel = dots.MotionKernel(n_dots, [aperture] * 2, norm, interval,
+                                   rng=0)
+
+        #warm up
+        for _ in range(interval):
+            kernel.step(270, .5)
+
+        n_frames = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            kernel.step(270, .5)
+            n_frames += 1
+        elapsed = time.perf_counter() - start
+
+        fps = n_frames / elapsed
+        results.append((n_dots, fps))
+        print('%7i dots: %10.1f updates/s (%.3f ms per frame)'
+              % (n_dots, fps, 1000 / fps))
+
+    return results
+
+
+#display and plotting packages that loading parameters should never pull in
+heavy_modules = ['psychopy', 'colormath', 'seaborn', 'pandas', 'matplotlib']
+
+import_script = """
+import sys, time
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(elapsed, ' '.join(m for m in %r if m in sys.modules))
+"""
+
+
+def bench_import(modules=('datastruct', 'params', 'trial_log', 'coherence_floors'),
+                 repeats=5, budget=.25):
+    """Time importing modules in a fresh interpreter.
+
+    Each import runs in a new process so nothing is cached in
+    ``sys.modules``; the fastest of ``repeats`` runs is reported against the
+    budget (in s), along with any of ``heavy_modules`` the import loaded.
+
+    """
+    here = op.dirname(op.abspath(__file__))
+    results = []
+    for module in modules:
+        times = []
+        for _ in range(repeats):
+            out = subprocess.check_output([sys.executable, '-c',
+                                           import_script % (module, heavy_modules)],
+                                          cwd=here, universal_newlines=True)
+            elapsed, loaded = (out.strip().split(' ', 1) + [''])[:2]
+            times.append(float(elapsed))
+
+        best = min(times)
+        results.append((module, best, loaded.split()))
+        print('%16s: %7.1f ms %s%s'
+              % (module, 1000 * best,
+                 'ok' if best <= budget else 'OVER BUDGET',
+                 ' (loads %s)' % ', '.join(loaded.split()) if loaded else ''))
+
+    return results
+
+
+benchmarks = dict(update=bench_update,
+                  imports=bench_import)
+
+
+def main(arglist):
+
+    names = arglist if arglist else sorted(benchmarks)
+    for name in names:
+        print(name)
+        benchmarks[name]()
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,45 @@
+"""Per-subject coherence floors from the training sessions.
+
+Kept apart from ``trial_functions`` so the scanner and switch tasks can set
+subject parameters without loading psychopy.
+
+"""
+import glob
+import os.path as op
+import pickle
+import numpy as np
+from trial_log import read_trial_log
+
+
+def set_subject_specific_params(p):
+    
+    p.coherence_floor = {}
+    for rule in ['color','shape','motion']:
+        
+        #should be 7 blocks, but check for less just in case
+        #older sessions were saved as pickled Params
+        files = glob.glob(op.join(op.abspath('./data'), p.sub + '_training_' + rule + '_*.arrow'))
+        if not files:
+            files = glob.glob(op.join(op.abspath('./data'), p.sub + '_training_' + rule + '_*.pkl'))
+        file_idx = [int(x.split('_')[-2]) for x in files]
+        f = files[file_idx.index(max(file_idx))]
+        print(f)
+        
+        if f.endswith('.arrow'):
+            trials, meta = read_trial_log(f)
+            coherence_record = trials['next_coherence']
+            #bayesian staircases estimate the coherence directly
+            if meta.get('staircase') in ['quest', 'psi']:
+                coherence_record = trials['coherence_estimate'].iloc[-1:]
+        else:
+            with open(f, 'rb') as f:
+                coherence_record = pickle.load(f).coherence_record[rule]
+            
+        mean_coherence = np.mean(coherence_record)
+        
+        if rule == 'motion':
+            p.coherence_floor[rule] = np.round(max(mean_coherence, .02),2)
+        else:
+            p.coherence_floor[rule] = np.round(max(mean_coherence, .52),2) 
+    
+    print(p.coherence_floor)
@@ -0,0 +1,142 @@
+"""Vectorized CIE LCh(ab) to sRGB conversion.
+
+Reproduces colormath's ``convert_color(LCHabColor(l, c, h), sRGBColor)``
+for the default 2 degree observer: LCh is converted to Lab and XYZ under
+D50, adapted to the D65 white of sRGB with the Bradford transform, and
+companded. Whole arrays are converted at once, individual colors are cached
+by (lightness, chroma, hue), and ``palette`` builds lookup tables of
+isoluminant hues.
+
+RGB values are on colormath's 0-1 scale. As in colormath, negative channels
+are clamped to 0 but values above 1 are kept; ``in_gamut`` tells whether a
+color can be shown without clipping.
+
+"""
+from __future__ import division
+import numpy as np
+
+#reference whites (2 degree observer)
+d50 = np.array([0.96422, 1.00000, 0.82521])
+d65 = np.array([0.95047, 1.00000, 1.08883])
+
+#XYZ (D65) to linear sRGB
+xyz65_to_linear_rgb = np.array([[3.24071, -1.53726, -0.498571],
+                                [-0.969258, 1.87599, 0.0415557],
+                                [0.0556352, -0.203996, 1.05707]])
+
+bradford = np.array([[0.8951, 0.2664, -0.1614],
+                     [-0.7502, 1.7135, 0.0367],
+                     [0.0389, -0.0685, 1.0296]])
+
+cie_e = 216 / 24389
+
+
+def adaptation_matrix(src_white, dst_white, cone_matrix=bradford):
+    """Von Kries style chromatic adaptation between two reference whites."""
+    src_cone = cone_matrix.dot(src_white)
+    dst_cone = cone_matrix.dot(dst_white)
+    return np.linalg.inv(cone_matrix).dot(np.diag(dst_cone / src_cone)).dot(cone_matrix)
+
+
+#LCh colors are D50; do the adaptation and the RGB matrix in one step
+xyz50_to_linear_rgb = xyz65_to_linear_rgb.dot(adaptation_matrix(d50, d65))
+
+
+def lch_to_lab(lightness, chroma, hue):
+    """Lab array of shape (..., 3) from broadcastable L, C and h (degrees)."""
+    lightness, chroma, hue = np.broadcast_arrays(*[np.asarray(x, float)
+                                                   for x in [lightness, chroma, hue]])
+    hue = np.radians(hue)
+    return np.stack([lightness, chroma * np.cos(hue), chroma * np.sin(hue)], -1)
+
+
+def lab_to_xyz(lab, white=d50):
+    """XYZ array of shape (..., 3) from Lab relative to a reference white."""
+    fy = (lab[..., 0] + 16) / 116
+    f = np.stack([lab[..., 1] / 500 + fy, fy, fy - lab[..., 2] / 200], -1)
+    xyz = np.where(f ** 3 > cie_e, f ** 3, (f - 16 / 116) / 7.787)
+    return xyz * white
+
+
+def xyz_to_linear_rgb(xyz, matrix=xyz50_to_linear_rgb):
+    """Linear sRGB from XYZ, before clamping or companding."""
+    return np.einsum('ij,...j->...i', matrix, xyz)
+
+
+def compand(linear):
+    """sRGB transfer curve; negative values are clamped to 0 as in colormath."""
+    linear = np.maximum(linear, 0)
+    curve = 1.055 * np.power(linear, 1 / 2.4) - 0.055
+    return np.where(linear <= 0.0031308, linear * 12.92, curve)
+
+
+def convert(lightness, chroma, hue):
+    """sRGB array of shape (..., 3) for broadcastable L, C and h, uncached."""
+    return compand(xyz_to_linear_rgb(lab_to_xyz(lch_to_lab(lightness, chroma, hue))))
+
+
+####################
+#### Cache #########
+####################
+
+_cache = {}
+
+
+def lch_to_rgb(lightness, chroma, hue):
+    """sRGB (0-1) for broadcastable L, C and h, caching each color.
+
+    Colors not converted before are converted together in one vectorized
+    call, so the first call for a palette costs about as much as one
+    color and later calls are dictionary lookups.
+    """
+    lightness, chroma, hue = np.broadcast_arrays(*[np.asarray(x, float)
+                                                   for x in [lightness, chroma, hue]])
+    keys = list(zip(lightness.ravel().tolist(), chroma.ravel().tolist(), hue.ravel().tolist()))
+
+    missing = [key for key in set(keys) if key not in _cache]
+    if missing:
+        rgbs = convert(*np.array(missing).T)
+        _cache.update(zip(missing, rgbs))
+
+    rgb = np.array([_cache[key] for key in keys]).reshape(lightness.shape + (3,))
+    return rgb
+
+
+def in_gamut(lightness, chroma, hue, tol=1e-6):
+    """Whether each LCh color can be shown without clipping in sRGB."""
+    linear = xyz_to_linear_rgb(lab_to_xyz(lch_to_lab(lightness, chroma, hue)))
+    return np.all((linear >= -tol) & (linear <= 1 + tol), -1)
+
+
+_palettes = {}
+
+
+def palette(lightness, chroma, n_hues=360):
+    """Lookup table of isoluminant colors around the hue circle.
+
+    Parameters
+    ----------
+    lightness, chroma : float
+        L* and C* shared by every entry.
+    n_hues : int
+        Number of evenly spaced hues, starting at 0 degrees.
+
+    Returns
+    -------
+    table : record array
+        Fields ``hue``, ``rgb`` (0-1) and ``in_gamut``, one row per hue.
+        Tables are cached, so treat them as read-only.
+
+    """
+    key = (float(lightness), float(chroma), int(n_hues))
+    if key not in _palettes:
+        hues = np.arange(n_hues) * 360 / n_hues
+        table = np.recarray(n_hues, dtype = [('hue', float),
+                                             ('rgb', float, 3),
+                                             ('in_gamut', bool)])
+        table.hue = hues
+        table.rgb = convert(lightness, chroma, hues)
+        table.in_gamut = in_gamut(lightness, chroma, hues)
+        table.flags.writeable = False
+        _palettes[key] = table
+    return _palettes[key]
@@ -3,16 +3,15 @@ import time
 import numpy as np
 import pickle
 import os.path as op
-import pandas as pd
 import os
 import glob
-from psychopy.monitors import Monitor
 import warnings
-from colormath.color_objects import LCHabColor, sRGBColor
-from colormath.color_conversions import convert_color
-from psychopy import core, visual, event, logging
 from numpy.random import RandomState
-pd.options.mode.chained_assignment = None  # suppress chained assignment warning
+import colors
+
+#psychopy and pandas are imported by the methods that need them,
+#so loading parameters or unpickling saved sessions stays fast and works
+#on machines without a display stack
 
 class Params(object):
     
@@ -84,6 +83,23 @@ class Params(object):
         self.cue_map = {3:'Triangle', 4:'Diamond', 5: 'Pentagon'}
          
     
+    def init_random_streams(self):
+        """Seed independent random streams for stimuli, trial design and reward.
+
+        The seed is derived from the subject, mode and run (or taken from
+        self.seed when set), and kept in self.random_seed with the saved data,
+        so any session can be regenerated offline.
+        """
+        if getattr(self, 'seed', None) is not None:
+            self.random_seed = self.seed
+        else:
+            run = int(getattr(self, 'run', 0))
+            self.random_seed = [ord(c) for c in self.sub + '_' + self.mode] + [run]
+
+        seed_seq = np.random.SeedSequence(self.random_seed)
+        self.seed_seqs = dict(zip(['stim', 'design', 'reward'], seed_seq.spawn(3)))
+        self.rng = {name: np.random.default_rng(seq) for name, seq in self.seed_seqs.items()}
+
     def randomize_rewarded_rule(self):
         rs = RandomState(self.hash_sub_id) #set random state
         rules = ['motion','color','shape']
@@ -91,17 +107,8 @@ class Params(object):
     
     def lch_to_rgb(self, p):
         """Convert the color values from Lch to RGB."""
-        rgbs = []
-        for lightness, hue in zip(p.lightnesses, p.hues):
-            lch = LCHabColor(lightness, p.chroma, hue)
-            rgb = convert_color(lch, sRGBColor).get_value_tuple()
-            rgbs.append(rgb)
-        
-        rgbs = np.array(rgbs)
-        rgbs = rgbs*2-1
-        rgbs = [tuple(x) for x in rgbs]
-        
-        return np.array(rgbs)
+        rgbs = colors.lch_to_rgb(p.lightnesses, p.chroma, p.hues)
+        return rgbs*2-1
              
     def set_subject_specific_params(self):
         
@@ -111,6 +118,8 @@ class Params(object):
         self.coherence_floor = coh[self.sub]
     
     def run_info(self):
+        import pandas as pd
+        pd.options.mode.chained_assignment = None  # suppress chained assignment warning
 
         #load run timings
         run_fname = op.join(op.abspath('timing'),'models','run' + str(int(self.run) - 1) + '.csv')
@@ -152,6 +161,9 @@ class Params(object):
             
     def launch_window(self, test_refresh=True, test_tol=.5):
         """Load window info"""
+        from psychopy.monitors import Monitor
+        from psychopy import visual, logging
+
         #taken from Mwaskom cregg
         try:
             mod = __import__("monitors")
@@ -216,5 +228,10 @@ class Params(object):
         else:
             win.framerate = stated_refresh_hz
 
+        #collect key presses on a background thread from here on
+        if self.keyboard_thread:
+            import keypoll
+            keypoll.start()
+
         return win
    
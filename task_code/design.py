@@ -0,0 +1,364 @@
+"""Trial sequences for the rule-switching blocks.
+
+A design is a NumPy record array with one row per trial (see
+``trial_dtype``). Sequences are built directly rather than reshuffled until
+they happen to satisfy the constraints:
+
+* the miniblock order is a random permutation per repetition, and when the
+  first miniblock of a repetition would repeat the one before it, it is
+  swapped with a random later position;
+* within a miniblock the two rules are shuffled, and when the first trial
+  isn't the rule that was absent from the previous miniblock, it is
+  swapped with a random trial that has that rule.
+
+Both fixes leave every valid sequence equally likely, so the designs have
+the same distribution as the old rejection loops. ``make_designs`` builds
+a whole batch at once for design searches::
+
+    designs = make_designs(5000, rng = 0, **design_settings(p))
+    designs = designs[validate_design(designs, p.miniblock_ids)]
+
+"""
+from __future__ import division
+import json
+import os.path as op
+import numpy as np
+
+rules = ['color', 'shape', 'motion']
+
+#feature values of each dimension; the first is answered with '1'
+features = dict(color = ['green', 'pink'],
+                shape = ['circle', 'cross'],
+                motion = ['up', 'down'])
+
+trial_dtype = np.dtype([('miniblock_num', np.int16),
+                        ('miniblock', 'U16'),
+                        ('rule', 'U6'),
+                        ('correct_resp', 'U1'),
+                        ('color', 'U6'),
+                        ('shape', 'U6'),
+                        ('motion', 'U6'),
+                        ('color_resp', 'U1'),
+                        ('shape_resp', 'U1'),
+                        ('motion_resp', 'U1'),
+                        ('color_coherence', np.float64),
+                        ('shape_coherence', np.float64),
+                        ('motion_coherence', np.float64)])
+
+
+def design_settings(p):
+    """Keyword arguments for ``make_designs`` from a Params object."""
+    return dict(miniblock_ids = p.miniblock_ids,
+                n_reps = p.num_block_reps,
+                ntrials_per_miniblock = p.ntrials_per_miniblock,
+                coherence_floor = p.coherence_floor,
+                coherence_range = p.coherence_range,
+                n_coherence_levels = p.n_coherence_levels)
+
+
+def _swap_first(rows, new_first):
+    """Swap the first column of each row with column new_first, in place."""
+    idx = np.arange(len(rows))
+    first = rows[:, 0].copy()
+    rows[:, 0] = rows[idx, new_first]
+    rows[idx, new_first] = first
+
+
+def miniblock_order(n_designs, n_miniblocks, n_reps, rng):
+    """Miniblock indices (n_designs, n_reps * n_miniblocks) without repeats."""
+    order = rng.permuted(np.tile(np.arange(n_miniblocks), (n_designs * n_reps, 1)), axis = 1)
+    order = order.reshape(n_designs, n_reps, n_miniblocks)
+
+    for rep in range(1, n_reps):
+        bad = order[:, rep, 0] == order[:, rep - 1, -1]
+        rows = order[bad, rep]
+        _swap_first(rows, rng.integers(1, n_miniblocks, len(rows)))
+        order[bad, rep] = rows
+
+    return order.reshape(n_designs, -1)
+
+
+def rule_order(order, pairs, ntrials_per_miniblock, rng, unique_first=True):
+    """Active rule indices (n_designs, n_miniblocks, ntrials_per_miniblock).
+
+    Parameters
+    ----------
+    order : int array (n_designs, n_miniblocks)
+        Miniblock index of each miniblock.
+    pairs : int array (n_miniblock_ids, 2)
+        Rule indices of each miniblock id.
+    unique_first : bool
+        Start each miniblock after the first with the rule that wasn't in
+        the previous one.
+
+    """
+    half = ntrials_per_miniblock // 2
+    rule_idx = np.repeat(pairs[order], half, axis = -1)
+    rule_idx = rng.permuted(rule_idx, axis = -1)
+
+    if unique_first:
+        current = pairs[order[:, 1:]]
+        previous = pairs[order[:, :-1]]
+        in_previous = (current[..., :, None] == previous[..., None, :]).any(-1)
+        unique = np.where(in_previous[..., 0], current[..., 1], current[..., 0])
+
+        trials = rule_idx[:, 1:]
+        bad = trials[..., 0] != unique
+        rows = trials[bad]
+        #pick a random trial holding the unique rule
+        keys = np.where(rows == unique[bad][:, None], rng.random(rows.shape), -1)
+        _swap_first(rows, keys.argmax(1))
+        trials[bad] = rows
+        rule_idx[:, 1:] = trials
+
+    return rule_idx
+
+
+def coherence_sequence(active, n_levels, rng, balance_active=True):
+    """Coherence level indices (n_designs, n_miniblocks, ntrials_per_miniblock).
+
+    ``active`` marks the trials where the dimension is the active rule.
+    Within each miniblock the levels are used equally often; with
+    ``balance_active`` this holds separately for the active trials and the
+    rest.
+    """
+    n_trials = active.shape[-1]
+    if balance_active:
+        values = np.resize(np.arange(n_levels), n_trials // 2)
+        values = np.concatenate([values, values])
+    else:
+        values = np.resize(np.arange(n_levels), n_trials)
+
+    #active trials first, each half in random order
+    keys = rng.random(active.shape)
+    if balance_active:
+        keys = keys + ~active
+    positions = keys.argsort(-1)
+
+    level = np.empty(active.shape, int)
+    np.put_along_axis(level, positions, np.broadcast_to(values, active.shape), -1)
+    return level
+
+
+def make_codes(n_designs, miniblock_ids, n_reps, ntrials_per_miniblock,
+               n_coherence_levels, unique_first=True, balance_active=True,
+               rng=None, **kwargs):
+    """Integer form of a batch of designs, for fast scoring.
+
+    Returns a dict with the miniblock index of each miniblock (``order``,
+    n_designs x n_miniblocks) and, per trial (n_designs x n_trials), the
+    index into ``rules`` of the active rule (``rule``), and for each rule
+    the feature value (0 or 1) and coherence level index (``value`` and
+    ``level``, dicts by rule). See ``make_designs`` for the arguments;
+    coherence values aren't needed here and extra keywords are ignored.
+    """
+    rng = np.random.default_rng(rng)
+    n_miniblocks = len(miniblock_ids)
+    pairs = np.array([[rules.index(rule) for rule in block.split('_')]
+                      for block in miniblock_ids])
+
+    order = miniblock_order(n_designs, n_miniblocks, n_reps, rng)
+    rule_idx = rule_order(order, pairs, ntrials_per_miniblock, rng, unique_first)
+    n_trials = rule_idx.shape[1] * ntrials_per_miniblock
+
+    codes = dict(order = order,
+                 rule = rule_idx.reshape(n_designs, n_trials),
+                 value = {},
+                 level = {})
+    for rule_num, rule in enumerate(rules):
+
+        #each feature value equally often over the session
+        codes['value'][rule] = rng.permuted(np.tile([0, 1], (n_designs, n_trials // 2)), axis = 1)
+        level = coherence_sequence(rule_idx == rule_num, n_coherence_levels, rng, balance_active)
+        codes['level'][rule] = level.reshape(n_designs, n_trials)
+
+    return codes
+
+
+def to_records(codes, miniblock_ids, coherence_floor, coherence_range,
+               n_coherence_levels, **kwargs):
+    """Record arrays (n_designs, n_trials) from ``make_codes`` output."""
+    order, rule_idx = codes['order'], codes['rule']
+    n_designs, n_trials = rule_idx.shape
+    ntrials_per_miniblock = n_trials // order.shape[1]
+
+    designs = np.recarray((n_designs, n_trials), trial_dtype)
+    designs.miniblock_num = np.repeat(np.arange(order.shape[1]), ntrials_per_miniblock)
+    designs.miniblock = np.repeat(np.array(miniblock_ids)[order], ntrials_per_miniblock, axis = 1)
+    designs.rule = np.array(rules)[rule_idx]
+
+    correct_resp = np.empty((n_designs, n_trials), 'U1')
+    for rule_num, rule in enumerate(rules):
+        value = codes['value'][rule]
+        designs[rule] = np.array(features[rule])[value]
+        designs[rule + '_resp'] = np.array(['1', '2'])[value]
+        active = rule_idx == rule_num
+        correct_resp[active] = designs[rule + '_resp'][active]
+
+        levels = np.linspace(coherence_floor[rule],
+                             coherence_floor[rule] + coherence_range[rule],
+                             n_coherence_levels)
+        designs[rule + '_coherence'] = levels[codes['level'][rule]]
+
+    designs.correct_resp = correct_resp
+    return designs
+
+
+def select_codes(codes, idx):
+    """Subset of the designs in ``make_codes`` output."""
+    return dict(order = codes['order'][idx],
+                rule = codes['rule'][idx],
+                value = {rule: val[idx] for rule, val in codes['value'].items()},
+                level = {rule: val[idx] for rule, val in codes['level'].items()})
+
+
+def make_designs(n_designs, miniblock_ids, n_reps, ntrials_per_miniblock,
+                 coherence_floor, coherence_range, n_coherence_levels,
+                 unique_first=True, balance_active=True, rng=None):
+    """Build a batch of session designs.
+
+    Parameters
+    ----------
+    n_designs : int
+        Number of designs.
+    miniblock_ids : list of strings
+        Miniblocks as pairs of rules, e.g. 'color_shape'.
+    n_reps : int
+        Repetitions of the full set of miniblocks.
+    ntrials_per_miniblock : int
+        Trials in each miniblock; each of its rules is active on half.
+    coherence_floor, coherence_range : dicts of floats
+        Lowest coherence and span of the coherence levels of each rule.
+    n_coherence_levels : int
+        Number of evenly spaced coherence levels.
+    unique_first : bool
+        Start each miniblock with the rule that is new relative to the
+        previous miniblock.
+    balance_active : bool
+        Balance coherence levels separately over the trials where a rule is
+        active and where it isn't (otherwise over the whole miniblock).
+    rng : numpy Generator, int or None
+        Source of randomness, or a seed for one.
+
+    Returns
+    -------
+    designs : record array (n_designs, n_trials)
+        One row of ``trial_dtype`` records per design.
+
+    """
+    codes = make_codes(n_designs, miniblock_ids, n_reps, ntrials_per_miniblock,
+                       n_coherence_levels, unique_first, balance_active, rng)
+    return to_records(codes, miniblock_ids, coherence_floor, coherence_range,
+                      n_coherence_levels)
+
+
+def make_design(p, rng=None, **kwargs):
+    """One design for the settings in p; keywords override them."""
+    if rng is None:
+        rng = p.rng['design']
+    settings = design_settings(p)
+    settings.update(kwargs)
+    return make_designs(1, rng = rng, **settings)[0]
+
+
+def validate_design(designs, miniblock_ids, unique_first=True):
+    """Check designs against the sequence constraints.
+
+    Returns a boolean per design (or a single bool for one design) that is
+    True when no miniblock follows itself, every trial's rule belongs to
+    its miniblock with both rules active equally often, miniblocks start
+    with their new rule (when ``unique_first``), the correct response is
+    the active rule's, and each feature value appears equally often.
+    """
+    designs = np.atleast_2d(designs)
+    n_designs, n_trials = designs.shape
+    mini = designs.miniblock_num[0]
+    starts = np.flatnonzero(np.diff(mini, prepend = -1))
+
+    names = designs.miniblock[:, starts]
+    ok = np.all(names[:, 1:] != names[:, :-1], 1)
+    ok &= np.all(np.isin(names, miniblock_ids), 1)
+
+    pairs = np.char.partition(designs.miniblock, '_')
+    first, second = pairs[..., 0], pairs[..., 2]
+    ok &= np.all((designs.rule == first) | (designs.rule == second), 1)
+    n_first = np.add.reduceat((designs.rule == first).astype(int), starts, axis = 1)
+    ok &= np.all(2 * n_first == np.diff(np.append(starts, n_trials)), 1)
+
+    if unique_first and len(starts) > 1:
+        first_rule = designs.rule[:, starts[1:]]
+        prev = designs.miniblock[:, starts[:-1]]
+        ok &= np.all(np.char.find(prev, first_rule) < 0, 1)
+
+    correct_resp = np.empty(designs.shape, 'U1')
+    for rule in rules:
+        active = designs.rule == rule
+        correct_resp[active] = designs[rule + '_resp'][active]
+        ok &= 2 * np.sum(designs[rule] == features[rule][0], 1) == n_trials
+    ok &= np.all(designs.correct_resp == correct_resp, 1)
+
+    return ok if n_designs > 1 else bool(ok[0])
+
+
+def apply_design(p, design):
+    """Set the trial lists the task modules read from p from one design."""
+    starts = np.flatnonzero(np.diff(design.miniblock_num, prepend = -1))
+    p.miniblocks = design.miniblock[starts].tolist()
+    p.ntrials = len(design)
+    p.miniblock = design.miniblock.tolist()
+    p.active_rule = design.rule.tolist()
+    p.correct_resp = design.correct_resp.tolist()
+
+    p.dimension_val = {}
+    p.dimension_correct_resp = {}
+    p.coherences = {}
+    for rule in ['color', 'motion', 'shape']:
+        p.dimension_val[rule] = tuple(design[rule].tolist())
+        p.dimension_correct_resp[rule] = tuple(design[rule + '_resp'].tolist())
+        p.coherences[rule] = design[rule + '_coherence'].tolist()
+
+
+def save_designs(fname, designs, settings, rewarded_rule=None, scores=None):
+    """Save designs, one per block, with the settings they were made for."""
+    if scores is None:
+        scores = np.zeros(len(designs))
+    np.savez(fname,
+             designs = np.asarray(designs),
+             settings = json.dumps(settings),
+             rewarded_rule = rewarded_rule or '',
+             scores = scores)
+    return fname
+
+
+def load_design(p):
+    """Next saved design for the subject and mode in p.design_dir.
+
+    Designs are used in order, counting blocks in p.design_num. Coherences
+    are moved onto the subject's current coherence levels, so designs can
+    be made before the coherence floors are known.
+    """
+    fname = op.join(p.design_dir, '%s_%s.npz' % (p.sub, p.mode))
+    with np.load(fname) as f:
+        designs = f['designs']
+        settings = json.loads(str(f['settings']))
+        rewarded_rule = str(f['rewarded_rule'])
+
+    if rewarded_rule and rewarded_rule != getattr(p, 'rewarded_rule', None):
+        raise ValueError('%s was made for rewarded rule %s' % (fname, rewarded_rule))
+    num = getattr(p, 'design_num', 0)
+    if num >= len(designs):
+        raise ValueError('%s only has %i designs' % (fname, len(designs)))
+    p.design_num = num + 1
+
+    design = designs[num].view(np.recarray).copy()
+    n_levels = settings['n_coherence_levels']
+    for rule in rules:
+        floor = settings['coherence_floor'][rule]
+        old = np.linspace(floor, floor + settings['coherence_range'][rule], n_levels)
+        new = np.linspace(p.coherence_floor[rule],
+                          p.coherence_floor[rule] + p.coherence_range[rule],
+                          n_levels)
+        coherence = design[rule + '_coherence']
+        design[rule + '_coherence'] = new[np.abs(coherence[:, None] - old).argmin(1)]
+
+    return design
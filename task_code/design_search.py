@@ -0,0 +1,244 @@
+"""Search for well-balanced switch/coherence designs for a subject.
+
+Candidate sessions come from ``design.make_designs``. Each is scored on
+
+* cell balance: how evenly trials fall into the switch type by coherence
+  bin cells the switch analyses use (chi-square distance from equal counts
+  among the switch cells and among the stay cells), and
+* efficiency: the D-efficiency of the design matrix of the RT regression
+  (coherence, switch type and miniblock type), which grows as the
+  conditions become less confounded with each other.
+
+The best designs of many random batches, spread over a process pool, are
+kept and saved for the subject's blocks; setting ``design_dir`` in the
+params makes the switch and reward tasks run them in order::
+
+    python design_search.py -s sub01 -m reward -n 100000
+
+"""
+from __future__ import division
+import sys, getopt
+import os
+import os.path as op
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import datastruct
+import design
+
+switch_types = ['stay', 'switch_to', 'switch_away', 'switch_other']
+
+
+####################
+#### Trial cells ###
+####################
+
+#designs are scored in the integer form of design.make_codes; only the
+#designs that are kept are turned into record arrays
+
+def switch_codes(codes, rewarded_rule=None):
+    """Index into switch_types of every trial after the first.
+
+    Without a rewarded rule every switch counts as 'switch_other'.
+    """
+    prev, cur = codes['rule'][:, :-1], codes['rule'][:, 1:]
+    rew = -1 if rewarded_rule is None else design.rules.index(rewarded_rule)
+
+    switch = np.full(cur.shape, 3)
+    switch[prev == rew] = 2
+    switch[cur == rew] = 1
+    switch[cur == prev] = 0
+    return switch
+
+
+def coherence_bins(codes):
+    """Coherence level index of each trial's active rule."""
+    return np.choose(codes['rule'], [codes['level'][rule] for rule in design.rules])
+
+
+def cell_counts(codes, n_levels, rewarded_rule=None):
+    """Trials (n_designs, switch type, coherence bin), first trials excluded."""
+    n_designs = len(codes['rule'])
+    n_cells = len(switch_types) * n_levels
+    cells = switch_codes(codes, rewarded_rule) * n_levels + coherence_bins(codes)[:, 1:]
+    cells = cells + (np.arange(n_designs) * n_cells)[:, None]
+    counts = np.bincount(cells.ravel(), minlength = n_designs * n_cells)
+    return counts.reshape(n_designs, len(switch_types), n_levels)
+
+
+####################
+#### Scores ########
+####################
+
+def imbalance(counts, rewarded_rule=None):
+    """Chi-square distance from equal counts, within switch and stay cells."""
+    switch = counts[:, 1:] if rewarded_rule is not None else counts[:, 3:]
+    total = 0
+    for cells in [counts[:, :1], switch]:
+        cells = cells.reshape(len(counts), -1)
+        expected = cells.mean(1, keepdims = True)
+        total = total + ((cells - expected) ** 2 / np.maximum(expected, 1)).sum(1)
+    return total
+
+
+def design_matrix(codes, miniblock_ids, n_levels, rewarded_rule=None):
+    """Regressors (n_designs, n_trials - 1, k) of the RT model.
+
+    Intercept, centered coherence bin, switch type dummies (reference
+    switch_other) and miniblock type dummies (reference noncompete); the
+    reward-specific columns are dropped when there is no rewarded rule.
+    """
+    switch = switch_codes(codes, rewarded_rule)
+    columns = [np.ones(switch.shape),
+               coherence_bins(codes)[:, 1:] - (n_levels - 1) / 2,
+               switch == 0]
+    if rewarded_rule is not None:
+        rew = design.rules.index(rewarded_rule)
+        has_rew = np.array([rewarded_rule in block.split('_') for block in miniblock_ids])
+        n_per_miniblock = codes['rule'].shape[1] // codes['order'].shape[1]
+        in_miniblock = np.repeat(has_rew[codes['order']], n_per_miniblock, axis = 1)[:, 1:]
+        rewarded = codes['rule'][:, 1:] == rew
+        columns.extend([switch == 1, switch == 2, rewarded, in_miniblock & ~rewarded])
+    return np.stack(columns, -1).astype(float)
+
+
+def efficiency(codes, miniblock_ids, n_levels, rewarded_rule=None):
+    """D-efficiency, det(X'X / n) ** (1 / k), of each design."""
+    X = design_matrix(codes, miniblock_ids, n_levels, rewarded_rule)
+    n, k = X.shape[1:]
+    info = np.einsum('dtk,dtj->dkj', X, X) / n
+    sign, logdet = np.linalg.slogdet(info)
+    return np.where(sign > 0, np.exp(logdet / k), 0)
+
+
+def score_designs(codes, settings, rewarded_rule=None, balance_weight=.01):
+    """Efficiency minus weighted imbalance; higher is better."""
+    n_levels = settings['n_coherence_levels']
+    counts = cell_counts(codes, n_levels, rewarded_rule)
+    return (efficiency(codes, settings['miniblock_ids'], n_levels, rewarded_rule)
+            - balance_weight * imbalance(counts, rewarded_rule))
+
+
+####################
+#### Search ########
+####################
+
+def _search_batch(seed, n_candidates, n_keep, settings, rewarded_rule, balance_weight):
+    codes = design.make_codes(n_candidates, rng = seed, **settings)
+    scores = score_designs(codes, settings, rewarded_rule, balance_weight)
+    best = np.argsort(scores)[::-1][:n_keep]
+    codes = design.select_codes(codes, best)
+    counts = cell_counts(codes, settings['n_coherence_levels'], rewarded_rule)
+    return np.asarray(design.to_records(codes, **settings)), scores[best], counts
+
+
+def search(settings, rewarded_rule=None, n_candidates=100000, n_keep=1,
+           balance_weight=.01, batch_size=5000, n_jobs=None, seed=None):
+    """Best designs among random candidates, generated in parallel.
+
+    Parameters
+    ----------
+    settings : dict
+        Keyword arguments for ``design.make_designs``.
+    rewarded_rule : string or None
+        Rule that is rewarded, which defines the switch types.
+    n_candidates : int
+        Number of candidate designs to score.
+    n_keep : int
+        Number of designs to return.
+    balance_weight : float
+        Weight of the imbalance in the score.
+    batch_size : int
+        Candidates generated and scored at once by a worker.
+    n_jobs : int or None
+        Worker processes; defaults to the number of CPUs.
+    seed : int, sequence or None
+        Seed of the search; each batch gets an independent child stream.
+
+    Returns
+    -------
+    designs : structured array (n_keep, n_trials)
+    scores : array (n_keep,)
+    counts : int array (n_keep, switch type, coherence bin)
+
+    """
+    n_batches = int(np.ceil(n_candidates / batch_size))
+    seeds = np.random.SeedSequence(seed).spawn(n_batches)
+    sizes = [min(batch_size, n_candidates - i * batch_size) for i in range(n_batches)]
+
+    with ProcessPoolExecutor(n_jobs) as pool:
+        results = list(pool.map(_search_batch, seeds, sizes,
+                                [n_keep] * n_batches,
+                                [settings] * n_batches,
+                                [rewarded_rule] * n_batches,
+                                [balance_weight] * n_batches))
+
+    designs, scores, counts = [np.concatenate(res) for res in zip(*results)]
+    best = np.argsort(scores)[::-1][:n_keep]
+    return designs[best], scores[best], counts[best]
+
+
+def main(arglist):
+
+    help_str = 'design_search.py -s <subject_id> -m <mode> -n <n_candidates> -j <n_jobs> -o <design_dir>'
+    try:
+        opts, args = getopt.getopt(arglist, "hs:m:n:j:o:w:",
+                                   ["subject=", "mode=", "candidates=", "jobs=", "out=", "weight="])
+    except getopt.GetoptError:
+        print(help_str)
+        sys.exit(2)
+
+    mode = 'reward'
+    n_candidates = 100000
+    n_jobs = None
+    out_dir = op.abspath('./designs')
+    balance_weight = .01
+    sub = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_str)
+            sys.exit()
+        elif opt in ("-s", "--subject"):
+            sub = arg
+        elif opt in ("-m", "--mode"):
+            mode = arg
+        elif opt in ("-n", "--candidates"):
+            n_candidates = int(arg)
+        elif opt in ("-j", "--jobs"):
+            n_jobs = int(arg)
+        elif opt in ("-o", "--out"):
+            out_dir = arg
+        elif opt in ("-w", "--weight"):
+            balance_weight = float(arg)
+    if sub is None:
+        print(help_str)
+        sys.exit(2)
+
+    #same subject-specific setup as the task
+    p = datastruct.Params(mode)
+    p.sub = sub
+    p.randomize_shape_assignments()
+    rewarded_rule = None
+    n_blocks = p.num_blocks
+    if mode == 'reward':
+        p.randomize_rewarded_rule()
+        rewarded_rule = str(p.rewarded_rule)
+        n_blocks = p.num_rew_blocks + p.num_test_blocks
+
+    settings = design.design_settings(p)
+    designs, scores, counts = search(settings, rewarded_rule, n_candidates, n_blocks,
+                                     balance_weight, n_jobs = n_jobs,
+                                     seed = [ord(c) for c in sub + '_' + mode])
+
+    for num, (score, count) in enumerate(zip(scores, counts)):
+        print('block %i: score %.4f, trials per switch type %s'
+              % (num, score, dict(zip(switch_types, count.sum(1).tolist()))))
+
+    if not op.exists(out_dir):
+        os.makedirs(out_dir)
+    out_f = design.save_designs(op.join(out_dir, '%s_%s.npz' % (sub, mode)),
+                                designs, settings, rewarded_rule, scores)
+    print('saved %s' % out_f)
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -4,6 +4,145 @@ import numpy as np
 from psychopy.visual import ElementArrayStim
 
 
+class MotionKernel(object):
+    """Frame-by-frame position update for a set of random dots.
+
+    All of the per-frame work happens in place, in buffers that are
+    allocated once for ``n_dots``, so calling ``step`` on every screen
+    refresh does not create any new arrays. The displacement for a
+    direction is computed once and reused until the direction changes.
+
+    """
+    def __init__(self, n_dots, aperture, norm, interval=3,
+                 elliptical=True, rng=None):
+        """Initialize the kernel.
+
+        Parameters
+        ----------
+        n_dots : int
+            Number of dots to allocate.
+        aperture : pair of floats
+            Width and height of the aperture, in degrees.
+        norm : float
+            Distance a coherent dot moves between its appearances, in degrees.
+        interval : int
+            Number of independent sets of dots that are cycled through.
+        elliptical : bool
+            If true, dots in the corners of the aperture are hidden.
+        rng : numpy Generator, int or None
+            Source of randomness for this stimulus, or a seed for one.
+
+        """
+        self.n_dots = n_dots
+        self.aperture = np.asarray(aperture, float)
+        self.half = self.aperture / 2
+        self.norm = norm
+        self.interval = interval
+        self.elliptical = elliptical
+        self.rng = np.random.default_rng(rng)
+
+        # Dots that are part of the stimulus at the current density
+        self.active = np.ones(n_dots, bool)
+
+        # Scratch buffers for the update
+        self._rand = np.empty(n_dots)
+        self._signal = np.empty(n_dots, bool)
+        self._noise = np.empty(n_dots, bool)
+        self._work = np.empty(n_dots)
+        self._outside = np.empty(n_dots, bool)
+        self._oob = np.empty(n_dots, bool)
+        self._r2 = np.empty(n_dots)
+        self._show = np.empty(n_dots, bool)
+        self.opacities = np.empty(n_dots)
+        self._inv_axes = 1 / self.half ** 2
+
+        self.direction = None
+        self.reset()
+
+    def set_direction(self, direction):
+        """Precompute the displacement of signal dots for a direction."""
+        theta = direction / 180 * np.pi
+        self.dxdy = np.array([np.cos(theta), -np.sin(theta)]) * self.norm
+        self.direction = direction
+
+    def random_xys(self, n=None):
+        """Generate random dot positions within the stimulus aperture."""
+        if n is None:
+            n = self.n_dots
+        return self.rng.uniform(-self.half, self.half, (n, 2))
+
+    def reset(self):
+        """Generate random starting positions for each set of dots."""
+        self.dotpos = [self.random_xys() for _ in range(self.interval)]
+        self.frame = 0
+
+    def step(self, direction, coherence):
+        """Move the next set of dots and return positions and opacities.
+
+        ``coherence`` can be a scalar or an array with one value per dot.
+        The returned arrays are owned by the kernel and are overwritten on
+        the following calls.
+
+        """
+        if direction != self.direction:
+            self.set_direction(direction)
+
+        # Get the dots to be drawn on the next frame
+        xys = self.dotpos[self.frame]
+        self.frame = (self.frame + 1) % self.interval
+
+        # Identify signal dots
+        self.rng.random(out=self._rand)
+        np.less(self._rand, coherence, out=self._signal)
+        np.logical_not(self._signal, out=self._noise)
+
+        # Work on one axis at a time with 1d buffers, which is much faster
+        # than broadcasting the masks against the (n_dots, 2) array
+        self._oob.fill(False)
+        for axis in range(2):
+            pos = xys[:, axis]
+            half = self.half[axis]
+
+            # Displace the signal dots
+            np.multiply(self._signal, self.dxdy[axis], out=self._work)
+            pos += self._work
+
+            # Randomly reposition the noise dots
+            self.rng.random(out=self._work)
+            self._work *= 2 * half
+            self._work -= half
+            np.copyto(pos, self._work, where=self._noise)
+
+            # Find dots that were displaced out of bounds
+            np.abs(pos, out=self._work)
+            np.greater(self._work, half, out=self._outside)
+            self._oob |= self._outside
+
+        # Wrap-around dots that were displaced out of bounds. The reflection
+        # inv(R) . -I . R about the motion axis is -I for every direction, so
+        # a dot is sent to (dxdy - xy), the other side of the aperture.
+        for axis in range(2):
+            np.subtract(self.dxdy[axis], xys[:, axis], out=xys[:, axis],
+                        where=self._oob)
+
+        # Identify dots in the corners of an elliptical aperture
+        if self.elliptical:
+            self._r2.fill(0)
+            for axis in range(2):
+                np.multiply(xys[:, axis], xys[:, axis], out=self._work)
+                self._work *= self._inv_axes[axis]
+                self._r2 += self._work
+            np.less(self._r2, 1, out=self._show)
+        else:
+            self._show.fill(True)
+
+        # Hide the dots that are not part of the current density
+        self._show &= self.active
+        np.copyto(self.opacities, self._show)
+
+        return xys, self.opacities
+
+
 class RandomDotMotion(object):
     """Random dot motion stimulus (from Newsome, Movshon, and others).
 
@@ -17,6 +156,7 @@ class RandomDotMotion(object):
                  shape="square", size=.05, color=1,
                  density=16.7, speed=5, interval=3,
                  pos=(0, 0), aperture=5, elliptical=True,
+                 max_density=None, rng=None,
                  ):
         """Initialize the stimulus.
 
@@ -45,6 +185,13 @@ class RandomDotMotion(object):
         elliptical : bool
             If true, aperture is elliptical (or circular). Dots can move
             coherently through the corners, but will not be shown.
+        max_density : float, optional
+            Density the element array is allocated for. Dots beyond the
+            current ``density`` are hidden, so the density can be changed
+            with ``set_density`` without building a new stimulus. Defaults
+            to ``density``.
+        rng : numpy Generator, int or None
+            Source of randomness for the dot positions, or a seed for one.
 
         """
         if np.isscalar(aperture):
@@ -55,9 +202,15 @@ class RandomDotMotion(object):
         self.norm = speed * interval / win.framerate
         self.speed = speed
         self.interval = interval
-        self.n_dots = int(np.round(density * ax * ay / win.framerate))
+        self.framerate = win.framerate
 
-        self.reset()
+        if max_density is None:
+            max_density = density
+        self.n_dots = self._n_dots_at(max_density)
+        self.kernel = MotionKernel(self.n_dots, self.aperture, self.norm,
+                                   interval, elliptical, rng)
+        self.rng = self.kernel.rng
+        self.set_density(density)
 
         shape = None if shape == "square" else shape
 
@@ -69,69 +222,49 @@ class RandomDotMotion(object):
             colors = color,
             elementMask=shape,
             elementTex=None,
-            xys=next(self.dotpos),
+            xys=self.kernel.dotpos[0],
             )
 
         self.array = array
 
-    def _random_xys(self, n=None):
-        """Generate random dot positions within the stimulus aperature."""
-        # TODO allow specified random seed
-        if n is None:
-            n = self.n_dots
+    def _n_dots_at(self, density):
+        """Number of dots needed to show a given density."""
+        ax, ay = self.aperture
+        return int(np.round(density * ax * ay / self.framerate))
 
-        halfx, halfy = self.aperture / 2
-        x = np.random.uniform(-halfx, halfx, n)
-        y = np.random.uniform(-halfy, halfy, n)
-
-        return np.column_stack([x, y])
+    def _dot_coherence(self, coherence):
+        """Coherence in the form the kernel expects."""
+        return coherence
 
     def _update_positions(self, direction, coherence):
         """Find new position for the dots with some coherent motion."""
-        # Get the dots to be drawn on the next frame
-        xys = next(self.dotpos)
-
-        # Identify signal dots
-        signal = np.random.rand(self.n_dots) < coherence
+        xys, opacities = self.kernel.step(direction,
+                                          self._dot_coherence(coherence))
 
-        # Displace the signal dots
-        theta = direction / 180 * np.pi
-        dxdy = np.array([[np.cos(theta), -np.sin(theta)]]) * self.norm
-        xys[signal] += dxdy
-
-        # Randomly reposition the noise dots
-        xys[~signal] = self._random_xys(np.sum(~signal))
+        # Update the Psychopy object
+        self._set_positions(xys, opacities)
 
-        # Displace the noise dots in the opposite direction
-        # theta = (360 - direction) / 180 * np.pi
-        # dxdy = np.array([[np.cos(theta), -np.sin(theta)]]) * self.norm
-        # xys[~signal] += dxdy
+    def _set_positions(self, xys, opacities):
+        """Send dot positions and opacities to the Psychopy object."""
+        self.array.xys = xys
+        self.array.opacities = opacities
 
-        # Wrap-around dots that were displaced out of bounds
-        oob = np.any(np.abs(xys) > (self.aperture / 2), axis=1)
-        rotmat = np.array([[np.cos(theta), -np.sin(theta)],
-                           [np.sin(theta), np.cos(theta)]])
-        refmat = np.array([[-1, 0], [0, -1]])
-        xfm = np.linalg.inv(rotmat).dot(refmat).dot(rotmat)
-        xys[oob] = np.dot(xys[oob] - dxdy, xfm)
+    def set_density(self, density):
+        """Change how many of the allocated dots are shown.
 
-        # Identify dots in the corners of an elliptical aperture
-        x, y = xys.T
-        if self.elliptical:
-            a, b = (self.aperture / 2) ** 2
-            show = (x ** 2 / a + y ** 2 / b) < 1
-        else:
-            show = np.ones(self.n_dots)
+        Parameters
+        ----------
+        density : float
+            Dot density in dots per degrees per second. Densities above the
+            allocated ``max_density`` are capped.
 
-        # Update the Psychopy object
-        self.array.xys = xys
-        self.array.opacities = show.astype(float)
+        """
+        self.n_active = min(self._n_dots_at(density), self.n_dots)
+        self.kernel.active[:] = np.arange(self.n_dots) < self.n_active
 
     def reset(self):
         """Generate random starting positions for each set of dots."""
-        self.dotpos = itertools.cycle(
-            [self._random_xys() for _ in range(self.interval)]
-            )
+        self.kernel.reset()
 
     def update(self, direction, coherence):
         """Advance the dot animation one frame.
@@ -147,6 +280,184 @@ class RandomDotMotion(object):
         """
         self._update_positions(direction, coherence)
 
+    def render(self, direction, coherence, n_frames, out=None):
+        """Compute the whole dot animation for a trial ahead of time.
+
+        The stimulus is reset first, so the frames are what ``reset``
+        followed by ``n_frames`` calls to ``update`` would have shown.
+
+        Parameters
+        ----------
+        direction, coherence
+            As in ``update``.
+        n_frames : int
+            Number of screen refreshes to compute.
+        out : array, optional
+            Array of shape (n_frames, n_dots, 3) to fill, e.g. a slice of a
+            memory-mapped file. A new float32 array is made if not given.
+
+        Returns
+        -------
+        frames : array
+            x, y position and opacity of each dot on each frame.
+
+        """
+        if out is None:
+            out = np.empty((n_frames, self.n_dots, 3), np.float32)
+
+        self.reset()
+        coherence = self._dot_coherence(coherence)
+        for frame in out[:n_frames]:
+            xys, opacities = self.kernel.step(direction, coherence)
+            frame[:, :2] = xys
+            frame[:, 2] = opacities
+
+        return out
+
+    def show_frame(self, frame):
+        """Load one frame made by ``render`` instead of calling ``update``."""
+        self._set_positions(frame[:, :2], frame[:, 2])
+
     def draw(self):
         """Draw the Psychopy object to the window."""
         self.array.draw()
+
+
+class DotField(RandomDotMotion):
+    """Several random dot motion populations drawn as a single field.
+
+    The populations differ in color, shape and density but share the
+    aperture and motion. Positions and visibility for all of the dots live
+    in one contiguous array and are updated in a single pass. Dots with the
+    same shape share one ElementArrayStim (the element mask is a property
+    of the whole array), so a field of colored crosses and circles takes
+    one draw call per shape rather than one per population.
+
+    """
+    def __init__(self, win, colors, shapes, densities,
+                 size=.05, speed=5, interval=3,
+                 pos=(0, 0), aperture=5, elliptical=True,
+                 max_density=None, rng=None,
+                 ):
+        """Initialize the stimulus.
+
+        Parameters
+        ----------
+        win : Psychopy Window
+            Window object with additional attributes added by visigoth.
+        colors : list of RGB triplets
+            Color of the dots in each population, in [-1, 1] RGB.
+        shapes : list of "square" | "circle" | Psychopy mask
+            Shape of the dots in each population.
+        densities : list of floats
+            Dot density of each population in dots per degrees per second.
+        size, speed, interval, pos, aperture, elliptical, rng
+            As in ``RandomDotMotion``; shared by all populations.
+        max_density : float or list of floats, optional
+            Density each population is allocated for; see ``set_density``.
+            Defaults to ``densities``.
+
+        """
+        if np.isscalar(aperture):
+            aperture = [aperture] * 2
+        self.aperture = np.asarray(aperture)
+        self.elliptical = elliptical
+
+        self.norm = speed * interval / win.framerate
+        self.speed = speed
+        self.interval = interval
+        self.framerate = win.framerate
+
+        # Lay the dots out so that each shape occupies a contiguous block
+        n_pops = len(densities)
+        if max_density is None:
+            max_density = densities
+        max_density = np.broadcast_to(max_density, (n_pops,))
+        capacity = [self._n_dots_at(d) for d in max_density]
+        order = sorted(range(n_pops), key=lambda i: str(shapes[i]))
+        self.population = np.repeat(order, [capacity[i] for i in order])
+        self.rank = np.concatenate([np.arange(capacity[i]) for i in order])
+        self.n_dots = len(self.population)
+        self.kernel = MotionKernel(self.n_dots, self.aperture, self.norm,
+                                   interval, elliptical, rng)
+        self.rng = self.kernel.rng
+        self._coherence = np.empty(self.n_dots)
+        self.set_density(densities)
+
+        dot_colors = np.array([np.broadcast_to(np.asarray(colors[i], float), (3,))
+                               for i in range(n_pops)])
+        dot_colors = dot_colors[self.population]
+        xys = self.kernel.dotpos[0]
+
+        self.arrays = []
+        self.slices = []
+        start = 0
+        for shape, group in itertools.groupby(order, lambda i: str(shapes[i])):
+            stop = start + sum(capacity[i] for i in group)
+            if stop == start:
+                continue
+            mask = shapes[self.population[start]]
+            mask = None if mask == "square" else mask
+            array = ElementArrayStim(
+                win,
+                fieldPos=pos,
+                nElements=stop - start,
+                sizes=size,
+                colors=dot_colors[start:stop],
+                elementMask=mask,
+                elementTex=None,
+                xys=xys[start:stop],
+                )
+            self.arrays.append(array)
+            self.slices.append(slice(start, stop))
+            start = stop
+
+    def _set_positions(self, xys, opacities):
+        """Send dot positions and opacities to each Psychopy object."""
+        for array, sl in zip(self.arrays, self.slices):
+            array.xys = xys[sl]
+            array.opacities = opacities[sl]
+
+    def set_density(self, densities):
+        """Change how many of the allocated dots are shown per population.
+
+        Parameters
+        ----------
+        densities : list of floats
+            Dot density of each population in dots per degrees per second.
+            Densities above the allocated ``max_density`` are capped.
+
+        """
+        densities = np.asarray(densities, float)
+        ax, ay = self.aperture
+        n_active = np.round(densities * ax * ay / self.framerate)
+        self.kernel.active[:] = self.rank < n_active[self.population]
+        self.n_active = int(self.kernel.active.sum())
+
+    def _dot_coherence(self, coherence):
+        """Expand per-population coherences to one value per dot."""
+        if np.isscalar(coherence):
+            return coherence
+        np.take(np.asarray(coherence, float), self.population,
+                out=self._coherence)
+        return self._coherence
+
+    def update(self, direction, coherence):
+        """Advance the dot animation one frame.
+
+        Parameters
+        ----------
+        direction : float in [0, 360]
+            Direction of coherent motion, in degrees. 0 means left to right;
+            positive angles go clockwise.
+        coherence : float or list of floats in [0, 1]
+            Average proportion of dots that will be displaced coherently,
+            either for the whole field or for each population.
+
+        """
+        self._update_positions(direction, coherence)
+
+    def draw(self):
+        """Draw the Psychopy objects to the window."""
+        for array in self.arrays:
+            array.draw()
@@ -0,0 +1,124 @@
+"""Per-frame timing records for diagnosing dropped frames and jitter."""
+from __future__ import division
+import numpy as np
+
+
+class FrameTimer(object):
+    """Fixed-size ring buffer of timing information for every screen flip.
+
+    Call ``start_trial`` at the beginning of each trial and ``record`` after
+    each flip. Each record holds the trial and phase, the flip timestamp
+    returned by ``win.flip``, and how long updating the stimulus, drawing it
+    and polling for events took on that frame. Flip intervals run across
+    trial boundaries, so a stall at a trial's first flip counts as a
+    dropped frame of that trial; only the first frame recorded and frames
+    after ``mark_gap`` (e.g. after an unrecorded instruction screen) have
+    no interval. Recording only writes into
+    preallocated arrays, so it is safe to leave on in the frame loop; once
+    more than ``capacity`` frames are recorded the oldest are overwritten.
+
+    """
+    phases = ['fixation', 'choice', 'feedback', 'reward']
+
+    dtype = np.dtype([('trial', np.int32),
+                      ('phase', np.int8),
+                      ('flip', np.float64),
+                      ('update', np.float32),
+                      ('draw', np.float32),
+                      ('poll', np.float32),
+                      ('gap', np.bool_)])
+
+    summary_dtype = np.dtype([('trial', np.int32),
+                              ('n_frames', np.int32),
+                              ('n_dropped', np.int32),
+                              ('max_interval', np.float32),
+                              ('jitter', np.float32),
+                              ('update', np.float32),
+                              ('draw', np.float32),
+                              ('poll', np.float32)])
+
+    def __init__(self, win, capacity=2 ** 16, drop_tolerance=1.5):
+        """Initialize the buffer.
+
+        Parameters
+        ----------
+        win : Psychopy Window
+            Window with a ``framerate`` attribute.
+        capacity : int
+            Number of frames kept.
+        drop_tolerance : float
+            A flip interval longer than this many refresh periods counts as
+            a dropped frame.
+
+        """
+        self.frame_dur = 1 / win.framerate
+        self.drop_tolerance = drop_tolerance
+        self.buffer = np.zeros(capacity, self.dtype)
+        self.capacity = capacity
+        self.n = 0
+        self.trial = -1
+        self.gap = True
+
+    def start_trial(self, trial):
+        self.trial = trial
+
+    def mark_gap(self):
+        """Flag that the next frame follows flips that weren't recorded."""
+        self.gap = True
+
+    def record(self, flip, update=0, draw=0, poll=0, phase='fixation'):
+        """Store the timing of one frame."""
+        row = self.buffer[self.n % self.capacity]
+        row['trial'] = self.trial
+        row['phase'] = self.phases.index(phase)
+        row['flip'] = flip
+        row['update'] = update
+        row['draw'] = draw
+        row['poll'] = poll
+        row['gap'] = self.gap
+        self.gap = False
+        self.n += 1
+
+    def frames(self):
+        """Recorded frames in the order they happened."""
+        if self.n <= self.capacity:
+            return self.buffer[:self.n].copy()
+        start = self.n % self.capacity
+        return np.concatenate([self.buffer[start:], self.buffer[:start]])
+
+    def summary(self):
+        """Per-trial frame counts, dropped frames, jitter and mean durations."""
+        frames = self.frames()
+        intervals = np.diff(frames['flip'], prepend=np.nan)
+        #frames after an unrecorded pause don't follow a refresh
+        intervals[frames['gap']] = np.nan
+
+        trials = np.unique(frames['trial'])
+        summary = np.zeros(len(trials), self.summary_dtype)
+        for row, trial in zip(summary, trials):
+            sel = frames['trial'] == trial
+            ivals = intervals[sel]
+            ivals = ivals[np.isfinite(ivals)]
+            row['trial'] = trial
+            row['n_frames'] = sel.sum()
+            row['n_dropped'] = np.sum(ivals > self.drop_tolerance * self.frame_dur)
+            if len(ivals):
+                row['max_interval'] = ivals.max()
+                row['jitter'] = ivals.std()
+            for field in ['update', 'draw', 'poll']:
+                row[field] = frames[field][sel].mean()
+
+        return summary
+
+    def save(self, fname, frame_intervals=None):
+        """Write the frames and their per-trial summary to an .npz file.
+
+        ``frame_intervals`` (e.g. ``win.frameIntervals``) are saved too.
+        """
+        if frame_intervals is None:
+            frame_intervals = []
+        np.savez(fname,
+                 frames=self.frames(),
+                 summary=self.summary(),
+                 phases=np.array(self.phases),
+                 frame_intervals=np.asarray(frame_intervals, float))
@@ -0,0 +1,351 @@
+"""Run task sessions without a display, for load tests and simulated data.
+
+The task modules talk to PsychoPy through the ``visual``, ``event``, ``core``
+and ``logging`` names they import, and get their window from
+``Params.launch_window``. ``run_session`` swaps those for the stand-ins
+below while it calls a task's ``main``, so the unchanged task logic runs
+against a virtual clock that advances one refresh per ``flip`` and a
+simulated keyboard that answers from a response model. Without psychopy
+installed, importing this module first registers empty psychopy modules so
+the task modules still import::
+
+    import headless, reward
+    session = headless.run_session(reward, ['reward', '-s', 'sim01'])
+
+"""
+from __future__ import division
+import sys
+import types
+import contextlib
+import os
+import numpy as np
+
+
+def _register_psychopy_stub():
+    """Put empty psychopy modules in sys.modules.
+
+    The task modules import psychopy at module level, but ``run_session``
+    replaces every psychopy name they use, so without psychopy installed
+    they only need something to import. Import this module before the task
+    modules.
+    """
+    psychopy = types.ModuleType('psychopy')
+    sys.modules['psychopy'] = psychopy
+    for name in ['core', 'visual', 'event', 'logging', 'monitors']:
+        mod = types.ModuleType('psychopy.' + name)
+        setattr(psychopy, name, mod)
+        sys.modules[mod.__name__] = mod
+    for name in ['ShapeStim', 'Polygon', 'ElementArrayStim', 'TextStim']:
+        setattr(psychopy.visual, name, None)
+    psychopy.monitors.Monitor = None
+
+try:
+    import psychopy
+except ImportError:
+    _register_psychopy_stub()
+
+import datastruct
+import dots
+import keypoll
+import trial_functions
+import runner
+
+
+class SessionEnd(Exception):
+    """Raised by the stand-in ``core.quit`` to end a simulated session."""
+    pass
+
+
+class HeadlessWindow(object):
+    """Stand-in for a PsychoPy Window that flips against a virtual clock."""
+    def __init__(self, session, framerate=60, **kwargs):
+        self.session = session
+        self.framerate = framerate
+        self.nDroppedFrames = 0
+        self.recordFrameIntervals = False
+        self.frameIntervals = []
+        self.__dict__.update(kwargs)
+
+    def setRecordFrameIntervals(self, value=True):
+        self.recordFrameIntervals = value
+
+    def flip(self, clearBuffer=True):
+        """Advance the virtual clock by one refresh."""
+        self.session.time += 1 / self.framerate
+        if self.recordFrameIntervals:
+            self.frameIntervals.append(1 / self.framerate)
+        return self.session.time
+
+    def close(self):
+        pass
+
+
+class Stim(object):
+    """Stand-in for any PsychoPy stimulus; remembers attributes, draws nothing."""
+    def __init__(self, win=None, *args, **kwargs):
+        self.win = win
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        #setters like setEdges or setOpacity
+        if name.startswith('set'):
+            return lambda *args, **kwargs: None
+        raise AttributeError(name)
+
+    def draw(self, win=None):
+        pass
+
+
+class Monitor(object):
+    """Stand-in for psychopy.monitors.Monitor."""
+    def __init__(self, name=None, width=None, distance=None, **kwargs):
+        self.name = name
+        self.width = width
+        self.distance = distance
+
+    def setSizePix(self, size):
+        self.size = size
+
+
+class Clock(object):
+    """Stand-in for psychopy.core.Clock that reads the virtual time."""
+    def __init__(self, session):
+        self.session = session
+        self.reset()
+
+    def reset(self, newT=0):
+        self._t0 = self.session.time - newT
+
+    def getTime(self):
+        return self.session.time - self._t0
+
+
+class Namespace(object):
+    """Bag of attributes standing in for a PsychoPy module."""
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class PsychometricObserver(object):
+    """Simulated subject with Weibull accuracy and shifted-lognormal RTs.
+
+    Coherence is turned into signal strength in [0, 1] (color and shape
+    coherences are at chance at .5), and the probability of a correct answer
+    rises from .5 with a Weibull function of it. Responses slower than the
+    decision period are never made.
+
+    """
+    def __init__(self, threshold=None, slope=3.5, lapse=.02,
+                 rt_shift=.3, rt_scale=.6, rt_sigma=.35, rng=None):
+        """Initialize the observer.
+
+        Parameters
+        ----------
+        threshold : dict of floats
+            Signal strength at which accuracy is about 82% for each rule.
+        slope : float
+            Weibull slope.
+        lapse : float
+            Probability of a random response.
+        rt_shift, rt_scale, rt_sigma : floats
+            Non-decision time, median decision time at zero signal (in s)
+            and log-scale spread of the RT distribution.
+        rng : numpy Generator, int or None
+            Source of randomness, or a seed for one.
+
+        """
+        if threshold is None:
+            threshold = dict(color = .25, shape = .25, motion = .1)
+        self.threshold = threshold
+        self.slope = slope
+        self.lapse = lapse
+        self.rt_shift = rt_shift
+        self.rt_scale = rt_scale
+        self.rt_sigma = rt_sigma
+        self.rng = np.random.default_rng(rng)
+
+    def signal(self, rule, coherence):
+        """Signal strength of a coherence on a rule's dimension."""
+        if rule == 'motion':
+            return coherence
+        return max(coherence - .5, 0) / .5
+
+    def p_correct(self, rule, coherence):
+        s = self.signal(rule, coherence)
+        f = 1 - np.exp(-(s / self.threshold[rule]) ** self.slope)
+        return .5 + (.5 - self.lapse) * f
+
+    def respond(self, rule, coherence, correct_resp, keys):
+        """Return the key pressed and its RT for one trial."""
+        correct = self.rng.random() < self.p_correct(rule, coherence)
+        s = self.signal(rule, coherence)
+        rt = self.rt_shift + self.rng.lognormal(np.log(self.rt_scale * (1.5 - s)),
+                                                self.rt_sigma)
+        if correct:
+            key = str(correct_resp)
+        else:
+            key = [x for x in keys if x != str(correct_resp)][0]
+        return key, rt
+
+
+class SimulatedKeyboard(object):
+    """Stand-in for psychopy.event driven by a response model.
+
+    A response window opens the first time the task polls for the response
+    keys on a trial and closes when it polls without them (feedback and ITI
+    only check for escape). The trial is the one being run, ``len(p.resp)``,
+    and RTs are measured from the first poll of the window.
+
+    """
+    response_keys = ['1', '2']
+
+    def __init__(self, session, model):
+        self.session = session
+        self.model = model
+        self.window_open = False
+
+    def _open_window(self):
+        p = self.session.p
+        n = len(p.resp)
+        rule = p.active_rule[n] if hasattr(p, 'active_rule') else p.training_step
+        key, rt = self.model.respond(rule, p.coherence[rule], p.correct_resp[n],
+                                     self.response_keys)
+        self.onset = self.session.time
+        self.press = (key, self.onset + rt)
+        self.window_open = True
+
+    def getKeys(self, keyList=None, timeStamped=False, **kwargs):
+        if keyList is None or not set(self.response_keys) & set(keyList):
+            self.window_open = False
+            return []
+
+        if not self.window_open:
+            self._open_window()
+
+        key, press_time = self.press
+        if key is None or press_time > self.session.time:
+            return []
+        self.press = (None, None)
+
+        if timeStamped:
+            t = timeStamped.getTime() - (self.session.time - press_time)
+            return [[key, t]]
+        return [key]
+
+    def waitKeys(self, keyList=None, **kwargs):
+        self.window_open = False
+        return [keyList[0]] if keyList else ['space']
+
+    def clearEvents(self, *args, **kwargs):
+        pass
+
+
+class HeadlessSession(object):
+    """Virtual clock, window and keyboard for one simulated session."""
+    def __init__(self, response_model=None, framerate=60, overrides=None):
+        if response_model is None:
+            response_model = PsychometricObserver()
+        self.time = 0.
+        self.framerate = framerate
+        self.overrides = overrides or {}
+        self.p = None
+        self.win = None
+        self.keyboard = SimulatedKeyboard(self, response_model)
+
+    def launch_window(self, p, *args, **kwargs):
+        """Replacement for Params.launch_window; also captures the Params."""
+        for key, val in self.overrides.items():
+            setattr(p, key, val)
+        self.p = p
+        self.win = HeadlessWindow(self, self.framerate)
+        return self.win
+
+    def wait(self, secs, *args, **kwargs):
+        self.time += secs
+
+    def quit(self):
+        raise SessionEnd()
+
+    def stand_ins(self):
+        """Names to swap into the task modules."""
+        visual = Namespace(Window = lambda **kwargs: HeadlessWindow(self, self.framerate, **kwargs),
+                           TextStim = Stim,
+                           Polygon = Stim,
+                           ShapeStim = Stim,
+                           ElementArrayStim = Stim,
+                           getMsPerFrame = lambda win, *args, **kwargs: (1000 / win.framerate, 0, 0))
+        core = Namespace(Clock = lambda: Clock(self),
+                         getTime = lambda: self.time,
+                         wait = self.wait,
+                         quit = self.quit)
+        event = Namespace(getKeys = self.keyboard.getKeys,
+                          waitKeys = self.keyboard.waitKeys,
+                          clearEvents = self.keyboard.clearEvents,
+                          Mouse = Stim)
+        console = Namespace(setLevel = lambda level: None)
+        logging = Namespace(console = console, CRITICAL = 50, WARNING = 30)
+        return dict(visual = visual,
+                    core = core,
+                    event = event,
+                    logging = logging,
+                    Polygon = Stim,
+                    ShapeStim = Stim,
+                    ElementArrayStim = Stim,
+                    Monitor = Monitor)
+
+    @contextlib.contextmanager
+    def patch(self, *modules):
+        """Swap the stand-ins into the given modules for the duration."""
+        stand_ins = self.stand_ins()
+        saved = []
+        for mod in modules + (trial_functions, dots, datastruct, keypoll, runner):
+            for name, obj in stand_ins.items():
+                if hasattr(mod, name):
+                    saved.append((mod, name, getattr(mod, name)))
+                    setattr(mod, name, obj)
+        saved.append((datastruct.Params, 'launch_window', datastruct.Params.launch_window))
+        datastruct.Params.launch_window = lambda p, *args, **kwargs: self.launch_window(p)
+        try:
+            yield self
+        finally:
+            for mod, name, obj in reversed(saved):
+                setattr(mod, name, obj)
+
+
+def run_session(task, arglist, response_model=None, framerate=60,
+                overrides=None, quiet=True):
+    """Run a task module's ``main`` headless and return the session.
+
+    Parameters
+    ----------
+    task : module
+        Task module with a ``main(arglist)`` entry point, e.g. ``reward``.
+    arglist : list of strings
+        Command line arguments for ``main``, mode first.
+    response_model : object with a ``respond`` method, optional
+        Simulated subject; defaults to a ``PsychometricObserver``.
+    framerate : float
+        Refresh rate of the virtual window.
+    overrides : dict, optional
+        Params attributes to set before the first block (e.g. ``outdir``).
+    quiet : bool
+        Silence the task's printing.
+
+    Returns
+    -------
+    session : HeadlessSession
+        Holds the session's Params as ``session.p`` and the virtual
+        duration of the session as ``session.time``.
+
+    """
+    session = HeadlessSession(response_model, framerate, overrides)
+    with contextlib.ExitStack() as stack:
+        if quiet:
+            devnull = stack.enter_context(open(os.devnull, 'w'))
+            stack.enter_context(contextlib.redirect_stdout(devnull))
+        stack.enter_context(session.patch(task))
+        try:
+            task.main(list(arglist))
+        except SessionEnd:
+            pass
+    return session
@@ -0,0 +1,290 @@
+"""Build the trial-level analysis dataset from raw session files.
+
+Finds reward and switch blocks in the data directory (trial logs written by
+``trial_log`` and older pickled Params), loads them in a process pool, adds
+the columns the analysis notebooks use and writes one parquet file per
+block into a dataset partitioned by block kind and subject. Re-running only
+processes files that are new or whose contents changed, tracked by their
+sha1 in ``_manifest.json``, and then rewrites the combined csv::
+
+    python ingest.py -d ./data -o ./data/clean -c all_data_clean.csv
+
+"""
+from __future__ import division
+import sys, getopt
+import os
+import os.path as op
+import glob
+import hashlib
+import json
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from trial_log import read_trial_log
+
+patterns = ['*_reward_*.arrow', '*_switch_*.arrow',
+            '*_reward_*.pkl', '*_switch_*.pkl']
+
+manifest_name = '_manifest.json'
+
+#columns that go into the partition path rather than the files
+partition_cols = ['block', 'sub']
+
+
+####################
+#### Loading #######
+####################
+
+class LegacyParams(object):
+    """Stand-in for datastruct.Params and psychopy objects in old pickles."""
+    pass
+
+
+class LegacyUnpickler(pickle.Unpickler):
+    """Unpickle old blocks without importing datastruct or psychopy."""
+    def find_class(self, module, name):
+        if module.split('.')[0] in ['datastruct', 'psychopy']:
+            return LegacyParams
+        return pickle.Unpickler.find_class(self, module, name)
+
+
+def load_pickle(fname):
+    """Trials and metadata from a block saved as pickled Params."""
+    with open(fname, 'rb') as f:
+        p = LegacyUnpickler(f).load()
+
+    n = len(p.resp)
+    trials = pd.DataFrame(dict(trial = np.arange(n),
+                               onset = p.choice_times[:n],
+                               rt = np.asarray(p.rt, float),
+                               resp = [None if x != x else str(x) for x in p.resp],
+                               correct_resp = [str(x) for x in p.correct_resp[:n]],
+                               correct = p.correct[:n],
+                               rule = p.active_rule[:n],
+                               miniblock = p.miniblock[:n]))
+    for dimension in ['color', 'shape', 'motion']:
+        trials[dimension] = p.dimension_val[dimension][:n]
+        trials[dimension + '_coherence'] = p.coherences[dimension][:n]
+    if hasattr(p, 'rew'):
+        trials['reward'] = p.rew[:n]
+
+    meta = {key: val for key, val in vars(p).items()
+            if not isinstance(val, LegacyParams)}
+    return trials, meta
+
+
+def load_block(fname):
+    """Trials and metadata from a trial log or an old pickle."""
+    if fname.endswith('.pkl'):
+        return load_pickle(fname)
+    return read_trial_log(fname)
+
+
+####################
+#### Columns #######
+####################
+
+def miniblock_type(rule, miniblock, rewarded_rule):
+    """'rewarded', 'compete' or 'noncompete' for one trial.
+
+    The miniblock is compete when the rewarded rule is one of its two rules
+    but not the active one, and noncompete when it isn't in it at all.
+    """
+    if rewarded_rule is None:
+        return None
+    if rule == rewarded_rule:
+        return 'rewarded'
+    elif rewarded_rule in miniblock.split('_'):
+        return 'compete'
+    return 'noncompete'
+
+
+def switch_type(rule, prev_rule, rewarded_rule):
+    """'stay', 'switch_to', 'switch_away' or 'switch_other' for one trial."""
+    if prev_rule is None:
+        return None
+    if rule == prev_rule:
+        return 'stay'
+    elif rule == rewarded_rule:
+        return 'switch_to'
+    elif prev_rule == rewarded_rule:
+        return 'switch_away'
+    return 'switch_other'
+
+
+def add_columns(trials, meta):
+    """Add the analysis columns to one block's trials.
+
+    ``coherence_bin`` is the rank of the active rule's coherence among the
+    block's coherence levels and ``coherence_center`` is the bin minus the
+    mean bin of the design. The first trial of a block has no switch type.
+    """
+    df = trials.copy()
+    rewarded_rule = meta.get('rewarded_rule')
+    df['sub'] = meta['sub']
+    df['block'] = meta.get('block_kind', meta['mode'])
+    df['block_num'] = meta['step_num']
+    df['rewarded_rule'] = rewarded_rule
+
+    #coherence of the rule that was active
+    df['coherence'] = np.nan
+    df['coherence_bin'] = np.nan
+    n_levels = meta['n_coherence_levels']
+    for rule in ['color', 'shape', 'motion']:
+        active = (df['rule'] == rule).values
+        floor = meta['coherence_floor'][rule]
+        levels = np.linspace(floor, floor + meta['coherence_range'][rule], n_levels)
+        coherence = df[rule + '_coherence'].values[active]
+        df.loc[active, 'coherence'] = coherence
+        df.loc[active, 'coherence_bin'] = np.abs(coherence[:, None] - levels).argmin(1)
+    df['coherence_center'] = df['coherence_bin'] - (n_levels - 1) / 2
+
+    prev_rules = [None] + list(df['rule'][:-1])
+    df['miniblock_type'] = [miniblock_type(rule, mini, rewarded_rule)
+                            for rule, mini in zip(df['rule'], df['miniblock'])]
+    df['switch_type'] = [switch_type(rule, prev, rewarded_rule)
+                         for rule, prev in zip(df['rule'], prev_rules)]
+    df['reward_block'] = df['miniblock_type'].map({'rewarded': 'rewarded rule',
+                                                   'compete': 'unrewarded rules',
+                                                   'noncompete': 'unrewarded rules'})
+    df['correct_bin'] = df['correct'].astype(int)
+    df['logRT'] = np.log(df['rt'])
+    return df
+
+
+####################
+#### Dataset #######
+####################
+
+def file_hash(fname, chunk_size=2 ** 20):
+    sha = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def ingest_file(fname, sha, out_dir):
+    """Load one block, add the analysis columns and write its parquet part.
+
+    Returns the part's path relative to ``out_dir`` and its number of trials.
+    """
+    trials, meta = load_block(fname)
+    df = add_columns(trials, meta)
+
+    part_dir = op.join(*['%s=%s' % (col, df[col].iloc[0]) for col in partition_cols])
+    stem = op.splitext(op.basename(fname))[0]
+    part = op.join(part_dir, '%s-%s.parquet' % (stem, sha[:12]))
+    if not op.exists(op.join(out_dir, part_dir)):
+        os.makedirs(op.join(out_dir, part_dir))
+    df.drop(columns = partition_cols).to_parquet(op.join(out_dir, part), index = False)
+    return part, len(df)
+
+
+def find_files(data_dir):
+    files = []
+    for pattern in patterns:
+        files.extend(glob.glob(op.join(data_dir, pattern)))
+    return sorted(files)
+
+
+def ingest(data_dir, out_dir, n_jobs=None):
+    """Bring the dataset in ``out_dir`` up to date with ``data_dir``.
+
+    Parameters
+    ----------
+    data_dir : string
+        Directory with the raw session files.
+    out_dir : string
+        Root of the partitioned parquet dataset.
+    n_jobs : int or None
+        Worker processes; defaults to the number of CPUs.
+
+    Returns
+    -------
+    manifest : dict
+        Maps each source file (relative to ``data_dir``) to its sha1, the
+        part written for it and its number of trials.
+
+    """
+    manifest_f = op.join(out_dir, manifest_name)
+    manifest = {}
+    if op.exists(manifest_f):
+        with open(manifest_f) as f:
+            manifest = json.load(f)
+
+    current = {op.relpath(fname, data_dir): file_hash(fname)
+               for fname in find_files(data_dir)}
+
+    #drop parts whose source was removed or changed
+    for src in list(manifest):
+        if current.get(src) != manifest[src]['sha1']:
+            part = op.join(out_dir, manifest.pop(src)['part'])
+            if op.exists(part):
+                os.remove(part)
+
+    todo = sorted(src for src in current if src not in manifest)
+    print('%i files, %i to ingest' % (len(current), len(todo)))
+
+    if not op.exists(out_dir):
+        os.makedirs(out_dir)
+    with ProcessPoolExecutor(n_jobs) as pool:
+        jobs = {src: pool.submit(ingest_file, op.join(data_dir, src), current[src], out_dir)
+                for src in todo}
+        for src, job in jobs.items():
+            try:
+                part, n_trials = job.result()
+            except Exception as e:
+                print('skipping %s: %s' % (src, e))
+                continue
+            manifest[src] = dict(sha1 = current[src], part = part, n_trials = n_trials)
+
+    with open(manifest_f, 'w') as f:
+        json.dump(manifest, f, indent = 1, sort_keys = True)
+    return manifest
+
+
+def load_dataset(out_dir):
+    """Read the whole dataset back as one DataFrame."""
+    df = pd.read_parquet(out_dir)
+    for col in partition_cols:
+        df[col] = df[col].astype(str)
+    return df.sort_values(['sub', 'block', 'block_num', 'trial']).reset_index(drop = True)
+
+
+def main(arglist):
+
+    help_str = 'ingest.py -d <data_dir> -o <dataset_dir> -c <csv> -j <n_jobs>'
+    try:
+        opts, args = getopt.getopt(arglist, "hd:o:c:j:", ["data=", "out=", "csv=", "jobs="])
+    except getopt.GetoptError:
+        print(help_str)
+        sys.exit(2)
+
+    data_dir = op.abspath('./data')
+    out_dir = op.join(data_dir, 'clean')
+    csv_f = 'all_data_clean.csv'
+    n_jobs = None
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_str)
+            sys.exit()
+        elif opt in ("-d", "--data"):
+            data_dir = arg
+        elif opt in ("-o", "--out"):
+            out_dir = arg
+        elif opt in ("-c", "--csv"):
+            csv_f = arg
+        elif opt in ("-j", "--jobs"):
+            n_jobs = int(arg)
+
+    manifest = ingest(data_dir, out_dir, n_jobs)
+    if manifest and csv_f:
+        df = load_dataset(out_dir)
+        df.to_csv(csv_f, index = False)
+        print('wrote %i trials from %i subjects to %s' % (len(df), df['sub'].nunique(), csv_f))
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
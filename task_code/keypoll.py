@@ -0,0 +1,157 @@
+"""Keyboard input collected on a background thread.
+
+``psychopy.event.getKeys`` only sees key presses when it is called, so
+polling it once per frame quantizes RTs to the refresh period and puts the
+cost of the poll in the frame loop. When Psychtoolbox is available,
+``start`` instead opens a ``psychopy.hardware.keyboard.Keyboard``, whose
+events carry the hardware timestamp of the key press, and drains it on a
+daemon thread into a deque. The frame loop only empties the deque::
+
+    keypoll.start()                               #after opening the window
+    keys = keypoll.getKeys(['1', '2'], timeStamped = clock)
+
+Without Psychtoolbox (or when ``start`` isn't called, as in headless runs)
+the module functions fall through to ``psychopy.event``, so the task code
+is the same either way.
+
+"""
+from __future__ import division
+import threading
+from collections import deque
+from psychopy import core, event
+
+#the running poller, if any
+poller = None
+
+
+class KeyPoller(object):
+    """Moves key presses from a keyboard device into a queue on a thread.
+
+    Only the thread appends to the queue and only the frame loop pops from
+    it; deque appends and pops are atomic, so neither side takes a lock.
+    Presses that a ``getKeys`` call doesn't ask for are kept, as in
+    ``psychopy.event``, until a later call takes them.
+
+    """
+    def __init__(self, device, interval=.0005, maxlen=1024):
+        """Initialize the poller.
+
+        Parameters
+        ----------
+        device : object
+            Keyboard with a ``getKeys(waitRelease, clear)`` method returning
+            presses with ``name`` and ``tDown`` (seconds on the
+            ``core.getTime`` clock), like ``psychopy.hardware.keyboard``.
+        interval : float
+            Seconds between polls of the device.
+        maxlen : int
+            Presses kept if the frame loop doesn't drain the queue.
+
+        """
+        self.device = device
+        self.interval = interval
+        self.queue = deque(maxlen = maxlen)
+        self.pending = []
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target = self._run, name = 'keypoll')
+        self.thread.daemon = True
+
+    def _run(self):
+        while not self._stop.is_set():
+            for key in self.device.getKeys(waitRelease = False, clear = True):
+                self.queue.append((key.name, key.tDown))
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.thread.join()
+
+    def getKeys(self, keyList=None, timeStamped=False):
+        """Presses since the last call, in the format of ``event.getKeys``.
+
+        Parameters
+        ----------
+        keyList : list of strings, optional
+            Keys to return; all keys when None.
+        timeStamped : bool or Clock
+            Return [key, time] pairs: times on the ``core.getTime`` clock
+            when True, or on the given clock.
+
+        """
+        while self.queue:
+            self.pending.append(self.queue.popleft())
+
+        if keyList is None:
+            keys, self.pending = self.pending, []
+        else:
+            keys = [key for key in self.pending if key[0] in keyList]
+            self.pending = [key for key in self.pending if key[0] not in keyList]
+
+        if not timeStamped:
+            return [name for name, t in keys]
+        if timeStamped is True:
+            return [[name, t] for name, t in keys]
+        #shift the press times onto the clock
+        offset = timeStamped.getTime() - core.getTime()
+        return [[name, t + offset] for name, t in keys]
+
+    def clear(self):
+        self.queue.clear()
+        self.pending = []
+
+
+def start(interval=.0005):
+    """Start polling the keyboard on a thread, if Psychtoolbox is available.
+
+    Returns the poller, or None when the module falls back to
+    ``psychopy.event``.
+    """
+    global poller
+    try:
+        from psychopy.hardware import keyboard
+    except ImportError:
+        return None
+    if not getattr(keyboard, 'havePTB', False):
+        return None
+
+    if poller is None:
+        poller = KeyPoller(keyboard.Keyboard(), interval).start()
+    return poller
+
+
+def stop():
+    global poller
+    if poller is not None:
+        poller.stop()
+        poller = None
+
+
+def getKeys(keyList=None, timeStamped=False):
+    """Drain key presses from the poller, or from ``psychopy.event``."""
+    if poller is None:
+        return event.getKeys(keyList = keyList, timeStamped = timeStamped)
+    return poller.getKeys(keyList, timeStamped)
+
+
+def waitKeys(keyList=None, **kwargs):
+    """``event.waitKeys`` for instruction screens, without stale presses.
+
+    Presses made before the call (e.g. responses during the block, which
+    the poller took instead of ``psychopy.event``) are discarded, and
+    presses made while waiting are cleared from the poller afterwards.
+    """
+    event.clearEvents('keyboard')
+    keys = event.waitKeys(keyList = keyList, **kwargs)
+    if poller is not None:
+        poller.clear()
+    return keys
+
+
+def clearEvents():
+    event.clearEvents('keyboard')
+    if poller is not None:
+        poller.clear()
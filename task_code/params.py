@@ -1,7 +1,6 @@
 from copy import deepcopy
 import os.path as op
 from textwrap import dedent
-import seaborn as sns
 import numpy as np
 
 #base parameters for all runs
@@ -13,6 +12,8 @@ base = dict(
     window_color = '#0a0a0a',#'#545454',
     full_screen = True,
     test_refresh = True,
+    seed = None, #random seed; derived from subject, mode and run when None
+    design_dir = None, #optimized designs from design_search.py; random designs when None
     coherence = dict(color = .8,
                            motion = .8,
                            shape = .8),
@@ -35,6 +36,9 @@ base.update(
     dot_aperture = 6, #degrees of visual angle
     dot_density = 24,
     motion_direction_map = {'up':270, 'down':90},
+    prerender = False, #compute all dot frames of a block before it starts
+    absolute_timing = True, #time phases against deadlines on the block clock (scheduler.py) instead of counting frames
+    keyboard_thread = True, #timestamp key presses on a background thread when psychtoolbox is installed
     chroma = 50,
     lightnesses = [80, 80],
     hues = [160, 340],
@@ -74,6 +78,13 @@ train.update(
                 'color':.8,
                 'shape':.8},
     num_correct_down = np.repeat([3,3,3,3,3,3,2],3), #how many correct in a row before it gets harder
+    staircase = 'updown', #'updown', 'weighted', 'quest' or 'psi'; see staircase.py
+    staircase_target = .794, #proportion correct for the weighted and bayesian staircases
+    staircase_ci = .03, #quest and psi stop once the 95% CI of the coherence is this narrow
+    coherence_bounds = {'motion': (0, .99),
+                'color': (.51, .99),
+                'shape': (.51, .99)},
+    fine_update = {'motion': (.15, .01)}, #smaller steps once a block starts below this coherence
     feedback_dur = .75,
     decision_dur = 2,
     instruct_text = {
@@ -147,7 +158,9 @@ psychophys.update(
     run_type = 'psychophys',
     training_blocks = ['shape','motion','color']*2,
     ntrials_init = 8,
-    ntrials_test = 60
+    ntrials_test = 60,
+    coherence_method = 'constant', #'constant' levels from coherence_floor, or 'psi' for the rule being judged
+    staircase_ci = None #psi runs every trial in psychophys
 )
 
 switch = deepcopy(base)
@@ -213,3 +226,14 @@ reward.update(
     break_dur = 6, #6 minute break
 )
 
+scan = deepcopy(switch)
+
+scan.update(
+    run_type = 'scan',
+    monitor_name = 'bic',
+    num_blocks = 1,
+    prerender = True, #all dots of the run are rendered before the trigger
+    trigger_key = '5',
+    init_wait_time = 2, #seconds from the trigger to the first onset when the design has none
+    end_wait_time = 2, #fixation after the last trial
+)
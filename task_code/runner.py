@@ -0,0 +1,315 @@
+"""Trial loop shared by the task modes.
+
+A block of any mode is the same sequence of phases: instructions, trial
+order, optional pre-rendering, the go signal, and then for every trial the
+coherences, the choice period, feedback, the outcome, the trial log and
+the ITI, followed by saving the block. ``TrialRunner.run`` owns that
+sequence and the bookkeeping (clock, frame timer, schedule, response
+lists, trial log); the modes subclass it and override the phase hooks they need::
+
+    class SwitchBlock(TrialRunner):
+
+        def fname(self):
+            return self.p.sub + '_switch_' + str(self.p.step_num)
+
+        def setup_design(self):
+            setup_miniblocks_and_coherences(self.p)
+
+    SwitchBlock(p, win).run()
+
+``FeatureRunner`` adds the pieces shared by the training and psychophysics
+modes, where one feature (p.training_step) is judged on every trial.
+
+"""
+from __future__ import division
+import os.path as op
+from textwrap import dedent
+import numpy as np
+from psychopy import core, visual
+import keypoll
+from frametiming import FrameTimer
+from scheduler import Scheduler
+from trial_log import TrialLog
+from trial_functions import draw_stim, draw_error, init_stims, set_stim_densities, present_dots_record_keypress, prerender_block, unique_fname, get_basic_objects, update_rule_names
+
+
+class TrialRunner(object):
+    """One block of the dots task."""
+
+    #key that advances the instruction screens
+    instruct_key = 'space'
+
+    #whether the block's dots can be computed before it starts
+    can_prerender = True
+
+    def __init__(self, p, win):
+        self.p = p
+        self.win = win
+
+    ####################
+    #### Hooks #########
+    ####################
+
+    def fname(self):
+        """Output file name for the block, without directory or extension."""
+        raise NotImplementedError
+
+    def setup_design(self):
+        """Set the block's trial order on p (p.ntrials, p.correct_resp, ...)."""
+        raise NotImplementedError
+
+    def show_text(self, txt, wait=True):
+        message = visual.TextStim(self.win,
+            height = self.p.text_height,
+            text=dedent(txt))
+        message.draw()
+        self.win.flip()
+        if wait:
+            keypoll.waitKeys(keyList = [self.instruct_key])
+
+    def instructions(self):
+        """Intro before the first block, progress text before the others."""
+        p = self.p
+        update_rule_names(p)
+        if p.step_num == 0:
+            for txt in p.instruct_text['intro']:
+                self.show_text(txt)
+        else:
+            for txt in p.instruct_text['break_txt']:
+                txt = txt.replace('COMPLETED',str(p.step_num))
+                txt = txt.replace('TOTAL',str(p.num_blocks))
+                self.show_text(txt)
+
+    def start_block(self):
+        """Wait for the go signal; blocks start right away by default."""
+        pass
+
+    def start_trial(self, n):
+        self.timer.start_trial(n)
+        if self.schedule is not None:
+            self.schedule.start_trial(n)
+
+    def rule(self, n):
+        return self.p.active_rule[n]
+
+    def set_coherences(self, n):
+        for rule in ['color','shape','motion']:
+            self.p.coherence[rule] = self.p.coherences[rule][n]
+
+    def choice(self, n):
+        """Show the dots and record the response and RT on p."""
+        p = self.p
+        rt_clock = self.clock.getTime()
+        p.choice_times.append(rt_clock)
+
+        #color, motion and shape for this trial
+        color = p.dimension_val['color'][n]
+        motion = p.dimension_val['motion'][n]
+        shape = p.dimension_val['shape'][n]
+        rule = self.rule(n)
+        print(color, motion, shape, rule)
+
+        keys = present_dots_record_keypress(p,
+                                            self.win,
+                                            self.dotstims,
+                                            self.cue,
+                                            self.clock,
+                                            color, shape, motion,
+                                            rule,
+                                            movie = None if self.movie is None else self.movie[n],
+                                            timer = self.timer,
+                                            schedule = self.schedule)
+
+        #record keypress
+        if not keys:
+            p.resp.append(np.nan)
+            p.rt.append(np.nan)
+        else:
+            p.resp.append(keys[0][0])
+            p.rt.append(keys[0][1] - rt_clock)
+
+    def feedback(self, n):
+        """Flicker the fixation cross after errors; return whether correct.
+
+        Correct answers get no feedback, so the feedback time is left to the
+        ITI when the block runs on a schedule.
+        """
+        p = self.p
+        nframes = p.feedback_dur * self.win.framerate
+        if np.isnan(p.rt[-1]):
+            draw_error(self.win, nframes, p.too_slow_color, timer = self.timer, schedule = self.schedule)
+            return False
+        elif str(p.resp[-1]) != str(p.correct_resp[n]):
+            draw_error(self.win, nframes, p.fixation_color, timer = self.timer, schedule = self.schedule)
+            return False
+        return True
+
+    def outcome(self, n, correct):
+        """Consequences of the response; returns extra trial log columns."""
+        return {}
+
+    def iti(self, n, outcome):
+        draw_stim(self.win,
+                    self.fixation,
+                    self.p.iti * self.win.framerate,
+                    timer = self.timer,
+                    schedule = self.schedule)
+
+    def done(self, n):
+        """Whether to end the block after trial n."""
+        return False
+
+    def summary(self):
+        print('errors',self.num_errors, self.num_errors/self.n_trials)
+        print('mean_rt',np.nanmean(self.p.rt))
+
+    def save(self, out_f):
+        """Close the trial log and write the block's timing records."""
+        self.log.close()
+        self.timer.save(op.splitext(out_f)[0] + '_frames.npz', self.win.frameIntervals)
+        if self.schedule is not None:
+            print('The block ended %.3f s off schedule.' % self.schedule.delay())
+            self.schedule.save(op.splitext(out_f)[0] + '_onsets.npz')
+
+    def result(self):
+        """Value returned by ``run``."""
+        return None
+
+    ####################
+    #### Block #########
+    ####################
+
+    def run(self):
+        p, win = self.p, self.win
+        self.instructions()
+
+        #colors, dotstims, fixation cross and feedback
+        p.dot_colors = p.lch_to_rgb(p)
+        self.dotstims, self.cue = init_stims(p, win)
+        self.fixation, self.reward = get_basic_objects(win, p)
+
+        self.setup_design()
+
+        #pre-render the dots for every trial of the block
+        self.movie = None
+        if p.prerender and self.can_prerender:
+            movie_f = unique_fname(op.join(p.outdir, self.fname() + '_movie.npy'))
+            self.movie = prerender_block(p, win, self.dotstims, movie_f)
+
+        self.start_block()
+
+        #start timer
+        self.clock = core.Clock()
+
+        #per-frame timing records
+        self.timer = FrameTimer(win)
+
+        #phase onsets planned on the block clock
+        self.schedule = None
+        if p.absolute_timing:
+            self.schedule = Scheduler(self.clock, win.framerate)
+
+        #draw fixation
+        draw_stim(win,
+                    self.fixation,
+                    1 * win.framerate,
+                    timer = self.timer,
+                    schedule = self.schedule)
+
+        p.resp = []
+        p.rt = []
+        p.choice_times = []
+        p.feedback_times = []
+        p.correct = []
+        p.incorrect = [] #only for switch
+        p.bank = 0
+        win.recordFrameIntervals = True
+        self.num_errors = 0
+
+        #trial data is written to disk as each trial ends
+        out_f = unique_fname(op.join(p.outdir, self.fname() + '.arrow'))
+        self.log = TrialLog(out_f, p)
+        for n in range(p.ntrials):
+            self.start_trial(n)
+
+            #show the number of dots implied by this trial's coherences
+            self.set_coherences(n)
+            set_stim_densities(p, self.dotstims)
+
+            self.choice(n)
+            correct = self.feedback(n)
+            if not correct:
+                self.num_errors += 1
+            p.correct.append(correct)
+
+            outcome = self.outcome(n, correct)
+            self.log.write_trial(p, n, self.rule(n), correct, **outcome)
+
+            self.iti(n, outcome)
+            if self.done(n):
+                break
+        self.n_trials = n + 1
+
+        self.summary()
+        print('\nOverall, %i frames were dropped.\n' % win.nDroppedFrames)
+
+        #save data
+        self.save(out_f)
+        return self.result()
+
+
+class FeatureRunner(TrialRunner):
+    """Block in which one feature, p.training_step, is judged on every trial."""
+
+    instruct_key = '1'
+
+    def instructions(self):
+        p = self.p
+        if p.step_num == 0:
+            for txt in p.instruct_text['intro']:
+                self.show_text(txt)
+
+        if p.step_num < 3: #run through instructions for each feature the first time
+            for txt in p.instruct_text[p.training_step]:
+                self.show_text(txt)
+        else:
+            for txt in p.instruct_text['break_txt']:
+                txt = txt.replace('COMPLETED',str(p.step_num))
+                txt = txt.replace('TOTAL',str(p.total_trials))
+                txt = txt.replace('FEATURE',p.training_step)
+                self.show_text(txt, wait = False)
+
+    def setup_features(self, rng):
+        """Shuffled, balanced features for p.ntrials trials and their answers."""
+        p = self.p
+        p.dimension_val = {}
+        for dimension in ['color','motion','shape']:
+
+            if dimension == 'color':
+                direction = ['green','pink'] * int(p.ntrials/2)
+            elif dimension == 'shape':
+                direction = ['circle','cross'] * int(p.ntrials/2)
+            elif dimension == 'motion':
+                direction = ['up','down'] * int(p.ntrials/2)
+
+            correct_resp = ['1','2'] * int(p.ntrials/2)
+
+            #shuffle
+            resp = list(zip(direction, correct_resp))
+            rng.shuffle(resp)
+
+            p.dimension_val[dimension], correct_resp = zip(*resp)
+
+            if p.training_step == dimension:
+                p.correct_resp = correct_resp
+
+    def start_block(self):
+        # notify participant
+        if self.p.step_num < 2: #after 2nd intro, "space to continue" is in instructions
+            self.show_text('Press space to begin', wait = False)
+
+        #wait for scan trigger
+        keypoll.waitKeys(keyList = ['space'])
+
+    def rule(self, n):
+        return self.p.training_step
@@ -0,0 +1,332 @@
+"""Scanner runs of the switch task timed by a precompiled event schedule.
+
+Trials and their timing for a run come from its design file,
+``timing/designs/run<run - 1>.csv`` (the file ``Params.run_info`` reads),
+with one row per trial and columns
+
+* ``trial_type``: the trial's miniblock, one of ``p.miniblock_ids``,
+* ``correct_dim``: the rule in effect, one of the miniblock's two,
+* ``color_direction``, ``motion_direction`` and optionally
+  ``shape_direction``: the feature shown on each dimension, either its
+  name (e.g. ``pink``) or ``left``/``right`` for the feature answered with
+  '1'/'2'; a dimension without a column shows the feature of the correct
+  response where its rule is active, and otherwise one drawn from the
+  design stream,
+* ``correct_resp``: the key of the active dimension's feature, checked
+  against the directions,
+* ``magnitude``: the coherence level of the trial on every dimension, from
+  1 to ``p.n_coherence_levels`` (the subject's levels, as in training),
+* ``isi``: fixation between the choice period and feedback (s),
+* ``iti``: fixation after feedback (s), and optionally
+* ``onset``: trial onset from the scanner trigger (s). Without it, trials
+  follow each other from ``p.init_wait_time``, each taking
+  decision_dur + isi + feedback_dur + iti.
+
+The run's model file, ``timing/models/run<run - 1>.csv``, has a row per
+trial too, and every column it shares with the design file (or an
+``onset`` column, against the schedule) has to agree with it.
+
+The design and schedule are loaded and checked before the window opens,
+the dots of the whole run are rendered before the trigger, and each trial
+starts at its onset on a clock reset by the trigger. Besides the trial
+log, every choice and feedback event is written to a BIDS-style events
+file with its planned and actual onset::
+
+    python scanner.py scan -s sub01 -r 1
+
+"""
+from __future__ import division
+import sys
+import os.path as op
+import numpy as np
+from psychopy import core, event, logging
+import datastruct
+import keypoll
+from runner import TrialRunner
+from trial_functions import draw_stim, unique_fname
+from coherence_floors import set_subject_specific_params
+from design import trial_dtype, rules, features, apply_design
+
+schedule_dtype = np.dtype([('onset', np.float64),
+                           ('isi', np.float64),
+                           ('iti', np.float64)])
+
+
+#columns of the design file that set up the trials
+design_columns = ['trial_type', 'correct_dim', 'color_direction', 'motion_direction',
+                  'correct_resp', 'magnitude']
+
+#directions of the design files, in the order of design.features
+directions = ['left', 'right']
+
+
+def schedule_fname(p):
+    return op.join(op.abspath('timing'), 'designs', 'run' + str(int(p.run) - 1) + '.csv')
+
+
+def models_fname(p):
+    return op.join(op.abspath('timing'), 'models', 'run' + str(int(p.run) - 1) + '.csv')
+
+
+def read_table(fname):
+    return np.atleast_1d(np.genfromtxt(fname, delimiter = ',', names = True, dtype = None,
+                                       encoding = 'utf-8'))
+
+
+def load_design(fname, p, rng=None):
+    """The run's trials from a design file, as a ``design.trial_dtype`` array.
+
+    Raises ValueError if a column is missing or a trial's miniblock, rule,
+    features, correct response or coherence level don't fit p.
+    """
+    if rng is None:
+        rng = p.rng['design']
+    table = read_table(fname)
+    missing = [col for col in design_columns if col not in table.dtype.names]
+    if missing:
+        raise ValueError('%s has no %s column' % (fname, ', '.join(missing)))
+
+    n_trials = len(table)
+    design = np.recarray(n_trials, trial_dtype)
+    design.miniblock = table['trial_type']
+    design.rule = table['correct_dim']
+    design.miniblock_num = np.cumsum(np.concatenate([[0], design.miniblock[1:] != design.miniblock[:-1]]))
+    for n in range(n_trials):
+        if design.miniblock[n] not in p.miniblock_ids:
+            raise ValueError('trial %i in %s has unknown trial_type %s' % (n, fname, design.miniblock[n]))
+        if design.rule[n] not in design.miniblock[n].split('_'):
+            raise ValueError('trial %i in %s has rule %s in a %s miniblock'
+                             % (n, fname, design.rule[n], design.miniblock[n]))
+
+    correct_resp = np.array([str(x) for x in table['correct_resp']])
+    if not np.all(np.isin(correct_resp, ['1', '2'])):
+        raise ValueError('%s has correct responses other than 1 and 2' % fname)
+    levels = np.asarray(table['magnitude'])
+    if not np.all(np.isin(levels, np.arange(1, p.n_coherence_levels + 1))):
+        raise ValueError('%s has magnitudes outside 1 to %i' % (fname, p.n_coherence_levels))
+    for rule in rules:
+        col = rule + '_direction'
+        if col in table.dtype.names:
+            value = np.array([_feature_index(rule, x, fname) for x in table[col]])
+        else:
+            #the correct response gives the feature where the rule is active
+            value = rng.integers(2, size = n_trials)
+            active = design.rule == rule
+            value[active] = (correct_resp[active] == '2').astype(int)
+        design[rule] = np.array(features[rule])[value]
+        design[rule + '_resp'] = np.array(['1', '2'])[value]
+        coherence = np.linspace(p.coherence_floor[rule],
+                                p.coherence_floor[rule] + p.coherence_range[rule],
+                                p.n_coherence_levels)
+        design[rule + '_coherence'] = coherence[levels - 1]
+
+    design.correct_resp = [design[rule + '_resp'][n] for n, rule in enumerate(design.rule)]
+    wrong = np.flatnonzero(design.correct_resp != correct_resp)
+    if len(wrong):
+        raise ValueError('trial %i in %s has correct_resp %s, but its %s feature is answered with %s'
+                         % (wrong[0], fname, table['correct_resp'][wrong[0]],
+                            design.rule[wrong[0]], design.correct_resp[wrong[0]]))
+    return design
+
+
+def _feature_index(rule, value, fname):
+    value = str(value)
+    if value in directions:
+        return directions.index(value)
+    if value in features[rule]:
+        return features[rule].index(value)
+    raise ValueError('%s has unknown %s direction %s' % (fname, rule, value))
+
+
+def check_models(fname, design_fname, schedule):
+    """Check a run's model file against its design file and schedule.
+
+    The files need a row per trial, the same values in the columns they
+    share and, if the model file has onsets, the schedule's onsets.
+    Raises ValueError otherwise.
+    """
+    models = read_table(fname)
+    design = read_table(design_fname)
+    if len(models) != len(design):
+        raise ValueError('%s has %i trials and %s %i' % (fname, len(models), design_fname, len(design)))
+
+    for col in models.dtype.names:
+        if col in design.dtype.names:
+            expected = design[col]
+        elif col == 'onset':
+            expected = schedule.onset
+        else:
+            continue
+        if models[col].dtype.kind in 'fiu':
+            agree = np.isclose(models[col], expected, atol = 1e-3)
+        else:
+            agree = models[col] == expected
+        if not np.all(agree):
+            raise ValueError('%s and %s disagree on the %s of trial %i'
+                             % (fname, design_fname, col, np.flatnonzero(~agree)[0]))
+
+
+def load_schedule(fname, p):
+    """Trial onsets, ISIs and ITIs from a design file, checked against p.
+
+    Returns a record array with fields onset, isi and iti, one row per
+    trial of the run. Raises ValueError if the file has negative times or
+    onsets that don't leave room for a trial.
+    """
+    table = read_table(fname)
+    missing = [col for col in ['isi', 'iti'] if col not in table.dtype.names]
+    if missing:
+        raise ValueError('%s has no %s column' % (fname, ' or '.join(missing)))
+
+    schedule = np.zeros(len(table), schedule_dtype).view(np.recarray)
+    schedule.isi = table['isi']
+    schedule.iti = table['iti']
+
+    #shortest time a trial can take, feedback included
+    trial_dur = p.decision_dur + schedule.isi + p.feedback_dur + schedule.iti
+    if 'onset' in table.dtype.names:
+        schedule.onset = table['onset']
+    else:
+        schedule.onset = p.init_wait_time + np.concatenate([[0], np.cumsum(trial_dur[:-1])])
+
+    if np.any(schedule.isi < 0) or np.any(schedule.iti < 0) or schedule.onset[0] < 0:
+        raise ValueError('%s has negative times' % fname)
+    overlap = np.flatnonzero(np.diff(schedule.onset) < trial_dur[:-1] - 1e-6)
+    if len(overlap):
+        raise ValueError('trial %i in %s starts before trial %i can end'
+                         % (overlap[0] + 1, fname, overlap[0]))
+
+    return schedule
+
+
+def _tsv_value(val):
+    if val is None or (isinstance(val, float) and np.isnan(val)):
+        return 'n/a'
+    if isinstance(val, float):
+        return '%.4f' % val
+    return str(val)
+
+
+def write_events(fname, p, onsets):
+    """Write a BIDS-style events file for a run.
+
+    One row per choice and feedback phase (correct trials have no
+    feedback), with the actual onset
+    (``onset``), its planned onset and duration, and the trial's rule,
+    coherence and response. Times are in seconds from the trigger.
+    """
+    columns = ['onset', 'duration', 'trial_type', 'planned_onset', 'trial', 'rule',
+               'miniblock', 'coherence', 'response', 'response_time', 'correct']
+    lines = ['\t'.join(columns)]
+    for row in onsets[np.isin(onsets['phase'], ['choice', 'feedback'])]:
+        n = int(row['trial'])
+        rule = p.active_rule[n]
+        resp = p.resp[n]
+        values = [float(row['actual']), float(row['duration']), str(row['phase']),
+                  float(row['planned']), n, rule, p.miniblock[n],
+                  float(p.coherences[rule][n]),
+                  None if resp != resp else str(resp),
+                  float(p.rt[n]), int(p.correct[n])]
+        lines.append('\t'.join(_tsv_value(val) for val in values))
+
+    with open(fname, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return fname
+
+
+class ScanBlock(TrialRunner):
+    """One scanner run: switch trials at the onsets of the run's schedule."""
+
+    def fname(self):
+        return self.p.sub + '_scan_' + str(self.p.run)
+
+    def setup_design(self):
+        apply_design(self.p, self.p.design)
+
+    def start_block(self):
+        self.show_text('Waiting for the scanner', wait = False)
+        keypoll.waitKeys(keyList = [self.p.trigger_key])
+
+    def start_trial(self, n):
+        TrialRunner.start_trial(self, n)
+        #hold fixation until the trial's onset, then plan the trial from it
+        gap = self.p.schedule.onset[n] - self.schedule.next_onset
+        if gap > 0:
+            draw_stim(self.win,
+                        self.fixation,
+                        gap * self.win.framerate,
+                        timer = self.timer,
+                        schedule = self.schedule)
+        self.schedule.next_onset = self.p.schedule.onset[n]
+
+    def feedback(self, n):
+        draw_stim(self.win,
+                    self.fixation,
+                    self.p.schedule.isi[n] * self.win.framerate,
+                    timer = self.timer,
+                    schedule = self.schedule)
+        return TrialRunner.feedback(self, n)
+
+    def iti(self, n, outcome):
+        iti = self.p.schedule.iti[n]
+        if n == self.p.ntrials - 1:
+            iti += self.p.end_wait_time
+        draw_stim(self.win,
+                    self.fixation,
+                    iti * self.win.framerate,
+                    timer = self.timer,
+                    schedule = self.schedule)
+
+    def save(self, out_f):
+        TrialRunner.save(self, out_f)
+        p = self.p
+        events_f = unique_fname(op.join(p.outdir, 'sub-%s_task-%s_run-%s_events.tsv'
+                                        % (p.sub, p.mode, p.run)))
+        write_events(events_f, p, self.schedule.onsets())
+
+
+def main(arglist):
+
+    ##################################
+    #### Parameter Initialization ####
+    ##################################
+
+    # Get the experiment parameters
+    mode = arglist.pop(0)
+    p = datastruct.Params(mode)
+    p.set_by_cmdline(arglist)
+    p.randomize_shape_assignments()
+    p.init_random_streams()
+    set_subject_specific_params(p)
+
+    #trial onsets are deadlines on the schedule
+    p.absolute_timing = True
+
+    #check the run's trials and timing before anything is shown
+    design_f = schedule_fname(p)
+    p.design = load_design(design_f, p)
+    p.schedule = load_schedule(design_f, p)
+    check_models(models_fname(p), design_f, p.schedule)
+
+    ##################################
+    #### Window Initialization ####
+    ##################################
+
+    win = p.launch_window(p)
+    logging.console.setLevel(logging.WARNING)
+
+    #hide mouse
+    event.Mouse(visible = False)
+
+    ########################
+    #### Task Blocks ####
+    ########################
+
+    p.step_num = 0
+    ScanBlock(p, win).run()
+
+    core.quit()
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
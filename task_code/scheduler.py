@@ -0,0 +1,119 @@
+"""Frame loops timed against absolute deadlines on the block clock.
+
+Counting flips (``for frameN in range(nframes)``) assumes every flip takes
+one refresh, so each dropped frame lengthens the phase and the delay carries
+over to every later trial. A ``Scheduler`` instead plans each phase to start
+where the previous one was planned to end, runs its frames until the
+planned end and numbers them by elapsed time, so a late phase is cut short
+and a dropped frame is skipped rather than shown late. Phases with a
+minimum number of frames (by default the whole choice phase) are never cut:
+a late one is shifted to fit its minimum, and the phases after it (fixation,
+ITI) make up the delay::
+
+    schedule = Scheduler(clock, win.framerate)
+    for frameN in schedule.frames(p.iti, 'iti'):
+        fixation.draw()
+        win.flip()
+
+The planned onset of every phase and its actual onset (when its first flip
+returned) are kept for the block's records.
+
+"""
+from __future__ import division
+import numpy as np
+
+
+class Scheduler(object):
+    """Plans the phases of a block against onset deadlines."""
+
+    dtype = np.dtype([('trial', np.int32),
+                      ('phase', 'U16'),
+                      ('planned', np.float64),
+                      ('duration', np.float64),
+                      ('actual', np.float64)])
+
+    def __init__(self, clock, framerate, min_frames=None):
+        """Initialize the schedule at the current time of the clock.
+
+        Parameters
+        ----------
+        clock : Psychopy Clock
+            Block clock that onsets are measured on.
+        framerate : float
+            Refresh rate of the window.
+        min_frames : dict, optional
+            Minimum frames of a phase however late it starts, None for the
+            whole phase. Only the choice phase is kept whole by default.
+
+        """
+        self.clock = clock
+        self.frame_dur = 1 / framerate
+        self.min_frames = dict(choice = None) if min_frames is None else min_frames
+        self.next_onset = clock.getTime()
+        self.trial = -1
+        self.events = []
+
+    def start_trial(self, trial):
+        self.trial = trial
+
+    def frames(self, duration, phase):
+        """Frame numbers of the next phase, yielded until its planned end.
+
+        A frame drawn now is shown at the next refresh, one frame duration
+        later, and its number is the refresh count from the planned onset
+        to then, so numbers are skipped after a dropped frame. No frame is
+        shown within half a refresh of the end, which is where the next
+        phase's first flip returns. Yield to a loop that draws and flips
+        once per number.
+
+        A phase in ``min_frames`` that starts too late for its minimum is
+        shifted to end that long after now, and numbered from its shifted
+        onset; the next phase is still planned at the original end.
+        """
+        onset = self.next_onset
+        self.next_onset = onset + duration
+
+        event = [self.trial, phase, onset, duration, np.nan]
+        self.events.append(event)
+
+        if phase in self.min_frames:
+            n = self.min_frames[phase]
+            min_dur = duration if n is None else min(n * self.frame_dur, duration)
+            shown = self.clock.getTime() + self.frame_dur
+            onset = max(onset, shown - (duration - min_dur))
+        end = onset + duration
+
+        last = -1
+        while True:
+            shown = self.clock.getTime() + self.frame_dur
+            if shown >= end - self.frame_dur / 2:
+                break
+            frameN = max(int(round((shown - onset) / self.frame_dur)), last + 1)
+            yield frameN
+            if last < 0:
+                #the first flip of the phase has just returned
+                event[4] = self.clock.getTime()
+            last = frameN
+
+    def delay(self):
+        """Seconds the next frame is shown after the planned onset of the
+        next phase (negative when ahead)."""
+        return self.clock.getTime() + self.frame_dur - self.next_onset
+
+    def onsets(self):
+        """Planned onset and duration and actual onset of every phase so far."""
+        return np.array([tuple(event) for event in self.events], self.dtype)
+
+    def save(self, fname):
+        np.savez(fname, onsets = self.onsets())
+
+
+def frames(nframes, schedule=None, phase=None):
+    """Frame numbers for a phase of nframes refreshes.
+
+    Counts frames when there is no schedule, and otherwise runs the phase
+    for nframes refreshes' worth of time on the schedule.
+    """
+    if schedule is None:
+        return range(int(nframes))
+    return schedule.frames(nframes * schedule.frame_dur, phase)
@@ -0,0 +1,552 @@
+"""Adaptive staircases for coherence training, and a batched simulator.
+
+Every staircase tracks the coherence of ``n`` independent runs at once as
+arrays, so the same class drives the single subject in
+``training_staircase`` and thousands of simulated observers in
+``simulate``. The interface is::
+
+    staircase.start_block(n_down = 3)   #at the start of a training block
+    coherence = staircase.intensity     #array (n,) to show on this trial
+    staircase.update(correct)           #bool array (n,) after the response
+    staircase.estimate()                #coherence at the target accuracy
+    staircase.done()                    #whether the estimate is precise enough
+
+Higher coherence is easier; stepping "down" makes the task harder. The
+Bayesian staircases (``QuestStaircase`` and ``PsiStaircase``) report
+``done`` once the credible interval of the estimate is narrower than
+their ``ci_width``, so training can stop early.
+
+"""
+from __future__ import division
+import sys, getopt
+import numpy as np
+
+rules = ['color', 'shape', 'motion']
+
+#coherence at which color and shape are at chance
+chance_coherence = dict(color = .5, shape = .5, motion = 0)
+
+
+class UpDownStaircase(object):
+    """N-down/1-up staircase.
+
+    Coherence drops by ``step`` after ``n_down`` correct answers in a row
+    and rises by ``step`` after every error, converging near 79% correct
+    for n_down = 3. The count of correct answers restarts with each block.
+
+    """
+    def __init__(self, start, step, n_down=3, floor=0, ceiling=.99,
+                 fine_below=None, fine_step=None, n=1):
+        """Initialize the staircase.
+
+        Parameters
+        ----------
+        start : float or array
+            Starting coherence.
+        step : float
+            Coherence change per step.
+        n_down : int
+            Correct answers in a row before a step down.
+        floor, ceiling : floats
+            Bounds on the coherence.
+        fine_below, fine_step : floats, optional
+            Switch permanently to ``fine_step`` once a block starts below
+            ``fine_below``.
+        n : int
+            Number of independent runs.
+
+        """
+        self.intensity = np.broadcast_to(np.asarray(start, float), (n,)).copy()
+        self.step = np.full(n, step, float)
+        self.n_down = n_down
+        self.floor = floor
+        self.ceiling = ceiling
+        self.fine_below = fine_below
+        self.fine_step = fine_step
+        self.n_correct = np.zeros(n, int)
+
+    def start_block(self, n_down=None):
+        if n_down is not None:
+            self.n_down = n_down
+        self.n_correct[:] = 0
+        if self.fine_below is not None:
+            self.step[self.intensity < self.fine_below] = self.fine_step
+
+    def _clip(self):
+        np.clip(self.intensity, self.floor, self.ceiling, out = self.intensity)
+
+    def update(self, correct):
+        correct = np.asarray(correct, bool)
+        self.n_correct = np.where(correct, self.n_correct + 1, 0)
+        down = self.n_correct >= self.n_down
+        self.intensity -= np.where(down, self.step, 0)
+        self.intensity += np.where(correct, 0, self.step)
+        self.n_correct[down] = 0
+        self._clip()
+
+    def estimate(self):
+        return self.intensity.copy()
+
+    def done(self):
+        #up-down staircases run for as many trials as they are given
+        return np.zeros(len(self.intensity), bool)
+
+
+class WeightedUpDownStaircase(UpDownStaircase):
+    """Weighted up-down staircase (Kaernbach, 1991).
+
+    Steps down by ``step`` after every correct answer and up by
+    ``step * target / (1 - target)`` after every error, which converges on
+    ``target`` proportion correct.
+
+    """
+    def __init__(self, start, step, target=.794, floor=0, ceiling=.99,
+                 fine_below=None, fine_step=None, n=1):
+        UpDownStaircase.__init__(self, start, step, 1, floor, ceiling,
+                                 fine_below, fine_step, n)
+        self.target = target
+
+    def start_block(self, n_down=None):
+        #n_down doesn't apply; accepted so all staircases share the interface
+        UpDownStaircase.start_block(self)
+
+    def update(self, correct):
+        correct = np.asarray(correct, bool)
+        up = self.step * self.target / (1 - self.target)
+        self.intensity += np.where(correct, -self.step, up)
+        self._clip()
+
+
+def credible_interval(values, post, level=.95):
+    """Central credible interval of a quantity defined on a posterior grid.
+
+    Parameters
+    ----------
+    values : array (n_grid,)
+        Value of the quantity at each grid point.
+    post : array (n, n_grid)
+        Posterior of each run, not necessarily normalized.
+    level : float
+        Probability mass inside the interval.
+
+    Returns
+    -------
+    lower, upper : arrays (n,)
+
+    """
+    order = np.argsort(values)
+    cum = np.cumsum(post[:, order], 1)
+    cum /= cum[:, -1:]
+    tail = (1 - level) / 2
+    return (values[order][(cum >= tail).argmax(1)],
+            values[order][(cum >= 1 - tail).argmax(1)])
+
+
+class QuestStaircase(object):
+    """Bayesian staircase in the style of QUEST (Watson & Pelli, 1983).
+
+    Keeps a posterior over the Weibull threshold of each run on a grid and
+    places every trial where the posterior mean threshold predicts
+    ``target`` proportion correct.
+
+    """
+    def __init__(self, start, target=.794, offset=0, slope=3.5, guess=.5,
+                 lapse=.02, grid=None, prior_sd=.2, floor=0, ceiling=.99,
+                 ci_width=None, n=1):
+        """Initialize the staircase.
+
+        Parameters
+        ----------
+        start : float or array
+            Coherence used as the prior guess of the target coherence.
+        target : float
+            Proportion correct to track.
+        offset : float
+            Coherence at chance (.5 for color and shape, 0 for motion);
+            the psychometric function is a Weibull of coherence - offset.
+        slope, guess, lapse : floats
+            Weibull slope, chance level and lapse rate.
+        grid : array, optional
+            Candidate thresholds (in coherence above offset).
+        prior_sd : float
+            Standard deviation of the Gaussian prior on the threshold.
+        floor, ceiling : floats
+            Bounds on the coherence.
+        ci_width : float, optional
+            Width of the 95% credible interval of the target coherence at
+            which the run is done; never done when None.
+        n : int
+            Number of independent runs.
+
+        """
+        if grid is None:
+            grid = np.linspace(.005, ceiling - offset, 200)
+        self.grid = np.asarray(grid, float)
+        self.target = target
+        self.offset = offset
+        self.slope = slope
+        self.guess = guess
+        self.lapse = lapse
+        self.floor = floor
+        self.ceiling = ceiling
+        self.ci_width = ci_width
+
+        #threshold whose target coherence is the starting coherence
+        start = np.broadcast_to(np.asarray(start, float), (n,))
+        prior_mean = (start - offset) / self._target_scale()
+        log_prior = -.5 * ((self.grid - prior_mean[:, None]) / prior_sd) ** 2
+        self.log_post = log_prior - log_prior.max(1, keepdims = True)
+        self.intensity = np.empty(n)
+        self._place()
+
+    def _target_scale(self):
+        """Signal, in units of the threshold, at which p(correct) = target."""
+        f = (self.target - self.guess) / (1 - self.guess - self.lapse)
+        return (-np.log(1 - f)) ** (1 / self.slope)
+
+    def p_correct(self, intensity):
+        """p(correct) at each run's intensity for every grid threshold."""
+        signal = np.maximum(np.asarray(intensity)[..., None] - self.offset, 0)
+        f = 1 - np.exp(-(signal / self.grid) ** self.slope)
+        return self.guess + (1 - self.guess - self.lapse) * f
+
+    def threshold(self):
+        """Posterior mean threshold of each run."""
+        post = np.exp(self.log_post)
+        return (post * self.grid).sum(1) / post.sum(1)
+
+    def _place(self):
+        self.intensity[:] = self.offset + self.threshold() * self._target_scale()
+        np.clip(self.intensity, self.floor, self.ceiling, out = self.intensity)
+
+    def start_block(self, n_down=None):
+        pass
+
+    def update(self, correct):
+        correct = np.asarray(correct, bool)[:, None]
+        p = self.p_correct(self.intensity)
+        self.log_post += np.log(np.where(correct, p, 1 - p))
+        self.log_post -= self.log_post.max(1, keepdims = True)
+        self._place()
+
+    def estimate(self):
+        return self.offset + self.threshold() * self._target_scale()
+
+    def done(self):
+        if self.ci_width is None:
+            return np.zeros(len(self.intensity), bool)
+        lower, upper = credible_interval(self.offset + self.grid * self._target_scale(),
+                                         np.exp(self.log_post))
+        return upper - lower <= self.ci_width
+
+
+#grid sizes of the psi method; the likelihood of every outcome on the
+#grid is tabulated once per setting and shared by all runs
+psi_n_thresholds = 50
+psi_n_slopes = 15
+psi_n_levels = 60
+
+_tables = {}
+
+
+def psi_table(target, offset, guess, lapse, floor, ceiling):
+    """Cached lookup table for the psi method.
+
+    Returns
+    -------
+    table : dict
+        ``levels`` (n_levels,), the coherences that can be shown;
+        ``p_correct`` (n_levels, n_grid), p(correct) at each level for
+        every (threshold, slope) grid point; ``entropy`` (n_levels,
+        n_grid), the entropy of the outcome; and ``target`` (n_grid,),
+        the coherence at which each grid point predicts ``target``
+        proportion correct.
+
+    """
+    key = (target, offset, guess, lapse, floor, ceiling)
+    if key not in _tables:
+        threshold, slope = [grid.ravel() for grid in np.meshgrid(
+            np.geomspace(.005, 1 - offset, psi_n_thresholds),
+            np.geomspace(1, 10, psi_n_slopes), indexing = 'ij')]
+        levels = np.linspace(floor, ceiling, psi_n_levels)
+
+        signal = np.maximum(levels - offset, 0)[:, None]
+        p = guess + (1 - guess - lapse) * (1 - np.exp(-(signal / threshold) ** slope))
+        entropy = -(p * np.log(p) + (1 - p) * np.log(1 - p))
+
+        f = (target - guess) / (1 - guess - lapse)
+        table = dict(levels = levels, p_correct = p, entropy = entropy,
+                     target = offset + threshold * (-np.log(1 - f)) ** (1 / slope))
+        for val in table.values():
+            val.flags.writeable = False
+        _tables[key] = table
+    return _tables[key]
+
+
+class PsiStaircase(object):
+    """Psi method (Kontsevich & Tyler, 1999).
+
+    Keeps a joint posterior over the Weibull threshold and slope of each
+    run and shows, on every trial, the coherence whose outcome is expected
+    to reduce the entropy of the posterior the most. Likelihoods come from
+    ``psi_table``, so an update and a choice of coherence are two
+    matrix products over the grid.
+
+    """
+    def __init__(self, target=.794, offset=0, guess=.5, lapse=.02, floor=0,
+                 ceiling=.99, ci_width=None, n=1):
+        """Initialize the staircase with a flat prior on the log grids.
+
+        Parameters
+        ----------
+        target : float
+            Proportion correct at which the coherence is estimated.
+        offset : float
+            Coherence at chance (.5 for color and shape, 0 for motion).
+        guess, lapse : floats
+            Chance level and lapse rate of the Weibull.
+        floor, ceiling : floats
+            Range of coherences that can be shown.
+        ci_width : float, optional
+            Width of the 95% credible interval of the target coherence at
+            which the run is done; never done when None.
+        n : int
+            Number of independent runs.
+
+        """
+        self.table = psi_table(target, offset, guess, lapse, floor, ceiling)
+        self.ci_width = ci_width
+        n_grid = len(self.table['target'])
+        self.post = np.full((n, n_grid), 1 / n_grid)
+        self.level = np.empty(n, int)
+        self.intensity = np.empty(n)
+        self._select()
+
+    def _select(self):
+        #expected information gain of each level: entropy of the predicted
+        #outcome minus its expected entropy under the posterior
+        p = np.clip(self.post.dot(self.table['p_correct'].T), 1e-12, 1 - 1e-12)
+        gain = (-(p * np.log(p) + (1 - p) * np.log(1 - p))
+                - self.post.dot(self.table['entropy'].T))
+        self.level[:] = gain.argmax(1)
+        self.intensity[:] = self.table['levels'][self.level]
+
+    def start_block(self, n_down=None):
+        pass
+
+    def update(self, correct):
+        correct = np.asarray(correct, bool)[:, None]
+        p = self.table['p_correct'][self.level]
+        self.post *= np.where(correct, p, 1 - p)
+        self.post /= self.post.sum(1, keepdims = True)
+        self._select()
+
+    def estimate(self):
+        """Posterior mean coherence at the target proportion correct."""
+        return self.post.dot(self.table['target'])
+
+    def done(self):
+        if self.ci_width is None:
+            return np.zeros(len(self.intensity), bool)
+        lower, upper = credible_interval(self.table['target'], self.post)
+        return upper - lower <= self.ci_width
+
+
+def make_staircase(p, rule, n=1, kind=None, step_scale=1):
+    """Staircase for one rule from the training params.
+
+    The kind comes from p.staircase ('updown', 'weighted', 'quest' or
+    'psi'),
+    the start from p.coherence, step sizes from p.coherence_update and
+    p.fine_update (both multiplied by step_scale) and bounds from
+    p.coherence_bounds. The Bayesian staircases are done once the
+    credible interval of their estimate is narrower than p.staircase_ci.
+    """
+    if kind is None:
+        kind = p.staircase
+    start = p.coherence[rule]
+    step = p.coherence_update[rule] * step_scale
+    floor, ceiling = p.coherence_bounds[rule]
+    fine_below, fine_step = p.fine_update.get(rule, (None, None))
+    if fine_step is not None:
+        fine_step = fine_step * step_scale
+
+    if kind == 'updown':
+        return UpDownStaircase(start, step, p.num_correct_down[0],
+                               floor, ceiling, fine_below, fine_step, n)
+    elif kind == 'weighted':
+        return WeightedUpDownStaircase(start, step, p.staircase_target,
+                                       floor, ceiling, fine_below, fine_step, n)
+    elif kind == 'quest':
+        return QuestStaircase(start, p.staircase_target, chance_coherence[rule],
+                              floor = floor, ceiling = ceiling,
+                              ci_width = p.staircase_ci, n = n)
+    elif kind == 'psi':
+        return PsiStaircase(p.staircase_target, chance_coherence[rule],
+                            floor = floor, ceiling = ceiling,
+                            ci_width = p.staircase_ci, n = n)
+    raise ValueError('unknown staircase %s' % kind)
+
+
+####################
+#### Simulation ####
+####################
+
+class WeibullObservers(object):
+    """Simulated subjects with Weibull psychometric functions of coherence."""
+    def __init__(self, threshold, slope=3.5, guess=.5, lapse=.02):
+        """Initialize the observers.
+
+        Parameters
+        ----------
+        threshold : dict of arrays
+            Threshold of each observer for each rule, in coherence above
+            chance (see ``chance_coherence``).
+        slope, guess, lapse : floats or arrays
+            Weibull slope, chance level and lapse rate.
+
+        """
+        self.threshold = {rule: np.asarray(val, float) for rule, val in threshold.items()}
+        self.slope = slope
+        self.guess = guess
+        self.lapse = lapse
+
+    def p_correct(self, rule, coherence):
+        signal = np.maximum(coherence - chance_coherence[rule], 0)
+        f = 1 - np.exp(-(signal / self.threshold[rule]) ** self.slope)
+        return self.guess + (1 - self.guess - self.lapse) * f
+
+    def target_coherence(self, rule, target=.794):
+        """Coherence at which each observer is ``target`` proportion correct."""
+        f = (target - self.guess) / (1 - self.guess - self.lapse)
+        return chance_coherence[rule] + self.threshold[rule] * (-np.log(1 - f)) ** (1 / self.slope)
+
+
+def simulate(p, observers, kind=None, step_scale=1, rng=None):
+    """Run simulated observers through the training schedule in p.
+
+    Every observer gets its own staircase per rule, as in
+    ``training_staircase``, and all observers advance together trial by
+    trial through p.training_blocks (p.ntrials each, with
+    p.num_correct_down[block] as n_down).
+
+    Parameters
+    ----------
+    p : Params
+        Training parameters.
+    observers : WeibullObservers
+        Observers to simulate; their number is the length of the thresholds.
+    kind : string, optional
+        Staircase kind; defaults to p.staircase.
+    step_scale : float
+        Multiplier on the step sizes in p.
+    rng : numpy Generator, int or None
+        Source of randomness, or a seed for one.
+
+    Returns
+    -------
+    coherence : array (n_observers, n_blocks, ntrials)
+        Coherence shown on every trial.
+    correct : bool array (n_observers, n_blocks, ntrials)
+    estimate : array (n_observers, n_blocks, ntrials)
+        Estimated target coherence after every trial.
+    done : bool array (n_observers, n_blocks, ntrials)
+        Whether the staircase was done after every trial.
+
+    """
+    rng = np.random.default_rng(rng)
+    n = len(observers.threshold[p.training_blocks[0]])
+    stairs = {rule: make_staircase(p, rule, n, kind, step_scale)
+              for rule in set(p.training_blocks)}
+
+    shape = (n, len(p.training_blocks), p.ntrials)
+    coherence = np.empty(shape)
+    correct = np.empty(shape, bool)
+    estimate = np.empty(shape)
+    done = np.empty(shape, bool)
+    for block, rule in enumerate(p.training_blocks):
+        stair = stairs[rule]
+        stair.start_block(n_down = p.num_correct_down[block])
+        for trial in range(p.ntrials):
+            coherence[:, block, trial] = stair.intensity
+            correct[:, block, trial] = rng.random(n) < observers.p_correct(rule, stair.intensity)
+            stair.update(correct[:, block, trial])
+            estimate[:, block, trial] = stair.estimate()
+            done[:, block, trial] = stair.done()
+
+    return coherence, correct, estimate, done
+
+
+def convergence_trial(coherence, target, tol=.02, window=10):
+    """First trial from which the running mean stays within tol of target.
+
+    ``coherence`` is (n_observers, n_trials) for one rule's trials in
+    order and ``target`` (n_observers,); returns n_trials for observers
+    that never converge.
+    """
+    kernel = np.ones(window) / window
+    running = np.array([np.convolve(row, kernel, 'valid') for row in coherence])
+    off = np.abs(running - np.asarray(target)[:, None]) > tol
+    #last window that is still off target
+    last_off = np.where(off.any(1), off.shape[1] - 1 - off[:, ::-1].argmax(1), -1)
+    return np.minimum(last_off + window, coherence.shape[1])
+
+
+def main(arglist):
+
+    help_str = 'staircase.py -k <updown|weighted|quest|psi> -n <n_observers>'
+    try:
+        opts, args = getopt.getopt(arglist, "hk:n:", ["kind=", "observers="])
+    except getopt.GetoptError:
+        print(help_str)
+        sys.exit(2)
+
+    import datastruct
+    p = datastruct.Params('train')
+    kind = p.staircase
+    n = 2000
+    for opt, arg in opts:
+        if opt == '-h':
+            print(help_str)
+            sys.exit()
+        elif opt in ("-k", "--kind"):
+            kind = arg
+        elif opt in ("-n", "--observers"):
+            n = int(arg)
+
+    #thresholds spread over the range subjects end training at
+    rng = np.random.default_rng(0)
+    observers = WeibullObservers({rule: rng.uniform(.03, .15, n) for rule in rules})
+
+    print('%s staircase, %i observers, %i blocks of %i trials'
+          % (kind, n, len(p.training_blocks), p.ntrials))
+    if kind in ['quest', 'psi']:
+        #step sizes don't apply; report when the stopping rule fires
+        coherence, correct, estimate, done = simulate(p, observers, kind, rng = rng)
+        for rule in rules:
+            blocks = [num for num, block in enumerate(p.training_blocks) if block == rule]
+            done_trial = np.where(done[:, blocks].reshape(n, -1).any(1),
+                                  done[:, blocks].reshape(n, -1).argmax(1) + 1, np.nan)
+            stop = np.nan_to_num(done_trial, nan = len(blocks) * p.ntrials).astype(int) - 1
+            error = np.abs(estimate[:, blocks].reshape(n, -1)[np.arange(n), stop]
+                           - observers.target_coherence(rule, p.staircase_target))
+            print('%7s: median trials to CI < %.3f %4i (%.0f%% reached), error at stop %.3f'
+                  % (rule, p.staircase_ci, np.nanmedian(done_trial),
+                     100 * np.mean(~np.isnan(done_trial)), np.median(error)))
+        return
+
+    for scale in [.5, 1, 2]:
+        coherence, correct, estimate, done = simulate(p, observers, kind, scale, rng)
+        for rule in rules:
+            blocks = [num for num, block in enumerate(p.training_blocks) if block == rule]
+            trials = coherence[:, blocks].reshape(n, -1)
+            target = observers.target_coherence(rule, p.staircase_target)
+            converged = convergence_trial(trials, target)
+            error = np.abs(trials[:, -p.ntrials:].mean(1) - target)
+            print('%7s step %.3f: median trials to converge %4i, final error %.3f'
+                  % (rule, p.coherence_update[rule] * scale,
+                     np.median(converged), np.median(error)))
+
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -0,0 +1,43 @@
+"""Checks of the per-trial frame timing summary.
+
+Run from the task_code directory with ``python -m pytest test_frametiming.py``.
+"""
+from __future__ import division
+import numpy as np
+from frametiming import FrameTimer
+
+
+class Window(object):
+    framerate = 60
+
+
+def record_frames(timer, trial, t, n, phase='fixation'):
+    timer.start_trial(trial)
+    for i in range(n):
+        t += 1 / 60
+        timer.record(t, phase = phase)
+    return t
+
+
+def test_stall_at_choice_onset_is_dropped_frame():
+    timer = FrameTimer(Window())
+    t = record_frames(timer, 0, 0., 10, 'choice')
+    t = record_frames(timer, 0, t, 10)
+    #the first choice flip of trial 1 comes 50 ms after the last ITI flip
+    t = record_frames(timer, 1, t + .05 - 1 / 60, 10, 'choice')
+
+    summary = timer.summary()
+    assert summary['n_dropped'].tolist() == [0, 1]
+    assert summary['max_interval'][1] == np.float32(.05)
+
+
+def test_first_frame_and_marked_gaps_have_no_interval():
+    timer = FrameTimer(Window())
+    t = record_frames(timer, 0, 10., 5)
+    #an unrecorded instruction screen before trial 1
+    timer.mark_gap()
+    record_frames(timer, 1, t + 30, 5)
+
+    summary = timer.summary()
+    assert summary['n_dropped'].tolist() == [0, 0]
+    assert np.allclose(summary['max_interval'], 1 / 60)
@@ -9,243 +9,58 @@ import numpy as np
 import os.path as op
 import sys, getopt
 import time
-import pickle
 import datastruct 
 import pandas as pd
 import seaborn as sns
 from textwrap import dedent
-from trial_functions import check_abort, init_stims, present_dots_record_keypress, get_basic_objects, update_rule_names
+from staircase import make_staircase
+from runner import FeatureRunner
       
 
-def draw_stim(win, stim, nframes):    
-    for frameN in range(int(nframes)):
-        stim.draw()
-        win.flip()
-        check_abort(event.getKeys())
+class TrainingBlock(FeatureRunner):
+    """Training block: the judged feature's coherence follows a staircase."""
 
-#annoying function because setting opacity for textstim doesn't work    
-def draw_error(win, nframes, fixation_color):
-    for frameN in range(int(nframes)):    
-        error = visual.TextStim(win,
-                color = fixation_color,
-                text='+',
-                opacity = float((frameN % 8) >= 4))
-        error.draw()
-        win.flip()
-        check_abort(event.getKeys())
-                
-def experiment_module(p, win):
+    #coherences depend on the responses
+    can_prerender = False
 
-    ########################
-    #### Instructions ####
-    ########################
-    if p.step_num == 0:
-        for txt in p.instruct_text['intro']:
-            message = visual.TextStim(win,
-                height = p.text_height,
-                text=dedent(txt))
-            message.draw()
-            win.flip()
-            keys = event.waitKeys(keyList  = ['1'])
-                
-    if p.step_num < 3: #run through instructions for each feature the first time
-        for txt in p.instruct_text[p.training_step]:
-            message = visual.TextStim(win,
-                height = p.text_height,
-                text=dedent(txt))
-            message.draw()
-            win.flip()
-            keys = event.waitKeys(keyList  = ['1'])     
-    else:
-        for txt in p.instruct_text['break_txt']:
-            txt = txt.replace('COMPLETED',str(p.step_num))
-            txt = txt.replace('TOTAL',str(p.total_trials))
-            txt = txt.replace('FEATURE',p.training_step)
-            
-            message = visual.TextStim(win,
-                height = p.text_height,
-                text=dedent(txt))
-            message.draw()
-            win.flip()                
-            
-    ########################
-    #### Coherence #########
-    ########################
-    p.coherence_record[p.training_step] = []
-    
-    #slow down updates if we get close to the end of the range
-    if p.coherence['motion'] < .15:
-        p.coherence_update['motion'] = .01
-        
-    
-    ########################
-    #### Visual Objects ####
-    ########################
-    
-    #colors
-    p.dot_colors = p.lch_to_rgb(p)
-
-    #get fixation cross and feedback info
-    fixation, reward = get_basic_objects(win, p)
-                                                  
-    ############################
-    #### Set up Trial Order ####
-    ############################
-    p.dimension_val = {}
-    for dimension in ['color','motion','shape']:
-        
-        if dimension == 'color':
-            direction = ['green','pink'] * int(p.ntrials/2)
-        elif dimension == 'shape':
-            direction = ['circle','cross'] * int(p.ntrials/2)
-        elif dimension == 'motion':
-            direction = ['up','down'] * int(p.ntrials/2)
-                        
-        correct_resp = ['1','2'] * int(p.ntrials/2)
-        
-        #shuffle
-        resp = list(zip(direction, correct_resp))
-        np.random.shuffle(resp)
-        
-        p.dimension_val[dimension], correct_resp = zip(*resp)
-        
-        if p.training_step == dimension:
-            p.correct_resp = correct_resp
-     
-    ########################
-    #### Run Experiment ####
-    ########################
-    
-    # notify participant
-    if p.step_num < 2: #after 2nd intro, "space to continue" is in instructions
-        message = visual.TextStim(win,
-            height = p.text_height,
-            text='Press space to begin')
-        message.draw()
-        win.flip()
+    def fname(self):
+        p = self.p
+        return p.sub + '_training_' + p.training_step + '_' + str(p.step_num) + '_' + p.mode
 
-    #wait for scan trigger
-    keys = event.waitKeys(keyList  = ['space'])
-
-    #start timer
-    clock = core.Clock()   
-    
-    #draw fixation
-    draw_stim(win,
-                fixation,
-                1 * win.framerate)
-                
-    p.resp = []
-    p.rt = []
-    p.choice_times = []
-    p.feedback_times = []
-    p.incorrect = [] #only for switch
-    p.bank = 0
-    win.recordFrameIntervals = True
-    num_correct= 0
-    num_errors = 0
-    
-    for n in range(p.ntrials):
-        
-        ############################
-        ###dot stim/choice period###
-        ############################
-        print(p.coherence[p.training_step])
+    def setup_design(self):
+        p = self.p
+        p.coherence_record[p.training_step] = []
+        self.staircase = p.staircases[p.training_step]
+        self.staircase.start_block(n_down = p.num_correct_down[p.step_num])
+        p.coherence[p.training_step] = float(self.staircase.intensity[0])
 
-        #initialize dots    
-        dotstims, cue = init_stims(p, win)
-        
-        #set up response key and rt recording
-        rt_clock = clock.getTime()
-        p.choice_times.append(rt_clock)
-        correct = True
-        
-        #color, motion and shape for this trial
-        color_idx = p.dimension_val['color'][n]
-        motion_idx = p.dimension_val['motion'][n]
-        shape_idx= p.dimension_val['shape'][n]
-        print(color_idx, motion_idx, shape_idx)
+        self.setup_features(p.rng['design'])
 
-        keys = present_dots_record_keypress(p,
-                                            win,
-                                            dotstims,
-                                            cue,
-                                            clock,
-                                            color_idx, shape_idx, motion_idx,
-                                            p.training_step)
-        
-        #record keypress
-        if not keys:
-            resp = np.NaN
-            p.resp.append(resp)
-            p.rt.append(np.NaN)
-        else:
-            resp = keys[0][0]
-            p.resp.append(resp)
-            p.rt.append(keys[0][1] - rt_clock)  
-        
-        #####################
-        ###feedback period###
-        #####################
-        
-        #show feedback    
-        nframes = p.feedback_dur * win.framerate
-            
-        if np.isnan(p.rt[-1]): 
-            correct = False
-            draw_error(win, nframes, p.too_slow_color)
-            
-        elif str(resp) != str(p.correct_resp[n]):
-            correct = False            
-            draw_error(win, nframes, p.fixation_color)
+    def set_coherences(self, n):
+        #set by the staircase after each trial
+        print(self.p.coherence[self.p.training_step])
 
-        if not correct:
-            num_errors +=1   
- 
-        ######################
-        ###update coherence###
-        ######################
-        print('step_size',p.num_correct_down[p.step_num])
-        if correct:
-            num_correct += 1
-            if num_correct == p.num_correct_down[p.step_num]:
-                p.coherence[p.training_step] = p.coherence[p.training_step] - p.coherence_update[p.training_step]
-                
-                p.coherence[p.training_step] = min(p.coherence[p.training_step], .99) #don't let it go over 1
-                #don't let it get too low
-                if p.training_step in ['color','shape']:
-                    p.coherence[p.training_step] = max(p.coherence[p.training_step], .51) 
-                num_correct = 0
-                    
-        else: #wrong
-            p.coherence[p.training_step] = p.coherence[p.training_step] + p.coherence_update[p.training_step]            
-            num_correct = 0
-                
+    def outcome(self, n, correct):
+        p = self.p
+        self.staircase.update([correct])
+        p.coherence[p.training_step] = float(self.staircase.intensity[0])
         p.coherence_record[p.training_step].append(p.coherence[p.training_step])
-        
-        ################
-        ###iti period###
-        ################
-        
-        draw_stim(win,
-                    fixation,
-                    p.iti * win.framerate)
-    
+        return dict(next_coherence = p.coherence[p.training_step],
+                    coherence_estimate = float(self.staircase.estimate()[0]))
 
-    print('errors',num_errors, num_errors/p.ntrials)
-    print('mean_rt',np.nanmean(p.rt))
-    print('coherence', p.training_step, np.mean(p.coherence_record[p.training_step]))
-    print('\nOverall, %i frames were dropped.\n' % win.nDroppedFrames)
+    def done(self, n):
+        #bayesian staircases stop once the estimate is precise enough
+        return self.staircase.done()[0]
 
-    #save data
-    out_f = op.join(p.outdir,p.sub + '_training_' + p.training_step + '_' + str(p.step_num) + '_' + p.mode + '.pkl')
-    while op.exists(out_f):
-        out_f = out_f[:-4] + '+' + '.pkl'        
+    def summary(self):
+        FeatureRunner.summary(self)
+        print('coherence', self.p.training_step, np.mean(self.p.coherence_record[self.p.training_step]))
+
+    def result(self):
+        if self.p.staircase in ['quest', 'psi']:
+            return float(self.staircase.estimate()[0])
+        return np.mean(self.p.coherence_record[self.p.training_step])
 
-    with open(out_f, 'wb') as output:
-        pickle.dump(p, output, pickle.HIGHEST_PROTOCOL)
-        
-    return np.mean(p.coherence_record[p.training_step])
                               
 def main(arglist):
 
@@ -258,6 +73,7 @@ def main(arglist):
     p = datastruct.Params(mode)
     p.set_by_cmdline(arglist)
     p.randomize_shape_assignments()
+    p.init_random_streams()
 
     ##################################
     #### Window Initialization ####
@@ -275,14 +91,17 @@ def main(arglist):
     #### Task Blocks ####
     ########################
     p.coherence_record = {}
+    p.staircases = {rule: make_staircase(p, rule) for rule in set(p.training_blocks)}
     
     #loop through training steps
     summary = {'color':[],'motion':[], 'shape':[]}
     p.total_trials = len(p.training_blocks)
     for n,training_step in enumerate(p.training_blocks):
+        if p.staircases[training_step].done()[0]:
+            continue
         p.training_step = training_step
         p.step_num = n
-        mean_coherence = experiment_module(p, win)
+        mean_coherence = TrainingBlock(p, win).run()
         
         summary[training_step].append(mean_coherence)
 
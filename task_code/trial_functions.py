@@ -1,47 +1,97 @@
 from psychopy.visual import ShapeStim, Polygon
 from psychopy import core, visual, event, logging
 import dots
+import keypoll
+from scheduler import frames
+from coherence_floors import set_subject_specific_params
+from design import make_design, load_design, apply_design
 import numpy as np
-import pickle
 import os.path as op
-import glob
+import time
+
+def unique_fname(fname):
+    """Add '+' before the extension until fname doesn't clash with an existing file."""
+    stem, ext = op.splitext(fname)
+    while op.exists(stem + ext):
+        stem = stem + '+'
+    return stem + ext
 
 def check_abort(keys):
     if 'escape' in keys:
         core.quit()
+
+def draw_stim(win, stim, nframes, timer=None, phase='fixation', schedule=None):
+    for frameN in frames(nframes, schedule, phase):
+        t0 = time.perf_counter()
+        stim.draw()
+        t1 = time.perf_counter()
+        flip = win.flip()
+        t2 = time.perf_counter()
+        check_abort(keypoll.getKeys())
+        if timer is not None:
+            timer.record(flip, draw = t1 - t0, poll = time.perf_counter() - t2, phase = phase)
         
+def draw_error(win, nframes, color, timer=None, schedule=None):
+    """Flicker the fixation cross in the given color for nframes.
+
+    The cross is off for 4 frames and on for 4. One TextStim per color is
+    kept on the window, so its text texture is laid out once per session
+    instead of on every frame. With a schedule, the flicker follows the
+    refresh count since the planned onset of the feedback.
+    """
+    error_stims = getattr(win, 'error_stims', None)
+    if error_stims is None:
+        error_stims = win.error_stims = {}
+    key = str(color)
+    if key not in error_stims:
+        error_stims[key] = visual.TextStim(win,
+                color = color,
+                text='+')
+    error = error_stims[key]
+
+    for frameN in frames(nframes, schedule, 'feedback'):
+        t0 = time.perf_counter()
+        if (frameN % 8) >= 4:
+            error.draw()
+        t1 = time.perf_counter()
+        flip = win.flip()
+        t2 = time.perf_counter()
+        check_abort(keypoll.getKeys())
+        if timer is not None:
+            timer.record(flip, draw = t1 - t0, poll = time.perf_counter() - t2, phase = 'feedback')
+
+def get_dot_densities(p):
+    """Densities of the four component dotstims at the current coherences."""
+    return [p.dot_density * p.coherence['color'] * p.coherence['shape'], ##high color coherence high shape coherence
+            p.dot_density * (1 - p.coherence['color']) * p.coherence['shape'], ##low color coherence high shape coherence
+            p.dot_density * p.coherence['color'] * (1 - p.coherence['shape']), ##high color coherence low shape coherence
+            p.dot_density * (1 - p.coherence['color']) * (1 - p.coherence['shape'])] ##low color coherence low shape coherence
+
 def init_stims(p, win):
     #dots
+    #each color/shape combination is one DotField made of 4 component populations.
+    #every population is allocated for the full dot density, so changing coherences
+    #between trials only changes how many of its dots are shown (see set_stim_densities)
     shape_list = ['cross','circle']
     color_list = ['green','pink']
+    densities = get_dot_densities(p)
     dotstims = {}
+    #every DotField gets its own random stream, spawned from the session's stimulus stream
+    stim_seeds = p.seed_seqs['stim'].spawn(len(color_list) * len(shape_list))
     for color_idx, color in enumerate(color_list):
         for shape in shape_list:
-            dotstims[color + '_' + shape] = [
-            dots.RandomDotMotion(win, ##high color coherence high shape coherence 
-                                    color = p.dot_colors[color_idx],
-                                    size = p.dot_size,
-                                    shape = shape,
-                                    density = p.dot_density * p.coherence['color'] * p.coherence['shape'] ,
-                                    aperture = p.dot_aperture),
-            dots.RandomDotMotion(win, ##low color coherence high shape coherence 
-                                    color = p.dot_colors[1 - color_idx],
-                                    size = p.dot_size,
-                                    shape = shape,
-                                    density = p.dot_density * (1 - p.coherence['color']) * p.coherence['shape'] ,
-                                    aperture = p.dot_aperture),             
-            dots.RandomDotMotion(win, ##high color coherence low shape coherence 
-                                    color = p.dot_colors[color_idx],
+            other_shape = [x for x in shape_list if x != shape][0]
+            dotstims[color + '_' + shape] = dots.DotField(win,
+                                    colors = [p.dot_colors[color_idx], ##high color coherence high shape coherence
+                                              p.dot_colors[1 - color_idx], ##low color coherence high shape coherence
+                                              p.dot_colors[color_idx], ##high color coherence low shape coherence
+                                              p.dot_colors[1 - color_idx]], ##low color coherence low shape coherence
+                                    shapes = [shape, shape, other_shape, other_shape],
+                                    densities = densities,
+                                    max_density = p.dot_density,
                                     size = p.dot_size,
-                                    shape = [x for x in shape_list if x != shape][0], #other shape
-                                    density = p.dot_density * p.coherence['color'] * (1 - p.coherence['shape']),
-                                    aperture = p.dot_aperture),
-            dots.RandomDotMotion(win, ##low color coherence low shape coherence 
-                                    color = p.dot_colors[1 - color_idx],
-                                    size = p.dot_size,
-                                    shape = [x for x in shape_list if x != shape][0], #other shape
-                                    density = p.dot_density * (1 - p.coherence['color']) * (1 - p.coherence['shape']),
-                                    aperture = p.dot_aperture)]
+                                    aperture = p.dot_aperture,
+                                    rng = stim_seeds.pop())
     
     #polygonal cue
     cue = Polygon(win,
@@ -52,40 +102,86 @@ def init_stims(p, win):
     
     
     return dotstims, cue
-    
 
-def present_dots_record_keypress(p, win, dotstims, cue, clock, color, shape, motion, rule):
+def set_stim_densities(p, dotstims):
+    """Show the number of dots implied by the current coherences."""
+    densities = get_dot_densities(p)
+    for dotfield in dotstims.values():
+        dotfield.set_density(densities)
+    
+
+def prerender_block(p, win, dotstims, out_f):
+    """Compute the dot animation of every trial in the block before it starts.
+
+    Frames are written to a memory-mapped .npy file of shape
+    (ntrials, nframes, ndots, 3) holding x, y and opacity of each dot, which
+    is both streamed during the block and kept as a record of what was shown.
+    Needs the trial order (p.coherences, p.dimension_val) to be set up.
+    """
+    nframes = int(p.decision_dur * win.framerate)
+    ndots = max(dotfield.n_dots for dotfield in dotstims.values())
+    movie = np.lib.format.open_memmap(out_f,
+                                      mode = 'w+',
+                                      dtype = np.float32,
+                                      shape = (p.ntrials, nframes, ndots, 3))
+
+    trial_coherence = dict(p.coherence)
+    for n in range(p.ntrials):
+        for rule in ['color','shape','motion']:
+            p.coherence[rule] = p.coherences[rule][n]
+        set_stim_densities(p, dotstims)
+
+        dotfield = dotstims[p.dimension_val['color'][n] + '_' + p.dimension_val['shape'][n]]
+        dotfield.render(p.motion_direction_map[p.dimension_val['motion'][n]],
+                        p.coherence['motion'],
+                        nframes,
+                        out = movie[n, :, :dotfield.n_dots])
+    movie.flush()
+
+    #leave the stimuli as they were
+    p.coherence.update(trial_coherence)
+    set_stim_densities(p, dotstims)
+
+    return np.load(out_f, mmap_mode = 'r')
+
+def present_dots_record_keypress(p, win, dotstims, cue, clock, color, shape, motion, rule, movie=None, timer=None, schedule=None):
     keys = False
-    
-    #polygonal cue
-    cue.setEdges(p.cues[rule])
-    cue.draw()
-
-    #randomly initialize dot locations
-    for ds in dotstims[color + '_' + shape]:
-        ds.reset()
-    win.flip()
-
-    #loop through frames
-    nframes = p.decision_dur * win.framerate
-    for frameN in range(nframes): #update dot position
-        #loop through 4 component dotstims
-        for ds in dotstims[color + '_' + shape]:
-            ds.update(p.motion_direction_map[motion],
-                                        p.coherence['motion'])
-            ds.draw()
+
+    #randomly initialize dot locations (pre-rendered frames start from their own)
+    dotfield = dotstims[color + '_' + shape]
+    if movie is None:
+        dotfield.reset()
+
+    #loop through frames; the cue first appears with the dots on frame 0,
+    #so its onset is the scheduled onset of the choice phase
+    nframes = int(p.decision_dur * win.framerate)
+    for frameN in frames(nframes, schedule, 'choice'): #update dot position
+        t0 = time.perf_counter()
+        #all 4 component populations are updated and drawn together
+        if movie is None:
+            dotfield.update(p.motion_direction_map[motion],
+                            p.coherence['motion'])
+        else: #stream the pre-rendered frame
+            dotfield.show_frame(movie[min(frameN, len(movie) - 1), :dotfield.n_dots])
+        t1 = time.perf_counter()
+        dotfield.draw()
 
         #draw cue
         cue.setEdges(p.cues[rule])
         cue.draw()
+        t2 = time.perf_counter()
 
-        win.flip()
+        flip = win.flip()
 
         #detect keypresses
+        t3 = time.perf_counter()
         if not keys: #only record first
-            keys = event.getKeys(keyList = ['1','2'],
-                                timeStamped = clock)  # get keys from event buffer
+            keys = keypoll.getKeys(keyList = ['1','2'],
+                                   timeStamped = clock)  # get keys from the input queue
         
+        if timer is not None:
+            timer.record(flip, t1 - t0, t2 - t1, time.perf_counter() - t3, phase = 'choice')
+
     return keys
      
 def get_basic_objects(win, p):
@@ -108,133 +204,15 @@ def update_rule_names(p):
     p.instruct_text['intro'] = [x.replace('RULE3',p.cue_map[p.cues['shape']]) for x in p.instruct_text['intro']]
     
 
-def setup_miniblocks_and_coherences(p):
-    
-    
-    #Pseudorandomize miniblock structure
-    p.miniblocks = []
-    for i in range(p.num_block_reps):
-        mini = list(p.miniblock_ids) #deepcopy
-        np.random.shuffle(mini)
-        
-        #make sure no repititions
-        if len(p.miniblocks) > 0:
-            while mini[0] == p.miniblocks[-1]:
-                np.random.shuffle(mini)
-        p.miniblocks.extend(mini)
-    
+def setup_miniblocks_and_coherences(p, rng=None):
     
-    p.ntrials = p.ntrials_per_miniblock * len(p.miniblocks)
-
-    #create random color, shape, motion patterns for all trials
-    p.dimension_val = {}
-    p.dimension_correct_resp = {}
-    for dimension in ['color','motion','shape']:
-        
-        if dimension == 'color':
-            direction = ['green','pink'] * int(p.ntrials/2)
-        elif dimension == 'shape':
-            direction = ['circle','cross'] * int(p.ntrials/2)
-        elif dimension == 'motion':
-            direction = ['up','down'] * int(p.ntrials/2)
-
-        correct_resp = ['1','2'] * int(p.ntrials/2)
-        
-        #shuffle
-        resp = list(zip(direction, correct_resp))
-        np.random.shuffle(resp)
-        
-        p.dimension_val[dimension], p.dimension_correct_resp[dimension] = zip(*resp)
-     
-
-    #create vector of correct response that implictly define "correct" rule
-    p.correct_resp = []
-    p.active_rule = []
-    p.miniblock = []
-    p.coherences = dict(color = [], motion = [], shape = [])
-    
-    for block_num, block in enumerate(p.miniblocks):
-        
-        #create list of 'active' rules according to each miniblock
-        block_rules = block.split('_') #2 active rules in a block
-        block_rules = block_rules * int(p.ntrials_per_miniblock/2)
-        np.random.shuffle(block_rules)
-        
-        ########################
-        #make sure first rule of new miniblock is the rule that wasn't in old miniblock
-        ########################
-        
-        #figure out identity of unique rule
-        if block_num > 0:
-            old_rules = p.miniblocks[block_num-1].split('_') #2 old rules
-            unique_rule = list(set([x for x in block_rules if x not in old_rules]))[0]
-        
-            #reshuffle
-            while block_rules[0] != unique_rule:
-                np.random.shuffle(block_rules)
-        
-        ########################
-        #####get correct responses ####
-        ########################
-
-        for n,rule in enumerate(block_rules):
-            trial_idx = block_num*p.ntrials_per_miniblock + n
-            resp = p.dimension_correct_resp[rule][trial_idx]
-            
-            p.correct_resp.append(resp)
-            p.active_rule.append(rule)
-            p.miniblock.append(block)
-
-        ########################
-        # create coherences within miniblocks
-        ########################
-        coh = {}
-        for dimension in ['color','motion','shape']:
-            coh[dimension] = np.zeros(len(block_rules))
-    
-            #index when rule is active
-            active_times = np.array([x == dimension for x in block_rules])
-
-            #coherence levels
-            coherence = np.linspace(p.coherence_floor[dimension],
-                                    p.coherence_floor[dimension] + p.coherence_range[dimension],
-                                    num=p.n_coherence_levels)
-            coherence = list(coherence)*2
-            np.random.shuffle(coherence)
-
-            if sum(active_times) > 0: #this means that rule is active in this miniblock
-                coh[dimension][active_times] = coherence
-    
-                #shuffle again and set other trials
-                np.random.shuffle(coherence)
-                coh[dimension][~active_times] = coherence
-
-            else: #this means this rule is not active, so set randomly
-                coherence = coherence*2
-                np.random.shuffle(coherence)
-                coh[dimension] = coherence
-            
-            p.coherences[dimension].extend(list(coh[dimension]))
-            
-def set_subject_specific_params(p):
-    
-    p.coherence_floor = {}
-    for rule in ['color','shape','motion']:
-        
-        #should be 7 blocks, but check for less just in case
-        files = glob.glob(op.join(op.abspath('./data'), p.sub + '_training_' + rule + '*'))
-        file_idx = [int(x.split('_')[-2]) for x in files]
-        f = files[file_idx.index(max(file_idx))]
-        print(f)
-        
-        with open(f, 'rb') as f:
-            training_data = pickle.load(f)
-            
-        mean_coherence = np.mean(training_data.coherence_record[rule])
-        
-        if rule == 'motion':
-            p.coherence_floor[rule] = np.round(max(mean_coherence, .02),2)
-        else:
-            p.coherence_floor[rule] = np.round(max(mean_coherence, .52),2) 
+    #all randomization comes from the session's design stream
+    if rng is None:
+        rng = p.rng['design']
     
-    print(p.coherence_floor)
\ No newline at end of file
+    #miniblock order, active rules, features and coherences for the block,
+    #from the subject's optimized designs if there are any
+    if getattr(p, 'design_dir', None) is not None:
+        apply_design(p, load_design(p))
+    else:
+        apply_design(p, make_design(p, rng))
@@ -0,0 +1,152 @@
+"""Trial-level data files written incrementally as the task runs.
+
+Each block is saved as an Arrow IPC stream with one row per trial. A row is
+written and flushed as soon as its trial ends, so a crash loses at most the
+trial in progress, and the block's settings are stored once as metadata in
+the schema instead of pickling the whole Params object::
+
+    log = TrialLog(out_f, p)
+    for n in range(p.ntrials):
+        ...
+        log.write_trial(p, n, rule, correct, reward = rew)
+    log.close()
+
+    df, meta = read_trial_log(out_f)
+
+"""
+from __future__ import division
+import json
+import time
+import numpy as np
+import pyarrow as pa
+
+
+schema = pa.schema([('trial', pa.int32()),
+                    ('onset', pa.float64()),
+                    ('rt', pa.float64()),
+                    ('resp', pa.string()),
+                    ('correct_resp', pa.string()),
+                    ('correct', pa.bool_()),
+                    ('rule', pa.string()),
+                    ('miniblock', pa.string()),
+                    ('color', pa.string()),
+                    ('shape', pa.string()),
+                    ('motion', pa.string()),
+                    ('color_coherence', pa.float64()),
+                    ('shape_coherence', pa.float64()),
+                    ('motion_coherence', pa.float64()),
+                    ('next_coherence', pa.float64()),
+                    ('coherence_estimate', pa.float64()),
+                    ('reward', pa.bool_()),
+                    ('wall_time', pa.float64())])
+
+#trial data and text that have no place in the metadata
+skip_attrs = ['resp', 'rt', 'choice_times', 'feedback_times', 'correct',
+              'incorrect', 'rew', 'correct_resp', 'active_rule', 'miniblock',
+              'coherences', 'dimension_val', 'dimension_correct_resp',
+              'coherence_record', 'instruct_text', 'seed_seqs', 'rng']
+
+
+def _jsonable(val):
+    """Convert numpy values for json; raise TypeError for anything else."""
+    if isinstance(val, np.generic):
+        return val.item()
+    if isinstance(val, np.ndarray):
+        return val.tolist()
+    raise TypeError(type(val))
+
+
+def session_metadata(p):
+    """Block settings from a Params object as a json-serializable dict.
+
+    Attributes in ``skip_attrs`` and anything json can't represent (windows,
+    random generators, ...) are left out.
+    """
+    meta = {}
+    for key, val in vars(p).items():
+        if key in skip_attrs or key.startswith('_'):
+            continue
+        try:
+            meta[key] = json.loads(json.dumps(val, default=_jsonable))
+        except (TypeError, ValueError):
+            continue
+    return meta
+
+
+class TrialLog(object):
+    """Append-only trial log for one block."""
+    def __init__(self, fname, p):
+        """Open the file and write the schema with the block's metadata.
+
+        Parameters
+        ----------
+        fname : string
+            Output file, conventionally with an .arrow extension.
+        p : Params
+            Parameters of the block; see ``session_metadata``.
+
+        """
+        self.fname = fname
+        meta = json.dumps(session_metadata(p), default=_jsonable)
+        self.schema = schema.with_metadata({'session': meta})
+        self.sink = pa.OSFile(fname, 'wb')
+        self.writer = pa.ipc.new_stream(self.sink, self.schema)
+
+    def write(self, **row):
+        """Append one row; columns that aren't given are left null."""
+        batch = pa.RecordBatch.from_arrays(
+            [pa.array([row.get(field.name)], field.type) for field in self.schema],
+            schema = self.schema)
+        self.writer.write_batch(batch)
+        self.sink.flush()
+
+    def write_trial(self, p, n, rule, correct, **extra):
+        """Append trial n from the lists the task keeps on p.
+
+        Response, RT and onset are taken from the last entries of p.resp,
+        p.rt and p.choice_times, the stimulus from p.dimension_val and the
+        coherences from p.coherence. Task-specific columns such as
+        ``reward`` or ``next_coherence`` are passed as keywords.
+        """
+        resp = p.resp[-1]
+        rt = p.rt[-1]
+        row = dict(trial = n,
+                   onset = p.choice_times[-1],
+                   rt = None if np.isnan(rt) else rt,
+                   resp = None if resp is None or resp != resp else str(resp),
+                   correct_resp = str(p.correct_resp[n]),
+                   correct = bool(correct),
+                   rule = rule,
+                   wall_time = time.time())
+        if len(getattr(p, 'miniblock', [])) > n:
+            row['miniblock'] = p.miniblock[n]
+        for dimension in ['color', 'shape', 'motion']:
+            row[dimension] = p.dimension_val[dimension][n]
+            row[dimension + '_coherence'] = float(p.coherence[dimension])
+        row.update(extra)
+        self.write(**row)
+
+    def close(self):
+        self.writer.close()
+        self.sink.close()
+
+
+def read_trial_log(fname):
+    """Load a trial log as a DataFrame and its metadata dict.
+
+    A file cut short by a crash is read up to its last complete trial.
+    """
+    with pa.OSFile(fname, 'rb') as source:
+        reader = pa.ipc.open_stream(source)
+        batches = []
+        while True:
+            try:
+                batches.append(reader.read_next_batch())
+            except StopIteration:
+                break
+            except (pa.ArrowInvalid, OSError):
+                break
+        table = pa.Table.from_batches(batches, schema = reader.schema)
+
+    meta = json.loads(reader.schema.metadata[b'session'])
+    return table.to_pandas(), meta